@@ -0,0 +1,481 @@
+# benchmark.py
+#
+# Offline benchmark of the certificate pipeline. Each case (template x number
+# of names) runs in its own process so peak RSS is per case, and reports the
+# time spent rendering overlays, merging them and writing the files. Results
+# can be saved as JSON and compared against a stored baseline; the exit code
+# is 1 when a case regressed by more than the tolerance.
+#
+#   python benchmark.py [--sizes 10,1000,10000] [--output results.json]
+#                       [--baseline baseline.json] [--tolerance 0.2]
+#
+# With --memory, a long streamed batch checks instead that the resident
+# memory stays flat (exit code 1 when it grows by more than --memory-tolerance).
+#
+#   python benchmark.py --memory [1000000] [--workers 4]
+#
+# With --template-reuse, a batch checks instead that the template file is
+# opened a single time, and that its certificates are byte-identical to ones
+# merged onto a template parsed again for each certificate (the path before
+# templates were compiled once), with ReportLab's invariant mode on and the
+# parts that differ between runs blanked (see normalize_pdf).
+#
+#   python benchmark.py --template-reuse [5000]
+
+import argparse
+import builtins
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SIZES = (10, 1000, 10000)
+
+# Relative slowdown (or growth) tolerated before a metric counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+# Stage times closer than this (ms per certificate) are within timer noise
+NOISE_FLOOR_MS = 0.5
+
+STAGES = ("overlay", "merge", "write")
+
+# Names streamed by the memory check, and the resident memory growth it tolerates
+MEMORY_NAMES = 1000000
+MEMORY_TOLERANCE_MB = 8.0
+
+# Number of RSS samples taken during the memory check
+MEMORY_SAMPLES = 10
+
+# The memory check cycles through this many names, so it overwrites the same files
+MEMORY_DISTINCT_NAMES = 1000
+
+# Names of the template reuse check
+TEMPLATE_REUSE_NAMES = 5000
+
+FONT_SETTINGS = {"family": "Times-Roman", "size": 24, "color": "#000000"}
+POSITION = (300, 400)
+
+FIRST_NAMES = ["Ana", "Diogo", "Vitor", "Maria", "João", "Inês", "Francisco", "Beatriz", "Zoë", "Miguel"]
+LAST_NAMES = ["Roma", "Campos", "Prado", "Silva", "Gonçalves", "Ferreira", "Albuquerque e Bragança", "Costa"]
+
+
+def synthetic_names(count, seed=0):
+    """Return count reproducible names of varying length (with accented characters)."""
+    rng = random.Random(seed)
+    return [f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}" for i in range(count)]
+
+
+def stream_names(count, distinct=MEMORY_DISTINCT_NAMES, seed=0):
+    """Yield count names lazily, repeating distinct different ones (see synthetic_names)."""
+    rng = random.Random(seed)
+    names = [f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}" for i in range(distinct)]
+    for i in range(count):
+        yield names[i % distinct]
+
+
+def build_heavy_template(path, shapes=3000, image_size=1024):
+    """
+    Write a template with a large raster image and many vector paths, the kind
+    of artwork exported by design tools.
+    """
+    from PIL import Image
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    rng = random.Random(0)
+    noise = Image.frombytes("RGB", (image_size, image_size), rng.randbytes(image_size * image_size * 3))
+
+    c = canvas.Canvas(path, pagesize=letter)
+    c.drawImage(ImageReader(noise), 0, 0, width=letter[0], height=letter[1])
+    for _ in range(shapes):
+        c.setStrokeColorRGB(rng.random(), rng.random(), rng.random())
+        c.bezier(*(rng.uniform(0, 612) if i % 2 == 0 else rng.uniform(0, 792) for i in range(8)))
+    c.setFont("Helvetica-Bold", 36)
+    c.drawCentredString(306, 600, "Certificate of Achievement")
+    c.save()
+
+
+def run_case(template_path, count, temp_files=False, optimize=False):
+    """
+    Generate count certificates in this process, timing each stage.
+
+    Returns:
+        Dictionary with stage times in seconds, output bytes and peak RSS
+    """
+    from modules.processor import create_name_overlay, load_template, merge_overlay, render_name_overlay
+    from modules.utils import atomic_open
+
+    stages = dict.fromkeys(STAGES, 0.0)
+    output_dir = tempfile.mkdtemp(prefix="signit-bench-")
+    output_bytes = 0
+
+    start = time.perf_counter()
+    template = load_template(template_path, optimize)
+    load_time = time.perf_counter() - start
+
+    try:
+        for i, name in enumerate(synthetic_names(count)):
+            t0 = time.perf_counter()
+            if temp_files:
+                overlay = create_name_overlay(name, FONT_SETTINGS, POSITION)
+            else:
+                overlay = render_name_overlay(name, FONT_SETTINGS, POSITION)
+
+            t1 = time.perf_counter()
+            buffer = io.BytesIO()
+            merge_overlay(template, overlay).write(buffer)
+            data = buffer.getvalue()
+
+            t2 = time.perf_counter()
+            with atomic_open(os.path.join(output_dir, f"certificate_{i}.pdf")) as f:
+                f.write(data)
+            if temp_files:
+                os.remove(overlay)
+
+            t3 = time.perf_counter()
+            stages["overlay"] += t1 - t0
+            stages["merge"] += t2 - t1
+            stages["write"] += t3 - t2
+            output_bytes += len(data)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    total = load_time + sum(stages.values())
+    return {
+        "names": count,
+        "load": load_time,
+        "stages": stages,
+        "total": total,
+        "certificates_per_second": count / total if total > 0 else 0.0,
+        "bytes_per_certificate": output_bytes / count if count else 0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_memory_case(template_path, count, workers=None, samples=MEMORY_SAMPLES):
+    """
+    Stream count names through iter_certificates in this process, sampling its resident memory.
+
+    Returns:
+        Dictionary with the (certificates done, RSS MiB) samples
+    """
+    from modules.processor import iter_certificates
+
+    output_dir = tempfile.mkdtemp(prefix="signit-bench-")
+    checkpoints = {count * k // samples for k in range(1, samples + 1)}
+    rss = []
+    start = time.perf_counter()
+    try:
+        results = iter_certificates(template_path, stream_names(count), FONT_SETTINGS, POSITION, output_dir,
+                                    workers=workers, chunk_size=64, engine="direct")
+        for done, (_, name, _, error) in enumerate(results, 1):
+            if error is not None:
+                raise RuntimeError(f"{name}: {error}")
+            if done in checkpoints:
+                rss.append((done, current_rss_mb()))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    return {"names": count, "workers": workers, "seconds": time.perf_counter() - start, "rss_mb": rss}
+
+
+def current_rss_mb():
+    """Return the resident set size of this process in MiB (None where /proc is not available)."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure_memory(template_path, count, workers):
+    """Run the memory case in a fresh interpreter and return its result dictionary."""
+    command = [sys.executable, os.path.abspath(__file__), "--run-memory", template_path, str(count)]
+    if workers:
+        command += ["--workers", str(workers)]
+    output = subprocess.run(command, cwd=HERE, capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def check_memory(template_path, count, workers, tolerance_mb):
+    """
+    Check that the resident memory of a streamed batch does not depend on its size.
+
+    The batch runs twice in fresh interpreters, with count names and with
+    1/100th of them, and the memory at the end of both runs is compared. This
+    catches memory that grows gradually as well as memory taken up front (for
+    instance by queuing every name at once).
+
+    Returns:
+        True when the large run ended with at most tolerance_mb more than the small one
+    """
+    small = measure_memory(template_path, max(count // 100, MEMORY_SAMPLES), workers)
+    result = measure_memory(template_path, count, workers)
+
+    print(f"{count} names, {result['workers'] or 'no'} workers, {result['seconds']:.1f}s")
+    for done, rss in result["rss_mb"]:
+        print(f"  {done:>9} certificates: {rss:.1f} MiB" if rss is not None else f"  {done:>9}: n/a")
+    baseline = small["rss_mb"][-1][1]
+    if baseline is None:
+        print("Resident memory is not available on this platform")
+        return True
+
+    growth = result["rss_mb"][-1][1] - baseline
+    print(f"Growth over a {small['names']}-name run: {growth:+.1f} MiB (tolerance {tolerance_mb:.1f} MiB)")
+    return growth <= tolerance_mb
+
+
+@contextmanager
+def counting_opens(path):
+    """Count the calls to open() on a file while the block runs; yields a list holding the count."""
+    path = os.path.abspath(path)
+    opens = [0]
+    original = builtins.open
+
+    def counting_open(file, *args, **kwargs):
+        if isinstance(file, (str, os.PathLike)) and os.path.abspath(file) == path:
+            opens[0] += 1
+        return original(file, *args, **kwargs)
+
+    builtins.open = counting_open
+    try:
+        yield opens
+    finally:
+        builtins.open = original
+
+
+def normalize_pdf(data):
+    """
+    Return PDF bytes with the parts that differ between runs blanked.
+
+    These are the document ID, dates, the random UUID suffix merge_page
+    gives overlay resources whose names clash with the template's (e.g. /F1),
+    and the order of the /ProcSet entries merge_page takes from a set (it
+    depends on the process's hash seed).
+    """
+    data = re.sub(rb"/ID\s*\[\s*<[0-9A-Fa-f]*>\s*<[0-9A-Fa-f]*>\s*\]", b"/ID [<><>]", data)
+    data = re.sub(rb"\(D:[^)]*\)", b"(D:)", data)
+    data = re.sub(rb"/ProcSet \[ ([^]]*) \]", lambda m: b"/ProcSet [ %s ]" % b" ".join(sorted(m[1].split())), data)
+    return re.sub(rb"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", b"UUID", data)
+
+
+def check_template_reuse(template_path, count):
+    """
+    Check that a batch opens its template once and writes the same bytes as parsing it per certificate.
+
+    The batch runs in this process with the ReportLab engine. Each
+    certificate is then merged again with merge_overlay given the template's
+    path, which parses the template anew, and the two are compared.
+
+    Returns:
+        True when the template was opened once and every certificate matched
+    """
+    from reportlab import rl_config
+
+    from modules.processor import certificate_path, generate_certificates, merge_overlay, render_name_overlay
+
+    # Fixed document IDs and dates in the ReportLab overlays
+    rl_config.invariant = 1
+    names = synthetic_names(count)
+    output_dir = tempfile.mkdtemp(prefix="signit-bench-")
+    try:
+        start = time.perf_counter()
+        with counting_opens(template_path) as opens:
+            generate_certificates(template_path, names, FONT_SETTINGS, POSITION, output_dir, engine="reportlab")
+        print(f"{count} names in {time.perf_counter() - start:.1f}s: template opened {opens[0]} time(s)")
+
+        mismatches = []
+        for name in names:
+            buffer = io.BytesIO()
+            merge_overlay(template_path, render_name_overlay(name, FONT_SETTINGS, POSITION)).write(buffer)
+            with open(certificate_path(name, output_dir), "rb") as f:
+                if normalize_pdf(f.read()) != normalize_pdf(buffer.getvalue()):
+                    mismatches.append(name)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    print(f"{count - len(mismatches)} of {count} certificates identical to a per-certificate parse"
+          + (f" (first difference: {mismatches[0]})" if mismatches else ""))
+    return opens[0] == 1 and not mismatches
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MiB (None where unsupported)."""
+    # On Linux ru_maxrss survives fork() + exec(), so it would report the parent's
+    # peak when that is higher; the high-water mark of the address space does not
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def measure(template_name, template_path, count, temp_files, optimize=False):
+    """Run one case in a fresh interpreter and return its result dictionary."""
+    command = [sys.executable, os.path.abspath(__file__), "--run-case", template_path, str(count)]
+    if temp_files:
+        command.append("--temp-files")
+    if optimize:
+        command.append("--optimize")
+    output = subprocess.run(command, cwd=HERE, capture_output=True, text=True, check=True).stdout
+    result = json.loads(output)
+    result["template"] = template_name
+    return result
+
+
+def case_key(result):
+    return result["template"], result["names"]
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results against a baseline run.
+
+    Per-certificate stage times, output bytes per certificate and peak RSS are
+    compared for the cases present in both runs. Stage times must also grow by
+    more than NOISE_FLOOR_MS to count.
+
+    Returns:
+        List of regression messages (empty when nothing regressed)
+    """
+    previous = {case_key(result): result for result in baseline["cases"]}
+    regressions = []
+
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+
+        label = "{} x {}".format(*case_key(result))
+        count = result["names"]
+        metrics = [(f"{stage} ms/certificate", old["stages"][stage] * 1000 / count,
+                    result["stages"][stage] * 1000 / count, NOISE_FLOOR_MS) for stage in STAGES]
+        metrics.append(("bytes/certificate", old["bytes_per_certificate"], result["bytes_per_certificate"], 0))
+        if old.get("peak_rss_mb") and result.get("peak_rss_mb"):
+            metrics.append(("peak RSS MiB", old["peak_rss_mb"], result["peak_rss_mb"], 0))
+
+        for metric, before, after, floor in metrics:
+            if before > 0 and after > before * (1 + tolerance) and after - before > floor:
+                regressions.append(f"{label}: {metric} {before:.3f} -> {after:.3f} (+{(after / before - 1):.0%})")
+
+    return regressions
+
+
+def environment():
+    """Return the versions that affect the results."""
+    import PyPDF2
+    import reportlab
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "PyPDF2": PyPDF2.__version__,
+        "reportlab": reportlab.Version,
+    }
+
+
+def print_result(result):
+    count = result["names"]
+    stages = "  ".join(f"{stage} {result['stages'][stage] * 1000 / count:7.3f}" for stage in STAGES)
+    rss = f"{result['peak_rss_mb']:.1f} MiB" if result["peak_rss_mb"] is not None else "n/a"
+    print(f"{result['template']:>6} x {count:<6} {result['certificates_per_second']:8.1f} cert/s  "
+          f"ms/cert: {stages}  {result['bytes_per_certificate']:9.0f} B/cert  peak RSS {rss}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the certificate pipeline")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated numbers of names (default: 10,1000,10000)")
+    parser.add_argument("--templates", default="temp,heavy", help="Templates to run: temp, heavy (default: both)")
+    parser.add_argument("--temp-files", action="store_true", help="Render overlays to temporary files")
+    parser.add_argument("--optimize", action="store_true", help="Optimize the output size")
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Tolerated relative regression (default: 0.2)")
+    parser.add_argument("--memory", nargs="?", type=int, const=MEMORY_NAMES, metavar="NAMES",
+                        help="Check that memory stays flat over a streamed batch (default: 1000000 names)")
+    parser.add_argument("--workers", type=int, help="Worker processes for the memory check")
+    parser.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE_MB,
+                        help="Tolerated resident memory growth in MiB (default: 8)")
+    parser.add_argument("--template-reuse", nargs="?", type=int, const=TEMPLATE_REUSE_NAMES, metavar="NAMES",
+                        help="Check that a batch opens the template once and writes the same bytes as parsing it "
+                             "per certificate (default: 5000 names)")
+    parser.add_argument("--run-case", nargs=2, metavar=("TEMPLATE", "NAMES"), help=argparse.SUPPRESS)
+    parser.add_argument("--run-memory", nargs=2, metavar=("TEMPLATE", "NAMES"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        json.dump(run_case(args.run_case[0], int(args.run_case[1]), args.temp_files, args.optimize), sys.stdout)
+        return 0
+    if args.run_memory:
+        json.dump(run_memory_case(args.run_memory[0], int(args.run_memory[1]), args.workers), sys.stdout)
+        return 0
+    if args.memory:
+        template = os.path.join(HERE, "templates", "temp.pdf")
+        return 0 if check_memory(template, args.memory, args.workers, args.memory_tolerance) else 1
+    if args.template_reuse:
+        template = os.path.join(HERE, "templates", "temp.pdf")
+        return 0 if check_template_reuse(template, args.template_reuse) else 1
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    work_dir = tempfile.mkdtemp(prefix="signit-bench-")
+    try:
+        templates = {"temp": os.path.join(HERE, "templates", "temp.pdf")}
+        if "heavy" in args.templates.split(","):
+            templates["heavy"] = os.path.join(work_dir, "heavy.pdf")
+            build_heavy_template(templates["heavy"])
+
+        results = []
+        for template_name in args.templates.split(","):
+            for count in sizes:
+                result = measure(template_name, templates[template_name], count, args.temp_files, args.optimize)
+                print_result(result)
+                results.append(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    run = {"environment": environment(), "temp_files": args.temp_files, "optimize": args.optimize, "cases": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,13 @@
-import os
+import argparse
 import subprocess
 
-def build():
+def build(onedir=False):
     # Define o comando para criar o executável
     command = [
         "pyinstaller",
-        "--onefile",
+        # A one-file build unpacks itself to a temporary folder on every launch;
+        # the one-folder build starts straight from dist/signit/
+        "--onedir" if onedir else "--onefile",
         "--noconsole",
         "--name=signit",
         "main.py"
@@ -13,4 +15,7 @@ def build():
     subprocess.run(command, check=True)
 
 if __name__ == "__main__":
-    build()
+    parser = argparse.ArgumentParser(description="Build the signit executable with PyInstaller")
+    parser.add_argument("--onedir", action="store_true",
+                        help="Build an unpacked folder (dist/signit/) that starts faster than the single file")
+    build(parser.parse_args().onedir)
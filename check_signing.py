@@ -0,0 +1,360 @@
+# check_signing.py
+#
+# Checks the PDF signatures written with --sign. A throwaway RSA key (as a
+# PKCS#12 file) and a throwaway EC key (as a PEM key with a separate
+# certificate) are generated with the cryptography package, and a small
+# batch is signed with each in every output mode: one file per certificate,
+# worker processes, a combined PDF and a ZIP archive. For every signed PDF:
+#
+# - /ByteRange must cover the whole file except the /Contents hex string;
+# - the CMS SignedData in /Contents is decoded here (independently of the DER
+#   encoder in modules/signing.py), its messageDigest must be the SHA-256 of
+#   the byte ranges, and its signature must verify against the signed
+#   attributes with the certificate's public key;
+# - `openssl cms -verify` must accept it too, when openssl is installed.
+#
+# SHA256SUMS is checked with verify_checksums, and a modified copy of a
+# certificate must be rejected. The exit code is 1 on any failure.
+#
+#   python check_signing.py [--names N] [--keep DIR]
+
+import argparse
+import hashlib
+import importlib.util
+import io
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Certificates signed per output mode
+DEFAULT_NAMES = 5
+
+# Password of the throwaway PKCS#12 file
+KEY_PASSWORD = "check-signing"
+
+FONT_SETTINGS = {"family": "Times-Roman", "size": 24, "color": "#000000"}
+POSITION = (300, 400)
+
+OID_MESSAGE_DIGEST = "1.2.840.113549.1.9.4"
+
+
+def create_keys(directory):
+    """
+    Write a self-signed RSA certificate as a PKCS#12 file and a self-signed EC one as PEM files.
+
+    Returns:
+        List of (label, key path, password, certificate path or None, certificate PEM path)
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    from cryptography.hazmat.primitives.serialization import pkcs12
+    from cryptography.x509.oid import NameOID
+
+    def self_signed(key, common_name):
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+        now = datetime.now(timezone.utc)
+        return (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=1))
+                .sign(key, hashes.SHA256()))
+
+    keys = []
+
+    rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    rsa_certificate = self_signed(rsa_key, "signit check (RSA)")
+    rsa_path = os.path.join(directory, "rsa.p12")
+    with open(rsa_path, "wb") as f:
+        f.write(pkcs12.serialize_key_and_certificates(
+            b"signit", rsa_key, rsa_certificate, None,
+            serialization.BestAvailableEncryption(KEY_PASSWORD.encode())))
+    keys.append(("RSA", rsa_path, KEY_PASSWORD, None, _write_pem(directory, "rsa-cert.pem", rsa_certificate)))
+
+    ec_key = ec.generate_private_key(ec.SECP256R1())
+    ec_certificate = self_signed(ec_key, "signit check (EC)")
+    ec_path = os.path.join(directory, "ec-key.pem")
+    with open(ec_path, "wb") as f:
+        f.write(ec_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption()))
+    ec_certificate_path = _write_pem(directory, "ec-cert.pem", ec_certificate)
+    keys.append(("EC", ec_path, None, ec_certificate_path, ec_certificate_path))
+
+    return keys
+
+
+def _write_pem(directory, filename, certificate):
+    from cryptography.hazmat.primitives import serialization
+
+    path = os.path.join(directory, filename)
+    with open(path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    return path
+
+
+def read_der(data, position=0):
+    """
+    Decode the DER element starting at position.
+
+    Returns:
+        Tuple (tag, content bytes, position after the element)
+    """
+    tag = data[position]
+    length = data[position + 1]
+    position += 2
+    if length & 0x80:
+        size = length & 0x7F
+        length = int.from_bytes(data[position:position + size], "big")
+        position += size
+    return tag, data[position:position + length], position + length
+
+
+def der_children(content):
+    """Return the (tag, content) elements of a constructed DER element's content."""
+    children = []
+    position = 0
+    while position < len(content):
+        tag, child, position = read_der(content, position)
+        children.append((tag, child))
+    return children
+
+
+def decode_oid(content):
+    """Return the dotted form of an OBJECT IDENTIFIER's content."""
+    arcs = [content[0] // 40, content[0] % 40]
+    value = 0
+    for byte in content[1:]:
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(value)
+            value = 0
+    return ".".join(map(str, arcs))
+
+
+def check_pdf(data, certificate_pem, cms_path=None):
+    """
+    Check the signature of a signed PDF.
+
+    Args:
+        data: Bytes of the PDF
+        certificate_pem: Path of the signing certificate (PEM)
+        cms_path: Where to save the CMS for openssl (default: openssl is not run)
+
+    Returns:
+        List of problems (empty when the signature is valid)
+    """
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+    from PyPDF2 import PdfReader
+
+    byte_ranges = re.findall(rb"/ByteRange \[\s*(\d+) (\d+) (\d+) (\d+)\s*\]", data)
+    if len(byte_ranges) != 1:
+        return [f"{len(byte_ranges)} /ByteRange entries instead of 1"]
+    start1, length1, start2, length2 = map(int, byte_ranges[0])
+
+    problems = []
+    if start1 != 0 or start2 + length2 != len(data):
+        problems.append(f"/ByteRange {start1} {length1} {start2} {length2} does not reach both ends of "
+                        f"the {len(data)}-byte file")
+    gap = data[length1:start2]
+    if not re.fullmatch(rb"<[0-9a-fA-F]*>", gap):
+        problems.append("the bytes left out of /ByteRange are not exactly the /Contents hex string")
+    if b"/Contents " + gap not in data:
+        problems.append("the bytes left out of /ByteRange are not the value of /Contents")
+    if problems:
+        return problems
+
+    try:
+        PdfReader(io.BytesIO(data)).pages[0]
+    except Exception as e:
+        problems.append(f"PyPDF2 cannot read the signed file: {e}")
+
+    contents = bytes.fromhex(gap[1:-1].decode("ascii"))
+    _, content_info, end = read_der(contents)
+    if contents[end:].strip(b"\0"):
+        problems.append("/Contents has data after the CMS structure")
+    signed_data = der_children(der_children(content_info)[1][1])[0][1]
+    elements = der_children(signed_data)
+    certificates = next(child for tag, child in elements if tag == 0xA0)
+    signer_info = der_children(elements[-1][1])[0][1]
+    signed_attributes = next(child for tag, child in der_children(signer_info) if tag == 0xA0)
+    signature = der_children(signer_info)[-1][1]
+
+    signed = hashlib.sha256(data[start1:start1 + length1] + data[start2:start2 + length2]).digest()
+    digests = [der_children(values)[0][1]
+               for (_, oid), (_, values) in (der_children(attribute) for _, attribute in der_children(signed_attributes))
+               if decode_oid(oid) == OID_MESSAGE_DIGEST]
+    if digests != [signed]:
+        problems.append("the messageDigest attribute is not the SHA-256 of the /ByteRange bytes")
+
+    with open(certificate_pem, "rb") as f:
+        expected = x509.load_pem_x509_certificate(f.read())
+    certificate = x509.load_der_x509_certificate(certificates[:read_der(certificates)[2]])
+    if certificate != expected:
+        problems.append("the CMS does not carry the signing certificate first")
+
+    # The signature covers the attributes encoded as a SET OF
+    attributes = b"\x31" + der_length(signed_attributes) + signed_attributes
+    public_key = certificate.public_key()
+    try:
+        if isinstance(public_key, rsa.RSAPublicKey):
+            public_key.verify(signature, attributes, padding.PKCS1v15(), hashes.SHA256())
+        elif isinstance(public_key, ec.EllipticCurvePublicKey):
+            public_key.verify(signature, attributes, ec.ECDSA(hashes.SHA256()))
+        else:
+            problems.append(f"unexpected key type {type(public_key).__name__}")
+    except InvalidSignature:
+        problems.append("the signature does not verify against the signed attributes")
+
+    if cms_path is not None:
+        problems += openssl_verify(contents[:end], data[start1:start1 + length1] + data[start2:start2 + length2],
+                                   certificate_pem, cms_path)
+    return problems
+
+
+def der_length(content):
+    """Return the DER length bytes of an element with the given content."""
+    length = len(content)
+    if length < 0x80:
+        return bytes((length,))
+    size = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes((0x80 | len(size),)) + size
+
+
+def openssl_verify(cms, signed, certificate_pem, cms_path):
+    """Return the problems `openssl cms -verify` reports for a detached CMS (none when it accepts it)."""
+    content_path = cms_path + ".content"
+    with open(cms_path, "wb") as f:
+        f.write(cms)
+    with open(content_path, "wb") as f:
+        f.write(signed)
+    result = subprocess.run(["openssl", "cms", "-verify", "-binary", "-inform", "DER", "-in", cms_path,
+                             "-content", content_path, "-CAfile", certificate_pem, "-purpose", "any",
+                             "-out", os.devnull], capture_output=True, text=True)
+    if result.returncode != 0:
+        return [f"openssl cms -verify failed: {result.stderr.strip().splitlines()[0]}"]
+    return []
+
+
+def signed_outputs(mode, output_dir):
+    """
+    Return the signed PDFs of a batch and the path of its SHA256SUMS file.
+
+    Returns:
+        Tuple (list of (file name, bytes), checksum file path)
+    """
+    from modules.processor import ARCHIVE_FILENAME, COMBINED_FILENAME
+    from modules.signing import CHECKSUMS_FILENAME
+
+    checksums = os.path.join(output_dir, CHECKSUMS_FILENAME)
+    if mode == "combined":
+        with open(os.path.join(output_dir, COMBINED_FILENAME), "rb") as f:
+            return [(COMBINED_FILENAME, f.read())], checksums
+    if mode == "archive":
+        # The archive's checksum file lists its members; check it against an extracted copy
+        extracted = os.path.join(output_dir, "extracted")
+        with zipfile.ZipFile(os.path.join(output_dir, ARCHIVE_FILENAME)) as archive:
+            archive.extractall(extracted)
+        output_dir = extracted
+        checksums = os.path.join(extracted, CHECKSUMS_FILENAME)
+
+    pdfs = []
+    for filename in sorted(os.listdir(output_dir)):
+        if filename.endswith(".pdf"):
+            with open(os.path.join(output_dir, filename), "rb") as f:
+                pdfs.append((filename, f.read()))
+    return pdfs, checksums
+
+
+def check_mode(label, signer, certificate_pem, mode, names, work_dir, use_openssl):
+    """
+    Sign a batch in one output mode and check every signed file and the checksum file.
+
+    Returns:
+        List of problems
+    """
+    from modules.processor import generate_certificates
+    from modules.signing import CHECKSUMS_FILENAME, verify_checksums
+
+    output_dir = os.path.join(work_dir, f"{label}-{mode}")
+    os.makedirs(output_dir)
+    options = {"serial": {}, "parallel": {"workers": 2}, "combined": {"combined": True},
+               "archive": {"archive": "stored"}}[mode]
+    generate_certificates(os.path.join(HERE, "templates", "temp.pdf"), names, FONT_SETTINGS, POSITION, output_dir,
+                          signer=signer, **options)
+
+    pdfs, checksums = signed_outputs(mode, output_dir)
+    problems = []
+    expected = 1 if mode == "combined" else len(names)
+    if len(pdfs) != expected:
+        problems.append(f"{len(pdfs)} signed PDFs instead of {expected}")
+    for filename, data in pdfs:
+        cms_path = os.path.join(work_dir, f"{label}-{mode}.p7s") if use_openssl else None
+        problems += [f"{filename}: {problem}" for problem in check_pdf(data, certificate_pem, cms_path)]
+
+    if not os.path.exists(checksums):
+        problems.append(f"no {CHECKSUMS_FILENAME} file")
+    problems += [f"{CHECKSUMS_FILENAME}: {filename} {problem}" for filename, problem in verify_checksums(checksums)]
+
+    # A modified copy must fail both checks
+    filename, data = pdfs[0]
+    position = len(data) // 3
+    tampered = data[:position] + bytes((data[position] ^ 0x01,)) + data[position + 1:]
+    if not check_pdf(tampered, certificate_pem):
+        problems.append(f"{filename}: a modified copy still verifies")
+    path = os.path.join(os.path.dirname(checksums), filename)
+    with open(path, "wb") as f:
+        f.write(tampered)
+    if (filename, "changed") not in verify_checksums(checksums):
+        problems.append(f"{filename}: verify_checksums does not report a modified copy")
+
+    print(f"{label:>3} {mode:<8} {len(pdfs)} signed PDF(s): " + ("ok" if not problems else "FAILED"))
+    for problem in problems:
+        print(f"    {problem}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the PDF signatures written with --sign")
+    parser.add_argument("--names", type=int, default=DEFAULT_NAMES,
+                        help=f"Certificates signed per output mode (default: {DEFAULT_NAMES})")
+    parser.add_argument("--keep", metavar="DIR", help="Keep the keys and signed outputs in this folder")
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("cryptography") is None:
+        print("Signing needs the 'cryptography' package (pip install cryptography)", file=sys.stderr)
+        return 2
+
+    from modules.signing import load_signer
+
+    use_openssl = shutil.which("openssl") is not None
+    if not use_openssl:
+        print("openssl not found: CMS structures are checked without `openssl cms -verify`")
+
+    names = [f"Signed Name {i}" for i in range(args.names - 1)] + ["José Müller"]
+    work_dir = args.keep or tempfile.mkdtemp(prefix="signit-signing-")
+    os.makedirs(work_dir, exist_ok=True)
+    failures = 0
+    try:
+        for label, key_path, password, certificate_path, certificate_pem in create_keys(work_dir):
+            signer = load_signer(key_path, password, certificate_path)
+            for mode in ("serial", "parallel", "combined", "archive"):
+                failures += bool(check_mode(label, signer, certificate_pem, mode, names, work_dir, use_openssl))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("All signatures verified" if not failures else f"{failures} mode(s) failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
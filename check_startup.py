@@ -0,0 +1,173 @@
+# check_startup.py
+#
+# Measures the start-up of the headless command line and of the GUI, and
+# fails (exit code 1) when the command line imports a GUI library, the GUI
+# imports a heavy library before its window appears, or either exceeds its
+# time budget.
+#
+#   python check_startup.py [--budget SECONDS] [--gui-budget SECONDS] [--runs N] [--report JSON]
+#
+# Time-to-first-window needs a display; without one, only the GUI's imports
+# are measured.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from main import STARTUP_PROBE_VARIABLE
+from modules.cli import GUI_MODULES
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Wall-clock budget for a one-certificate run, interpreter start-up included
+DEFAULT_BUDGET = 1.0
+
+# Wall-clock budget from launching the GUI to its first drawn window
+DEFAULT_GUI_BUDGET = 0.5
+
+# Heavy modules the GUI only imports on the first preview or generation
+GUI_LAZY_MODULES = ("fitz", "pymupdf", "PIL", "reportlab", "PyPDF2", "chardet")
+
+# Number of slowest imports listed for the GUI
+SLOWEST_IMPORTS = 5
+
+
+def import_times(importtime_output):
+    """
+    Return the imports listed by `python -X importtime`.
+
+    Returns:
+        Dictionary {module name: cumulative import time in seconds}
+    """
+    times = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if name and name != "imported package":
+            times[name] = int(cumulative) / 1e6
+    return times
+
+
+def imported_modules(importtime_output):
+    """Return the top-level module names listed by `python -X importtime`."""
+    return {name.split(".")[0] for name in import_times(importtime_output)}
+
+
+def measure_cli(runs):
+    """
+    Run a one-certificate CLI job several times.
+
+    Returns:
+        Tuple (best wall time in seconds, set of imported top-level modules)
+    """
+    with tempfile.TemporaryDirectory(prefix="signit-startup-") as output_dir:
+        csv_path = os.path.join(output_dir, "names.csv")
+        with open(csv_path, "w", encoding="utf-8") as f:
+            f.write("Jane Doe\n")
+
+        command = [sys.executable, "-X", "importtime", os.path.join(HERE, "main.py"), "generate",
+                   os.path.join(HERE, "templates", "temp.pdf"), csv_path, "-o", output_dir]
+
+        best = None
+        modules = set()
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = subprocess.run(command, cwd=HERE, capture_output=True, text=True, check=True)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            modules |= imported_modules(result.stderr)
+
+    return best, modules
+
+
+def measure_gui(runs):
+    """
+    Launch the GUI several times until its first window is drawn (see main.py).
+
+    Without a display, the GUI module is imported instead of launched.
+
+    Returns:
+        Tuple (best time to the first window in seconds, or None without a display,
+        {module: cumulative import time in seconds} of the best run)
+    """
+    env = dict(os.environ, **{STARTUP_PROBE_VARIABLE: "1"})
+    launch = [sys.executable, "-X", "importtime", os.path.join(HERE, "main.py")]
+    import_only = [sys.executable, "-X", "importtime", "-c", "import tkinter, modules.gui"]
+
+    best = None
+    best_imports = {}
+    for _ in range(runs):
+        start = time.time()
+        result = subprocess.run(launch, cwd=HERE, env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            if "display" not in result.stderr:
+                raise RuntimeError(f"The GUI failed to start:\n{result.stderr[-2000:]}")
+            # No display: Tk cannot open a window
+            result = subprocess.run(import_only, cwd=HERE, capture_output=True, text=True, check=True)
+            imports = import_times(result.stderr)
+            if not best_imports or imports["modules.gui"] < best_imports["modules.gui"]:
+                best_imports = imports
+            continue
+
+        elapsed = float(result.stdout.split()[-1]) - start
+        if best is None or elapsed < best:
+            best, best_imports = elapsed, import_times(result.stderr)
+
+    return best, best_imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the start-up budgets of the command line and the GUI")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="Command line budget in seconds")
+    parser.add_argument("--gui-budget", type=float, default=DEFAULT_GUI_BUDGET,
+                        help="Time-to-first-window budget in seconds")
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs (the best one counts)")
+    parser.add_argument("--report", metavar="JSON", help="Save the measurements and the GUI's import times")
+    args = parser.parse_args()
+
+    elapsed, modules = measure_cli(args.runs)
+    gui_imports = sorted(modules.intersection(GUI_MODULES))
+
+    print(f"CLI one-certificate run: {elapsed:.3f}s (budget {args.budget:.3f}s)")
+    print(f"Top-level modules imported: {len(modules)}")
+
+    failed = False
+    if gui_imports:
+        print(f"FAIL: the command line imported GUI modules: {', '.join(gui_imports)}")
+        failed = True
+    if elapsed > args.budget:
+        print("FAIL: over budget")
+        failed = True
+
+    first_window, imports = measure_gui(args.runs)
+    if first_window is None:
+        print("GUI time-to-first-window: not measured (no display)")
+    else:
+        print(f"GUI time-to-first-window: {first_window:.3f}s (budget {args.gui_budget:.3f}s)")
+    print(f"GUI imports before the window: {imports.get('modules.gui', 0.0) * 1000:.1f} ms for modules.gui")
+    slowest = sorted(imports.items(), key=lambda item: item[1], reverse=True)[:SLOWEST_IMPORTS]
+    print("  slowest: " + ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in slowest))
+
+    eager = sorted({name.split(".")[0] for name in imports}.intersection(GUI_LAZY_MODULES))
+    if eager:
+        print(f"FAIL: the GUI imported heavy modules before its first window: {', '.join(eager)}")
+        failed = True
+    if first_window is not None and first_window > args.gui_budget:
+        print("FAIL: GUI over budget")
+        failed = True
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"cli_run": elapsed, "gui_first_window": first_window, "gui_imports": imports}, f, indent=2)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
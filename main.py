@@ -1,12 +1,29 @@
 # main.py
 
-import tkinter as tk
-from modules.gui import CertificateSignerGUI
+import os
+import sys
+import time
+
+# Set by check_startup.py: print when the first window is drawn, then exit
+STARTUP_PROBE_VARIABLE = "SIGNIT_STARTUP_PROBE"
 
 
 def main():
+    # Any argument selects the headless command line, which never imports Tk
+    if len(sys.argv) > 1:
+        from modules.cli import main as cli_main
+        sys.exit(cli_main(sys.argv[1:]))
+
+    import tkinter as tk
+    from modules.gui import CertificateSignerGUI
+
     root = tk.Tk()
     app = CertificateSignerGUI(root)
+    if os.environ.get(STARTUP_PROBE_VARIABLE):
+        root.update()  # maps and draws the window
+        print(f"first-window {time.time():.6f}", flush=True)
+        root.destroy()
+        return
     root.mainloop()
 
 
@@ -0,0 +1,102 @@
+# archive.py
+
+import hashlib
+import os
+import time
+import uuid
+import zipfile
+
+from modules.signing import CHECKSUMS_FILENAME, checksum_line
+
+# Compression methods accepted by ArchiveWriter
+COMPRESSION = {"stored": zipfile.ZIP_STORED, "deflated": zipfile.ZIP_DEFLATED}
+
+
+class ArchiveWriter:
+    """
+    Write certificates straight into a ZIP archive.
+
+    Each certificate is added as soon as it is rendered, so nothing but the
+    archive touches the output folder and memory holds one certificate at a
+    time. The archive is written under a temporary name and moved into place
+    by close(), which also runs when a batch is cancelled or fails, so the
+    archive always holds the certificates written so far. With checksums,
+    a SHA256SUMS file listing every certificate is added last.
+
+    File names are kept unique (e.g. for two attendees with the same name):
+    a name already in the archive gets a numbered suffix, compared without
+    case since most extractors write to case-insensitive file systems.
+
+    Use it as a context manager, or call close() to finish the archive.
+    """
+
+    def __init__(self, output_path, compression="deflated", checksums=False):
+        """
+        Args:
+            output_path: Path where to save the archive
+            compression: "stored" (no compression, fastest) or "deflated"
+            checksums: Add a checksum file of the certificates (see signing.ChecksumFile)
+        """
+        if compression not in COMPRESSION:
+            raise ValueError(f"Unknown compression: {compression}")
+
+        self.output_path = output_path
+        self.count = 0
+        directory, filename = os.path.split(os.path.abspath(output_path))
+        self._temp_path = os.path.join(directory, f".tmp-{uuid.uuid4().hex}-{filename}")
+        # PDFs are already compressed inside, level 1 keeps deflate cheap
+        self._zip = zipfile.ZipFile(self._temp_path, "x", COMPRESSION[compression], compresslevel=1)
+        self._date_time = time.localtime()[:6]
+        self._checksums = {} if checksums else None  # file name -> SHA-256 hex digest
+        self._names = {CHECKSUMS_FILENAME.casefold()} if checksums else set()  # casefolded names written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, filename, data):
+        """
+        Add a file to the archive.
+
+        Args:
+            filename: Name of the file inside the archive
+            data: Bytes of the file
+
+        Returns:
+            Name the file was added under: filename, or filename with a
+            suffix (_2, _3, ...) before its extension if it was already used
+        """
+        filename = self._unique_name(filename)
+        info = zipfile.ZipInfo(filename, self._date_time)
+        info.compress_type = self._zip.compression
+        info.external_attr = 0o644 << 16
+        self._zip.writestr(info, data, compresslevel=self._zip.compresslevel)
+        self.count += 1
+        if self._checksums is not None:
+            self._checksums[filename] = hashlib.sha256(data).hexdigest()
+        return filename
+
+    def _unique_name(self, filename):
+        """Return filename, or the first free numbered variant of it, and mark it as used."""
+        stem, extension = os.path.splitext(filename)
+        number = 1
+        while filename.casefold() in self._names:
+            number += 1
+            filename = f"{stem}_{number}{extension}"
+        self._names.add(filename.casefold())
+        return filename
+
+    def close(self):
+        """Write the central directory and move the archive into place."""
+        if self._zip.fp is None:
+            return
+
+        if self._checksums is not None:
+            info = zipfile.ZipInfo(CHECKSUMS_FILENAME, self._date_time)
+            info.external_attr = 0o644 << 16
+            self._zip.writestr(info, "".join(checksum_line(digest, filename)
+                                             for filename, digest in self._checksums.items()))
+        self._zip.close()
+        os.replace(self._temp_path, self.output_path)
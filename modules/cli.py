@@ -0,0 +1,273 @@
+# cli.py
+#
+# Headless entry point. Only the processing modules are imported here (never
+# tkinter, PyMuPDF or PIL), and they are imported after the arguments are
+# parsed, so `--help` and argument errors return immediately.
+
+import argparse
+import os
+import sys
+import time
+
+# Modules that must never be imported by the command line (see check_startup.py).
+# PIL is not listed: ReportLab imports it on its own when it is installed.
+GUI_MODULES = ("tkinter", "fitz")
+
+# Environment variable with the password of an encrypted signing key (kept off the command line)
+KEY_PASSWORD_VARIABLE = "SIGNIT_KEY_PASSWORD"
+
+
+def build_parser():
+    """Return the argument parser for the command line."""
+    parser = argparse.ArgumentParser(prog="signit", description="SIGNIT - Digital Certificate Signer")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate = subparsers.add_parser("generate", help="Generate certificates without the GUI")
+    generate.add_argument("template", help="Template PDF")
+    generate.add_argument("csv", help="CSV file with the names")
+    generate.add_argument("-o", "--output-dir", required=True, help="Output folder")
+    generate.add_argument("--font", default="Times-Roman", help="Font family, or a .ttf/.otf font file (default: Times-Roman)")
+    generate.add_argument("--size", type=int, default=24, help="Font size in points (default: 24)")
+    generate.add_argument("--bold", action="store_true", help="Use the bold variant of the font")
+    generate.add_argument("--italic", action="store_true", help="Use the italic variant of the font")
+    generate.add_argument("--max-width", type=float,
+                          help="Shrink names wider than this many points to fit (default: off)")
+    generate.add_argument("--min-size", type=float, default=8,
+                          help="Smallest font size used when fitting names (default: 8)")
+    generate.add_argument("--color", default="#000000", help="Text color as #RRGGBB (default: #000000)")
+    generate.add_argument("-x", type=float, default=300, help="X position of the text center in points")
+    generate.add_argument("-y", type=float, default=400, help="Y position of the text center in points")
+    generate.add_argument("--name-format", default="{name}", help="Name format (default: {name})")
+    generate.add_argument("--column", default="0", help="CSV column index, or header name with --header")
+    generate.add_argument("--header", action="store_true", help="The first CSV row is a header")
+    generate.add_argument("--layout", metavar="JSON",
+                          help="Layout file drawing several CSV columns (see modules/layout.py); "
+                               "replaces the font, position, name format and column options")
+    generate.add_argument("--engine", choices=["reportlab", "direct"], default="reportlab",
+                          help="Rendering engine (default: reportlab)")
+    generate.add_argument("--workers", type=int, help="Number of worker processes")
+    generate.add_argument("--chunk-size", type=int, default=16, help="Names per worker task (default: 16)")
+    generate.add_argument("--combined", action="store_true", help="Write a single multi-page PDF")
+    generate.add_argument("--zip", nargs="?", const="deflated", choices=["stored", "deflated"],
+                          help="Write the certificates into certificates.zip (default compression: deflated)")
+    generate.add_argument("--incremental", action="store_true",
+                          help="Only regenerate certificates that are missing or out of date (uses a manifest)")
+    generate.add_argument("--optimize", action="store_true",
+                          help="Write smaller files (compressed streams, deduplicated template objects)")
+    generate.add_argument("--stats", nargs="?", const="", metavar="JSON",
+                          help="Print a run summary (latency percentiles, stages, slowest names), "
+                               "and save it as JSON when a file is given")
+    generate.add_argument("--profile", metavar="FILE", help="Save a cProfile dump of the run")
+    generate.add_argument("--dry-run", nargs="?", const="", metavar="JSON",
+                          help="Only check every row for text that overflows or has characters the font cannot "
+                               "draw, without writing any PDF, and save the report as JSON when a file is given")
+    add_signing_arguments(generate)
+
+    serve = subparsers.add_parser("serve", help="Run a local job server that keeps templates and fonts loaded "
+                                                "(see modules/server.py)")
+    serve.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765)")
+    serve.add_argument("--engine", choices=["reportlab", "direct"], default="direct",
+                       help="Default rendering engine of the jobs (default: direct)")
+    serve.add_argument("--templates", type=int, default=8, help="Compiled templates kept in memory (default: 8)")
+    serve.add_argument("--fonts", type=int, default=16, help="Font files kept loaded (default: 16)")
+    serve.add_argument("--preload", action="append", default=[], metavar="TEMPLATE",
+                       help="Compile a template before the first job (repeatable)")
+    serve.add_argument("--root", action="append", metavar="DIR",
+                       help="Folder the templates, layouts, fonts and output folders of the jobs must be in; "
+                            "repeat for several (default: the current folder)")
+    serve.add_argument("--quiet", action="store_true", help="Do not log the requests")
+    add_signing_arguments(serve)
+
+    verify = subparsers.add_parser("verify", help="Check certificates against their SHA256SUMS file")
+    verify.add_argument("checksums", help="SHA256SUMS file written by generate --sign")
+
+    return parser
+
+
+def add_signing_arguments(parser):
+    """Add the --sign and --sign-cert options to a subcommand."""
+    parser.add_argument("--sign", metavar="KEY",
+                        help="Digitally sign the certificates with a PKCS#12 (.p12/.pfx) or PEM key, and write "
+                             f"SHA256SUMS (needs the cryptography package; password in ${KEY_PASSWORD_VARIABLE})")
+    parser.add_argument("--sign-cert", metavar="CERT",
+                        help="PEM/DER certificate (then its chain) of a PEM key given to --sign")
+
+
+def load_signer_from_args(args):
+    """
+    Return the signer selected by --sign, or None.
+
+    Raises:
+        ImportError: If the cryptography package is not installed
+        ValueError: If the key cannot be used
+    """
+    if not args.sign:
+        return None
+    from modules.signing import load_signer
+
+    signer = load_signer(args.sign, os.environ.get(KEY_PASSWORD_VARIABLE), args.sign_cert)
+    print(f"Signing as {signer.subject}")
+    return signer
+
+
+def run_generate(args):
+    """Run the generate subcommand and print throughput and elapsed time."""
+    from modules.instrumentation import RunStats
+    from modules.layout import load_layout
+    from modules.processor import (ARCHIVE_FILENAME, COMBINED_FILENAME, compare_output_size, generate_certificates,
+                                   iter_certificates)
+    from modules.utils import ensure_dir, iter_names_from_csv, iter_rows_from_csv, read_csv_header, resolve_font_name
+
+    column = int(args.column) if args.column.isdigit() else args.column
+    font_settings = {
+        "family": resolve_font_name(args.font, args.bold, args.italic),
+        "size": args.size,
+        "bold": args.bold,
+        "italic": args.italic,
+        "color": args.color,
+        "max_width": args.max_width,
+        "min_size": args.min_size,
+    }
+    layout = None
+    if args.layout:
+        # Parsed once; header names are resolved to column indices up front
+        layout = load_layout(args.layout).bind(read_csv_header(args.csv) if args.header else [])
+    try:
+        # The key is loaded once here; worker processes load it once each
+        signer = load_signer_from_args(args)
+    except (ImportError, ValueError) as e:
+        print(f"Cannot sign: {e}", file=sys.stderr)
+        return 2
+    read = [0]
+    sample = []
+
+    def names():
+        if layout is not None:
+            # Rows without a name are skipped, as in the single name mode
+            rows = (row for row in iter_rows_from_csv(args.csv, args.header) if layout.has_name(row))
+        else:
+            rows = (args.name_format.format(name=name) for name in iter_names_from_csv(args.csv, column, args.header))
+        for row in rows:
+            read[0] += 1
+            if not sample:
+                sample.append(row)
+            yield row
+
+    if args.dry_run is not None:
+        report = generate_certificates(args.template, names(), font_settings, (args.x, args.y), args.output_dir,
+                                       layout=layout, dry_run=True)
+        print(report.format())
+        if args.dry_run:
+            report.to_json(args.dry_run)
+        return 0 if report.ok else 1
+
+    ensure_dir(args.output_dir)
+
+    stats = None
+    if args.stats is not None or args.profile:
+        stats = RunStats(profile=bool(args.profile))
+
+    start = time.perf_counter()
+    # Results are streamed, so memory does not grow with the number of rows
+    failures = 0
+    results = iter_certificates(args.template, names(), font_settings, (args.x, args.y), args.output_dir,
+                                workers=args.workers, chunk_size=args.chunk_size, engine=args.engine,
+                                combined=args.combined, incremental=args.incremental, instrumentation=stats,
+                                optimize=args.optimize, archive=args.zip, layout=layout, signer=signer)
+    for index, name, _, error in results:
+        if error is not None:
+            failures += 1
+            print(f"Failed: row {index} ({name}): {error}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    count = read[0] - failures
+    rate = count / elapsed if elapsed > 0 else 0.0
+    target = args.output_dir
+    if args.combined:
+        target = os.path.join(args.output_dir, COMBINED_FILENAME)
+    elif args.zip:
+        target = os.path.join(args.output_dir, ARCHIVE_FILENAME)
+    print(f"Generated {count} certificates in {target} in {elapsed:.2f}s ({rate:.1f} certificates/s)")
+
+    if args.optimize and sample and not args.combined:
+        # Sizes of the first certificate, rendered both ways in memory
+        before, after = compare_output_size(args.template, sample[0], font_settings, (args.x, args.y), layout)
+        print(f"Optimized output: {before / 1024:.1f} KiB -> {after / 1024:.1f} KiB per certificate "
+              f"({(after - before) / before:+.1%})")
+
+    if args.stats is not None:
+        summary = stats.summary()
+        print(summary.format())
+        if args.stats:
+            summary.to_json(args.stats)
+    if args.profile:
+        stats.dump_profile(args.profile)
+
+    return 1 if failures else 0
+
+
+def run_serve(args):
+    """Run the serve subcommand until it is interrupted."""
+    from modules.server import CertificateServer, CertificateService
+
+    try:
+        signer = load_signer_from_args(args)
+    except (ImportError, ValueError) as e:
+        print(f"Cannot sign: {e}", file=sys.stderr)
+        return 2
+
+    service = CertificateService(args.engine, args.templates, args.fonts, signer, args.root or [os.getcwd()])
+    for path in args.preload:
+        try:
+            service.template(path)
+        except (OSError, ValueError) as e:
+            print(f"Cannot load template {path}: {e}", file=sys.stderr)
+            return 2
+
+    server = CertificateServer((args.host, args.port), service, args.quiet)
+    host, port = server.server_address[:2]
+    print(f"Serving on http://{host}:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def run_verify(args):
+    """Run the verify subcommand and print the files that are missing or changed."""
+    from modules.signing import verify_checksums
+
+    problems = verify_checksums(args.checksums)
+    for filename, problem in problems:
+        print(f"{filename}: {problem}", file=sys.stderr)
+    if problems:
+        print(f"{len(problems)} file(s) failed verification")
+        return 1
+    print("All files verified")
+    return 0
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+
+    Args:
+        argv: Arguments (defaults to sys.argv[1:])
+
+    Returns:
+        Process exit code
+    """
+    args = build_parser().parse_args(argv)
+
+    if args.command == "generate":
+        return run_generate(args)
+    if args.command == "serve":
+        return run_serve(args)
+    if args.command == "verify":
+        return run_verify(args)
+
+    return 2
@@ -0,0 +1,273 @@
+# combined.py
+
+import io
+import os
+import uuid
+
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import DecodedStreamObject, DictionaryObject, IndirectObject, NameObject
+
+from modules.stamper import (OVERLAY_CLIP, embedded_fonts, fields_ops, font_dictionaries, font_snippets, page_content,
+                             read_xref, remap_references)
+
+# Resource names used on every page of the combined document (formats take the page or font number)
+TEMPLATE_XOBJECT_FORMAT = "/SignitTpl{}"
+FONT_RESOURCE_FORMAT = "/SignitF{}"
+
+# Page attributes that can be inherited from the page tree root
+INHERITABLE = ("/MediaBox", "/CropBox", "/Rotate")
+
+
+class CombinedWriter:
+    """
+    Write a single PDF with the template's pages for every certificate.
+
+    Each template page is stored once as a shared form XObject, together with
+    its fonts and images; every page that receives text only carries a small
+    content stream that draws the template page and then the layout's fields.
+    Pages without text all point to a single shared content stream. Pages are
+    streamed to the file as they are added, so only the object offsets are
+    kept in memory. TrueType fonts are embedded once, when the document is
+    closed, subset to the glyphs of the whole batch. With a signer, the
+    finished document is signed before it is moved into place.
+
+    Use it as a context manager, or call close() to finish the document.
+    """
+
+    def __init__(self, template, layout, output_path, signer=None):
+        """
+        Args:
+            template: CompiledTemplate whose pages are used as the artwork
+            layout: modules.layout.Layout with the fields to draw
+            output_path: Path where to save the combined PDF
+            signer: Optional modules.signing.Signer signing the document once it is complete
+        """
+        self.output_path = output_path
+        self.signer = signer
+        resource_names = (FONT_RESOURCE_FORMAT.format(index) for index in range(1, len(layout.fields) + 1))
+        self.texts = font_snippets(layout, resource_names, embed=True)
+        self._page_fields = {page: layout.fields_on(page) for page in layout.pages}
+
+        self._offsets = []  # file offset of each object, indexed by object number - 1
+        self._page_ids = []
+        self._overlay_objects = {}  # object bytes -> object number (fonts of ReportLab fallback pages)
+        # Written under a temporary name and renamed over output_path by close()
+        directory, filename = os.path.split(os.path.abspath(output_path))
+        self._temp_path = os.path.join(directory, f".tmp-{uuid.uuid4().hex}-{filename}")
+        self._file = open(self._temp_path, "xb")
+        try:
+            self._write_shared(template)
+        except BaseException:
+            # close() never runs when the constructor fails, so nothing else removes the file
+            self._file.close()
+            os.remove(self._temp_path)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_shared(self, template):
+        """Write the template form XObjects, the shared resources, the catalog and the info dictionary."""
+        # Let PdfWriter serialize the template objects once
+        writer = PdfWriter()
+        forms = DictionaryObject()
+        for index, page in enumerate(template.pages):
+            form = DecodedStreamObject()
+            form.set_data(page_content(page))
+            form = form.flate_encode()
+            form[NameObject("/Type")] = NameObject("/XObject")
+            form[NameObject("/Subtype")] = NameObject("/Form")
+            form[NameObject("/BBox")] = page.mediabox
+            if "/Resources" in page:
+                form[NameObject("/Resources")] = page.raw_get("/Resources")
+            form.indirect_reference = None
+            forms[NameObject(TEMPLATE_XOBJECT_FORMAT.format(index))] = form.clone(writer).indirect_reference
+        self._forms = b"".join(key.encode() + b" %d 0 R " % ref.idnum for key, ref in forms.items())
+
+        fonts = DictionaryObject()
+        for resource_name, font in font_dictionaries(self.texts).items():
+            font.indirect_reference = None
+            fonts[NameObject(resource_name)] = font.clone(writer).indirect_reference
+        self._font_entries = b"".join(key.encode() + b" %d 0 R " % ref.idnum for key, ref in fonts.items())
+
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        data = buffer.getvalue()
+
+        trailer = PdfReader(io.BytesIO(data)).trailer
+        self._root_id = trailer.raw_get("/Root").idnum
+        self._info_id = trailer.raw_get("/Info").idnum
+        self._pages_id = trailer["/Root"].raw_get("/Pages").idnum
+
+        # Inheritable page attributes of the first page go on the page tree root, other pages only
+        # carry theirs when they differ
+        attributes = [_page_attributes(page) for page in template.pages]
+        self._inherited = attributes[0]
+        self._attributes = [b"" if value == attributes[0] else value for value in attributes]
+
+        xref_start, offsets, _ = read_xref(data)
+        self._file.write(data[:offsets[0]])
+        for index, offset in enumerate(offsets):
+            end = offsets[index + 1] if index + 1 < len(offsets) else xref_start
+            if index + 1 == self._pages_id:
+                # The page tree is written last, once every page is known
+                self._offsets.append(None)
+            else:
+                self._offsets.append(self._file.tell())
+                self._file.write(data[offset:end])
+
+        # The shared resources are written last, once the embedded fonts' subsets are known
+        self._offsets.append(None)
+        self._resources_id = len(self._offsets)
+
+        # Pages without text are the same for every certificate
+        self._static_contents = {index: self._write_stream(self._draw_template(index))
+                                 for index in range(len(template.pages)) if index not in self._page_fields}
+
+    def _write_object(self, body):
+        """Append an object to the file and return its object number."""
+        self._offsets.append(self._file.tell())
+        idnum = len(self._offsets)
+        self._file.write(b"%d 0 obj\n" % idnum + body + b"\nendobj\n")
+        return idnum
+
+    def _write_stream(self, data):
+        """Append a stream object and return its object number."""
+        return self._write_object(b"<<\n/Length %d\n>>\nstream\n" % len(data) + data + b"\nendstream")
+
+    @staticmethod
+    def _draw_template(index):
+        """Return the operators drawing a template page."""
+        return b"q " + TEMPLATE_XOBJECT_FORMAT.format(index).encode() + b" Do Q\n"
+
+    def _write_page(self, index, content_id, resources):
+        """Append a page with the given content stream and the attributes of a template page."""
+        page_id = self._write_object(b"<<\n/Type /Page\n/Parent %d 0 R\n/Resources %s\n/Contents %d 0 R\n%s>>"
+                                     % (self._pages_id, resources, content_id, self._attributes[index]))
+        self._page_ids.append(page_id)
+
+    def _write_pages(self, contents, resources):
+        """
+        Append the pages of a certificate.
+
+        Args:
+            contents: {template page index: operators drawn after the template page}
+            resources: Resources of the pages with contents
+        """
+        shared_resources = b"%d 0 R" % self._resources_id
+        for index in range(len(self._attributes)):
+            if index in contents:
+                content_id = self._write_stream(self._draw_template(index) + contents[index])
+                self._write_page(index, content_id, resources)
+            else:
+                self._write_page(index, self._static_contents[index], shared_resources)
+
+    def supports(self, values):
+        """Return True if add_values() can draw every field's text (see TextSnippet)."""
+        return all(text.supports(value) for text, value in zip(self.texts, values))
+
+    def add_values(self, values, font_sizes=None):
+        """
+        Add the pages of a certificate, with the fields' texts drawn with the shared font resources.
+
+        Args:
+            values: Texts of the layout's fields (must satisfy supports())
+            font_sizes: Font size of each field (default: auto-fitted from the font settings)
+        """
+        contents = {page: fields_ops(self.texts, values, font_sizes, indices)
+                    for page, indices in self._page_fields.items()}
+        self._write_pages(contents, b"%d 0 R" % self._resources_id)
+
+    def add_overlay(self, overlay):
+        """
+        Add the pages of a certificate from a ReportLab overlay PDF (see render_overlay).
+
+        The overlay's fonts, with the objects they refer to (embedded font
+        files), are written once per distinct object and shared by later pages.
+
+        Args:
+            overlay: Bytes of the overlay PDF, with a page per template page that receives text
+        """
+        overlay_pages = PdfReader(io.BytesIO(overlay)).pages
+
+        # ReportLab names its fonts per document, so the overlay pages agree on the names
+        fonts = {}
+        contents = {}
+        copied = {}
+        for page, overlay_page in zip(self._page_fields, overlay_pages):
+            overlay_fonts = overlay_page["/Resources"].get("/Font", DictionaryObject()).get_object()
+            for key, font in overlay_fonts.items():
+                fonts[key] = self._copy_object(font.get_object(), copied)
+            # Same clipping as merge_page applies to the letter-sized overlay
+            contents[page] = b"q " + OVERLAY_CLIP + b"\n" + page_content(overlay_page) + b"\nQ\n"
+
+        fonts = b"".join(key.encode() + b" %d 0 R " % idnum for key, idnum in fonts.items())
+        resources = b"<<\n/XObject << %s>>\n/Font << %s>>\n>>" % (self._forms, fonts)
+        self._write_pages(contents, resources)
+
+    def _copy_object(self, obj, copied):
+        """
+        Append an overlay object, after the objects it refers to, unless an identical one was written.
+
+        Args:
+            obj: Direct PyPDF2 object read from an overlay
+            copied: {overlay object number: object number} of the overlay's objects written so far
+
+        Returns:
+            Object number of the copy
+        """
+        def reference(ref):
+            if ref.idnum not in copied:
+                copied[ref.idnum] = self._copy_object(ref.get_object(), copied)
+            return IndirectObject(copied[ref.idnum], 0, None)
+
+        data = io.BytesIO()
+        remap_references(obj, reference).write_to_stream(data, None)
+        data = data.getvalue()
+        if data not in self._overlay_objects:
+            self._overlay_objects[data] = self._write_object(data)
+        return self._overlay_objects[data]
+
+    def close(self):
+        """Write the page tree, the xref table and the trailer, and move the file into place."""
+        if self._file.closed:
+            return
+
+        font_entries = self._font_entries
+        for embedded in embedded_fonts(self.texts):
+            font_entries += b"".join(key.encode() + b" %d 0 R " % idnum
+                                     for key, idnum in embedded.write(self._write_object).items())
+        self._offsets[self._resources_id - 1] = self._file.tell()
+        self._file.write(b"%d 0 obj\n<<\n/XObject << %s>>\n/Font << %s>>\n>>\nendobj\n"
+                         % (self._resources_id, self._forms, font_entries))
+
+        self._offsets[self._pages_id - 1] = self._file.tell()
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self._page_ids)
+        self._file.write(b"%d 0 obj\n<<\n/Type /Pages\n/Kids [ %s ]\n/Count %d\n%s>>\nendobj\n"
+                         % (self._pages_id, kids, len(self._page_ids), self._inherited))
+
+        xref_start = self._file.tell()
+        self._file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(self._offsets) + 1))
+        for offset in self._offsets:
+            self._file.write(b"%010d 00000 n \n" % offset)
+        self._file.write(b"trailer\n<<\n/Size %d\n/Root %d 0 R\n/Info %d 0 R\n>>\nstartxref\n%d\n%%%%EOF\n"
+                         % (len(self._offsets) + 1, self._root_id, self._info_id, xref_start))
+        self._file.close()
+        if self.signer is not None and self._page_ids:
+            self.signer.sign_file(self._temp_path)
+        os.replace(self._temp_path, self.output_path)
+
+
+def _page_attributes(page):
+    """Return the inheritable attributes of a page as dictionary entries."""
+    attributes = io.BytesIO()
+    for key in INHERITABLE:
+        value = page.mediabox if key == "/MediaBox" else page.get(key)
+        if value is not None:
+            attributes.write(key.encode() + b" ")
+            value.write_to_stream(attributes, None)
+            attributes.write(b"\n")
+    return attributes.getvalue()
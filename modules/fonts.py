@@ -0,0 +1,132 @@
+# fonts.py
+#
+# TrueType fonts given as a file path instead of a base-14 family. A font file
+# is parsed and registered with ReportLab once per process, under its path, so
+# every layout, canvas and worker refers to it by the same name. Embedding is
+# done per document with only the glyphs its text uses (see EmbeddedFont).
+
+import zlib
+
+from reportlab.lib.rl_accel import fp_str
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import FF_NONSYMBOLIC, FF_SYMBOLIC, SUBSETN, TTFError, TTFont, makeToUnicodeCMap
+
+from modules.metrics import fallback_width, glyph_widths
+from modules.utils import is_font_file
+
+
+def register_font(path):
+    """
+    Register a TrueType font file with ReportLab (once per process, until unregister_font).
+
+    OpenType files are accepted when they have TrueType outlines; ReportLab
+    cannot embed PostScript (CFF) outlines.
+
+    Args:
+        path: Path to the .ttf/.otf file
+
+    Returns:
+        ReportLab font name of the font (the path itself)
+
+    Raises:
+        ValueError: If the file cannot be read or is not a supported font
+    """
+    if path in pdfmetrics.getRegisteredFontNames():
+        return path
+    try:
+        # Without ASCII-readable codes, subsets only carry the glyphs that are drawn
+        pdfmetrics.registerFont(TTFont(path, path, asciiReadable=False))
+    except (OSError, TTFError) as e:
+        raise ValueError(f"Cannot use font '{path}': {e}") from e
+    return path
+
+
+def unregister_font(path):
+    """
+    Forget a registered font file, so its parsed tables can be freed (see server.CertificateService).
+
+    ReportLab has no public way to unregister a font, so its registries are
+    edited directly. register_font parses the file again if it is used later.
+    """
+    font = pdfmetrics._fonts.pop(path, None)
+    if font is not None and pdfmetrics._dynFaceNames.get(font.face.name) is font:
+        del pdfmetrics._dynFaceNames[font.face.name]
+    glyph_widths.cache_clear()
+    fallback_width.cache_clear()
+
+
+def register_fonts(font_settings_list):
+    """Register the font files used by a sequence of font settings (base-14 families are left alone)."""
+    for font_settings in font_settings_list:
+        if is_font_file(font_settings["family"]):
+            register_font(font_settings["family"])
+
+
+class EmbeddedFont:
+    """
+    A registered TrueType font embedded once in a document.
+
+    Texts are encoded as they are drawn, which assigns their characters codes
+    in 256-character subsets shared by the whole document (ReportLab's own
+    scheme, see TTFont.splitString). write() then embeds each subset once,
+    with only its glyphs, when the document's text is complete.
+    """
+
+    def __init__(self, font_name, resource_name):
+        """
+        Args:
+            font_name: ReportLab font name of a registered TrueType font (see register_font)
+            resource_name: Resource name prefix of the subsets (subset n is "<resource_name>+n")
+        """
+        self.font = pdfmetrics.getFont(font_name)
+        self.resource_name = resource_name
+        self._state = self.font._assignState(self)
+
+    def encode(self, text):
+        """
+        Return the text as runs of subset codes.
+
+        Returns:
+            List of (resource name bytes, code bytes) tuples, in drawing order
+        """
+        return [(b"%s+%d" % (self.resource_name.encode(), subset), codes)
+                for subset, codes in self.font.splitString(text, self)]
+
+    def write(self, write_object):
+        """
+        Write the font objects of every subset used so far.
+
+        Args:
+            write_object: Function appending an object body (bytes) to the document
+                and returning its object number
+
+        Returns:
+            {resource name: object number of the subset's font dictionary}
+        """
+        face = self.font.face
+        flags = face.flags & ~FF_NONSYMBOLIC | FF_SYMBOLIC
+        fonts = {}
+        for index, subset in enumerate(self._state.subsets):
+            base_font = b"".join((SUBSETN(index), b"+", face.name, face.subfontNameX))
+            font_file = face.makeSubset(subset)
+            font_file_id = write_object(_stream(zlib.compress(font_file), b"/Filter /FlateDecode\n/Length1 %d\n"
+                                                % len(font_file)))
+            descriptor_id = write_object(
+                b"<<\n/Type /FontDescriptor\n/FontName /%s\n/Flags %d\n/FontBBox [ %s ]\n/ItalicAngle %s\n"
+                b"/Ascent %s\n/Descent %s\n/CapHeight %s\n/StemV %s\n/MissingWidth %s\n/FontFile2 %d 0 R\n>>"
+                % (base_font, flags, fp_str(*face.bbox).encode(), fp_str(face.italicAngle).encode(),
+                   fp_str(face.ascent).encode(), fp_str(face.descent).encode(), fp_str(face.capHeight).encode(),
+                   fp_str(face.stemV).encode(), fp_str(face.defaultWidth).encode(), font_file_id))
+            cmap = makeToUnicodeCMap(base_font.decode("latin-1"), subset).encode("latin-1")
+            cmap_id = write_object(_stream(zlib.compress(cmap), b"/Filter /FlateDecode\n"))
+            widths = fp_str(*map(face.getCharWidth, subset)).encode()
+            fonts[f"{self.resource_name}+{index}"] = write_object(
+                b"<<\n/Type /Font\n/Subtype /TrueType\n/BaseFont /%s\n/FirstChar 0\n/LastChar %d\n/Widths [ %s ]\n"
+                b"/FontDescriptor %d 0 R\n/ToUnicode %d 0 R\n>>"
+                % (base_font, len(subset) - 1, widths, descriptor_id, cmap_id))
+        return fonts
+
+
+def _stream(data, entries=b""):
+    """Return the body of a stream object."""
+    return b"<<\n%s/Length %d\n>>\nstream\n" % (entries, len(data)) + data + b"\nendstream"
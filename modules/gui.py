@@ -1,15 +1,27 @@
 # gui.py
+#
+# Only Tk and light modules are imported at start-up. PyMuPDF, PIL, ReportLab
+# and PyPDF2 are loaded by the first preview (on the preview worker thread,
+# see modules.preview) or the first generation, so the window appears at once
+# (see check_startup.py).
 
 import os
-import tempfile
+import threading
+import time
 import tkinter as tk
 from tkinter import filedialog, colorchooser, messagebox, ttk
 
-import fitz  # PyMuPDF
-from PIL import Image, ImageTk
+from modules.preview import LatestJobWorker, PreviewRenderer
+from modules.utils import count_names_from_csv, iter_names_from_csv, resolve_font_name
 
-from modules.processor import generate_certificates
-from modules.utils import read_names_from_csv
+# Preview resolution, delay after the last settings change before rendering,
+# and how often the main loop checks for a finished render (milliseconds)
+PREVIEW_DPI = 100
+PREVIEW_DEBOUNCE_MS = 150
+PREVIEW_POLL_MS = 20
+
+# How often the progress window is refreshed during a batch (milliseconds)
+PROGRESS_POLL_MS = 100
 
 
 class CertificateSignerGUI:
@@ -29,6 +41,10 @@ class CertificateSignerGUI:
         self.is_italic_var = tk.BooleanVar(value=False)
         self.font_color_var = "#000000"  # Default: black
 
+        # Auto-fit: names wider than the fit width (points, 0 = off) are drawn smaller, down to the min size
+        self.fit_width_var = tk.IntVar(value=0)
+        self.min_size_var = tk.IntVar(value=8)
+
         # Text position variables (for PDF, origin is bottom-left)
         self.pos_x_var = tk.IntVar(value=300)
         self.pos_y_var = tk.IntVar(value=400)
@@ -39,7 +55,11 @@ class CertificateSignerGUI:
         # Preview data
         self.preview_img = None
         self.template_pdf = None
-        self.preview_temp_file = None
+        self.preview_renderer = PreviewRenderer()
+        self.preview_worker = LatestJobWorker()
+        self.preview_job_id = 0
+        self.preview_after_id = None
+        self.preview_polling = False
         self.sample_name = "Jane Doe"
 
         # Create the GUI layout
@@ -84,12 +104,22 @@ class CertificateSignerGUI:
         font_options = ["Times-Roman", "Helvetica", "Courier", "Symbol"]
         ttk.Combobox(font_frame, textvariable=self.font_family_var, values=font_options, width=15).grid(
             row=0, column=1, padx=5)
+        ttk.Button(font_frame, text="Font File...", command=self.browse_font).grid(row=0, column=4, padx=5)
 
         # Font size
         ttk.Label(font_frame, text="Size:").grid(row=0, column=2, sticky=tk.E, padx=5)
         ttk.Spinbox(font_frame, from_=8, to=72, textvariable=self.font_size_var, width=5).grid(
             row=0, column=3, padx=5)
 
+        # Auto-fit long names
+        ttk.Label(font_frame, text="Fit width:").grid(row=1, column=0, sticky=tk.E, padx=5, pady=(5, 0))
+        ttk.Spinbox(font_frame, from_=0, to=1000, textvariable=self.fit_width_var, width=5).grid(
+            row=1, column=1, sticky=tk.W, padx=5, pady=(5, 0))
+
+        ttk.Label(font_frame, text="Min size:").grid(row=1, column=2, sticky=tk.E, padx=5, pady=(5, 0))
+        ttk.Spinbox(font_frame, from_=4, to=72, textvariable=self.min_size_var, width=5).grid(
+            row=1, column=3, padx=5, pady=(5, 0))
+
         # Font style
         style_frame = ttk.Frame(text_frame)
         style_frame.pack(fill=tk.X, pady=5)
@@ -111,11 +141,11 @@ class CertificateSignerGUI:
 
         ttk.Label(position_frame, text="X Position:").grid(row=0, column=0, sticky=tk.E, padx=5)
         ttk.Spinbox(position_frame, from_=0, to=1000, textvariable=self.pos_x_var, width=5,
-                    command=lambda: self.update_preview()).grid(row=0, column=1, padx=5)
+                    command=self.schedule_preview).grid(row=0, column=1, padx=5)
 
         ttk.Label(position_frame, text="Y Position:").grid(row=0, column=2, sticky=tk.E, padx=5)
         ttk.Spinbox(position_frame, from_=0, to=1000, textvariable=self.pos_y_var, width=5,
-                    command=lambda: self.update_preview()).grid(row=0, column=3, padx=5)
+                    command=self.schedule_preview).grid(row=0, column=3, padx=5)
 
         # Sample name for preview
         sample_frame = ttk.Frame(text_frame)
@@ -134,6 +164,7 @@ class CertificateSignerGUI:
         action_frame.pack(fill=tk.X, pady=5)
 
         ttk.Button(action_frame, text="Update Preview", command=self.update_preview).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(action_frame, text="Check Names", command=self.check_names).pack(side=tk.LEFT, padx=5, pady=5)
         ttk.Button(action_frame, text="Generate Certificates", command=self.generate_certificates).pack(side=tk.RIGHT, padx=5, pady=5)
 
         # Right side: Preview
@@ -156,12 +187,14 @@ class CertificateSignerGUI:
 
         self.preview_canvas.configure(xscrollcommand=x_scrollbar.set, yscrollcommand=y_scrollbar.set)
 
-        # Bind events to update preview when settings change
-        self.font_family_var.trace_add("write", lambda *args: self.update_preview())
-        self.font_size_var.trace_add("write", lambda *args: self.update_preview())
-        self.is_bold_var.trace_add("write", lambda *args: self.update_preview())
-        self.is_italic_var.trace_add("write", lambda *args: self.update_preview())
-        self.name_format_var.trace_add("write", lambda *args: self.update_preview())
+        # Bind events to update preview when settings change (debounced)
+        self.font_family_var.trace_add("write", lambda *args: self.schedule_preview())
+        self.font_size_var.trace_add("write", lambda *args: self.schedule_preview())
+        self.fit_width_var.trace_add("write", lambda *args: self.schedule_preview())
+        self.min_size_var.trace_add("write", lambda *args: self.schedule_preview())
+        self.is_bold_var.trace_add("write", lambda *args: self.schedule_preview())
+        self.is_italic_var.trace_add("write", lambda *args: self.schedule_preview())
+        self.name_format_var.trace_add("write", lambda *args: self.schedule_preview())
 
     def browse_template(self):
         file_path = filedialog.askopenfilename(
@@ -172,6 +205,15 @@ class CertificateSignerGUI:
             self.template_path.set(file_path)
             self.update_preview()
 
+    def browse_font(self):
+        file_path = filedialog.askopenfilename(
+            title="Select Font File",
+            filetypes=[("TrueType Fonts", "*.ttf *.otf")]
+        )
+        if file_path:
+            # The path is the font family; the font is registered once, on first use
+            self.font_family_var.set(file_path)
+
     def browse_csv(self):
         file_path = filedialog.askopenfilename(
             title="Select CSV File",
@@ -180,9 +222,10 @@ class CertificateSignerGUI:
         if file_path:
             self.csv_path.set(file_path)
             try:
-                names = read_names_from_csv(file_path)
-                if names and len(names) > 0:
-                    self.update_sample_name(names[0])
+                # Only the first name is read
+                name = next(iter_names_from_csv(file_path), None)
+                if name is not None:
+                    self.update_sample_name(name)
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to read CSV file: {str(e)}")
 
@@ -199,147 +242,151 @@ class CertificateSignerGUI:
 
     def get_font_settings(self):
         """Return a dictionary with all font settings"""
-        font_name = self.font_family_var.get()
-
-        # Add Bold/Italic suffixes for standard fonts
-        if font_name in ["Times-Roman", "Helvetica", "Courier"]:
-            if self.is_bold_var.get() and self.is_italic_var.get():
-                if font_name == "Times-Roman":
-                    font_name = "Times-BoldItalic"
-                else:
-                    font_name = f"{font_name}-BoldOblique"
-            elif self.is_bold_var.get():
-                if font_name == "Times-Roman":
-                    font_name = "Times-Bold"
-                else:
-                    font_name = f"{font_name}-Bold"
-            elif self.is_italic_var.get():
-                if font_name == "Times-Roman":
-                    font_name = "Times-Italic"
-                else:
-                    font_name = f"{font_name}-Oblique"
+        font_name = resolve_font_name(self.font_family_var.get(), self.is_bold_var.get(), self.is_italic_var.get())
 
         return {
             "family": font_name,
             "size": self.font_size_var.get(),
             "bold": self.is_bold_var.get(),
             "italic": self.is_italic_var.get(),
-            "color": self.font_color_var
+            "color": self.font_color_var,
+            "max_width": self.fit_width_var.get(),
+            "min_size": self.min_size_var.get()
         }
 
-    def pdf_to_image(self, pdf_path, dpi=100):
-        """
-        Convert the first page of a PDF to a PIL Image using PyMuPDF (fitz).
-        PyMuPDF is a pure Python library that doesn't need external dependencies.
-
-        Args:
-            pdf_path: Path to the PDF file
-            dpi: Resolution of the output image
-
-        Returns:
-            PIL Image object
-        """
-        try:
-            # Open the PDF file with PyMuPDF
-            pdf_document = fitz.open(pdf_path)
-
-            # Get the first page
-            first_page = pdf_document[0]
-
-            # Calculate zoom factor based on DPI
-            zoom_factor = dpi / 72.0  # 72 points per inch
-
-            # Get the pixel matrix with the specified zoom
-            pixmap = first_page.get_pixmap(matrix=fitz.Matrix(zoom_factor, zoom_factor))
-
-            # Convert to PIL Image
-            img = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
-
-            # Close the PDF document
-            pdf_document.close()
-
-            return img
-
-        except Exception as e:
-            raise Exception(f"Error converting PDF to image: {str(e)}")
+    def schedule_preview(self):
+        """Update the preview once the settings stop changing for a moment"""
+        if self.preview_after_id is not None:
+            self.master.after_cancel(self.preview_after_id)
+        self.preview_after_id = self.master.after(PREVIEW_DEBOUNCE_MS, self.update_preview)
 
     def update_preview(self):
-        """Generate and display a preview of the certificate with current settings"""
+        """Render a preview of the certificate with current settings on the background worker"""
+        if self.preview_after_id is not None:
+            self.master.after_cancel(self.preview_after_id)
+            self.preview_after_id = None
+
         template_path = self.template_path.get()
         if not template_path or not os.path.isfile(template_path):
-            self.preview_canvas.delete("all")
-            self.preview_canvas.create_text(
-                self.preview_canvas.winfo_width() // 2,
-                self.preview_canvas.winfo_height() // 2,
-                text="Please select a template PDF file",
-                font=("Helvetica", 14)
-            )
+            self.preview_job_id += 1  # drop renders still in flight
+            self.show_preview_message("Please select a template PDF file")
             return
 
-        # Clean up previous temp file
-        if self.preview_temp_file and os.path.exists(self.preview_temp_file):
-            os.unlink(self.preview_temp_file)
-
-        # Format the name using the template
-        name_text = self.name_format_var.get().format(name=self.sample_name)
-
-        # Create a temporary preview file
         try:
-            # Create a temporary output file
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                self.preview_temp_file = tmp_file.name
-
-            # Generate a preview certificate
+            # Format the name using the template
+            name_text = self.name_format_var.get().format(name=self.sample_name)
             font_settings = self.get_font_settings()
             position = (self.pos_x_var.get(), self.pos_y_var.get())
-            generate_certificates(
-                template_path,
-                [name_text],
-                font_settings,
-                position,
-                os.path.dirname(self.preview_temp_file),
-                os.path.basename(self.preview_temp_file)
-            )
-
-            # Convert the PDF to an image using PyMuPDF
-            preview_image = self.pdf_to_image(self.preview_temp_file, dpi=100)
-
-            # Convert PIL image to Tkinter PhotoImage
-            self.preview_img = ImageTk.PhotoImage(image=preview_image)
+        except (tk.TclError, ValueError, KeyError, IndexError):
+            # A spinbox or the name format is being edited; wait for a valid value
+            return
 
-            # Update canvas
-            self.preview_canvas.delete("all")
+        # Only the latest job is rendered; results of older ones are dropped
+        self.preview_job_id += 1
+        self.preview_worker.submit(self.preview_job_id, self.render_preview,
+                                   template_path, name_text, font_settings, position)
+
+        if not self.preview_polling:
+            self.preview_polling = True
+            self.master.after(PREVIEW_POLL_MS, self.poll_preview)
+
+    def render_preview(self, template_path, name_text, font_settings, position):
+        """Composite the name onto the cached template raster (runs on the worker thread)"""
+        preview_image = self.preview_renderer.render(template_path, name_text, font_settings, position,
+                                                     dpi=PREVIEW_DPI)
+        return preview_image, position
+
+    def poll_preview(self):
+        """Hand finished renders back to the canvas from the Tk main loop"""
+        # Read the idle state first: a render that finishes afterwards is picked up by the next poll
+        idle = self.preview_worker.idle
+
+        for job_id, result, error in self.preview_worker.results():
+            if job_id != self.preview_job_id:
+                continue  # stale render
+            if error is not None:
+                self.show_preview_message(f"Preview error: {str(error)}", error=True)
+            else:
+                self.show_preview(*result)
+
+        if idle:
+            self.preview_polling = False
+        else:
+            self.master.after(PREVIEW_POLL_MS, self.poll_preview)
+
+    def show_preview(self, preview_image, position):
+        """Display a rendered preview image with a marker at the text position"""
+        # Convert PIL image to Tkinter PhotoImage (PIL is loaded by the time a preview is rendered)
+        from PIL import ImageTk
+
+        self.preview_img = ImageTk.PhotoImage(image=preview_image)
+
+        # Update canvas
+        self.preview_canvas.delete("all")
+
+        # Configure scrollregion
+        self.preview_canvas.config(scrollregion=(0, 0, preview_image.width, preview_image.height))
+
+        # Display the image
+        self.preview_canvas.create_image(0, 0, anchor="nw", image=self.preview_img)
+
+        # Draw position marker
+        marker_size = 10
+        scale = PREVIEW_DPI / 72
+        x, y = position
+        # Convert from PDF coordinates (origin at bottom-left) to image coordinates (origin at top-left)
+        y_image = preview_image.height - y * scale  # Adjust for DPI
+
+        # Draw crosshair at text position
+        self.preview_canvas.create_line(x * scale - marker_size, y_image, x * scale + marker_size,
+                                        y_image, fill="red", width=2)
+        self.preview_canvas.create_line(x * scale, y_image - marker_size, x * scale,
+                                        y_image + marker_size, fill="red", width=2)
+
+    def show_preview_message(self, text, error=False):
+        """Replace the preview with a centered message"""
+        self.preview_canvas.delete("all")
+        self.preview_canvas.create_text(
+            self.preview_canvas.winfo_width() // 2,
+            self.preview_canvas.winfo_height() // 2,
+            text=text,
+            font=("Helvetica", 14),
+            fill="red" if error else "black"
+        )
 
-            # Configure scrollregion
-            self.preview_canvas.config(scrollregion=(0, 0, preview_image.width, preview_image.height))
+    def check_names(self):
+        """Report the names that would overflow or have characters the font cannot draw, without generating"""
+        template_path = self.template_path.get()
+        csv_path = self.csv_path.get()
 
-            # Display the image
-            self.preview_canvas.create_image(0, 0, anchor="nw", image=self.preview_img)
+        if not template_path or not os.path.isfile(template_path):
+            messagebox.showerror("Error", "Template PDF not found.")
+            return
 
-            # Draw position marker
-            marker_size = 10
-            x, y = position
-            # Convert from PDF coordinates (origin at bottom-left) to image coordinates (origin at top-left)
-            y_image = preview_image.height - y * (100 / 72)  # Adjust for DPI
+        if not csv_path or not os.path.isfile(csv_path):
+            messagebox.showerror("Error", "CSV file not found.")
+            return
 
-            # Draw crosshair at text position
-            self.preview_canvas.create_line(x * (100 / 72) - marker_size, y_image, x * (100 / 72) + marker_size,
-                                            y_image, fill="red", width=2)
-            self.preview_canvas.create_line(x * (100 / 72), y_image - marker_size, x * (100 / 72),
-                                            y_image + marker_size, fill="red", width=2)
+        try:
+            name_format = self.name_format_var.get()
+            formatted_names = (name_format.format(name=name) for name in iter_names_from_csv(csv_path))
+            position = (self.pos_x_var.get(), self.pos_y_var.get())
+            from modules.processor import generate_certificates
 
+            # Only lays the names out, so it takes milliseconds even for large files
+            report = generate_certificates(template_path, formatted_names, self.get_font_settings(), position, None,
+                                           dry_run=True)
         except Exception as e:
-            self.preview_canvas.delete("all")
-            self.preview_canvas.create_text(
-                self.preview_canvas.winfo_width() // 2,
-                self.preview_canvas.winfo_height() // 2,
-                text=f"Preview error: {str(e)}",
-                font=("Helvetica", 14),
-                fill="red"
-            )
+            messagebox.showerror("Error", f"Failed to check names: {str(e)}")
+            return
+
+        if report.ok:
+            messagebox.showinfo("Check Names", report.format())
+        else:
+            messagebox.showwarning("Check Names", report.format(limit=10))
 
     def generate_certificates(self):
-        """Generate certificates for all names in the CSV file"""
+        """Generate certificates for all names in the CSV file on a background thread"""
         template_path = self.template_path.get()
         csv_path = self.csv_path.get()
 
@@ -352,14 +399,15 @@ class CertificateSignerGUI:
             return
 
         try:
-            # Read names from CSV
-            names = read_names_from_csv(csv_path)
-            if not names:
+            # Count the names; they are read again lazily by the batch, so no list is kept
+            total = count_names_from_csv(csv_path)
+            if not total:
                 messagebox.showerror("Error", "No names found in CSV.")
                 return
 
             # Format the names using the template
-            formatted_names = [self.name_format_var.get().format(name=name) for name in names]
+            name_format = self.name_format_var.get()
+            formatted_names = (name_format.format(name=name) for name in iter_names_from_csv(csv_path))
 
             # Ask for output directory
             output_dir = filedialog.askdirectory(title="Select Output Folder")
@@ -370,34 +418,119 @@ class CertificateSignerGUI:
             font_settings = self.get_font_settings()
             position = (self.pos_x_var.get(), self.pos_y_var.get())
 
-            # Show progress bar
-            progress_window = tk.Toplevel(self.master)
-            progress_window.title("Generating Certificates")
-            progress_window.geometry("300x100")
-            progress_window.transient(self.master)
-            progress_window.grab_set()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to generate certificates: {str(e)}")
+            return
+
+        # Show progress window
+        progress_window = tk.Toplevel(self.master)
+        progress_window.title("Generating Certificates")
+        progress_window.geometry("340x150")
+        progress_window.transient(self.master)
+        progress_window.grab_set()
+
+        status_label = ttk.Label(progress_window, text="Generating certificates...")
+        status_label.pack(pady=10)
+
+        progress = ttk.Progressbar(progress_window, orient="horizontal", length=300, mode="determinate")
+        progress.pack(pady=5)
+        progress["maximum"] = total
+
+        batch = {
+            "window": progress_window,
+            "progress": progress,
+            "status": status_label,
+            "total": total,
+            "output_dir": output_dir,
+            "cancel_event": threading.Event(),
+            "done": 0,
+            "generated": 0,
+            "error": None,
+            "start": time.perf_counter(),
+        }
 
-            ttk.Label(progress_window, text="Generating certificates...").pack(pady=10)
+        cancel_button = ttk.Button(progress_window, text="Cancel", command=lambda: self.cancel_generation(batch))
+        cancel_button.pack(pady=5)
+        batch["cancel_button"] = cancel_button
+        progress_window.protocol("WM_DELETE_WINDOW", lambda: self.cancel_generation(batch))
 
-            progress = ttk.Progressbar(progress_window, orient="horizontal", length=250, mode="determinate")
-            progress.pack(pady=10)
-            progress["maximum"] = len(names)
+        batch["thread"] = threading.Thread(
+            target=self.run_generation,
+            args=(batch, template_path, formatted_names, font_settings, position, output_dir),
+            daemon=True
+        )
+        batch["thread"].start()
+        self.master.after(PROGRESS_POLL_MS, self.poll_generation, batch)
 
-            # Update the progress bar
-            progress_window.update()
+    def run_generation(self, batch, template_path, names, font_settings, position, output_dir):
+        """Run the batch (on the worker thread); progress is read by poll_generation"""
+        try:
+            # Loaded here on the first batch, off the Tk thread
+            from modules.processor import iter_certificates
 
-            # Generate the certificates
-            generate_certificates(
+            results = iter_certificates(
                 template_path,
-                formatted_names,
+                names,
                 font_settings,
                 position,
-                output_dir
+                output_dir,
+                cancel_event=batch["cancel_event"]
             )
+            for index, name, path, error in results:
+                batch["done"] = index + 1
+                if error is not None:
+                    # Stop at the first failure
+                    results.close()
+                    batch["error"] = f"{name}: {error}"
+                    break
+                batch["generated"] += 1
+        except Exception as e:
+            batch["error"] = e
+
+    def cancel_generation(self, batch):
+        """Ask the batch to stop after the current certificate"""
+        batch["cancel_event"].set()
+        batch["cancel_button"].config(state=tk.DISABLED)
+        batch["status"].config(text="Cancelling after the current certificate...")
+
+    def poll_generation(self, batch):
+        """Update the progress window from the Tk main loop until the batch finishes"""
+        done = batch["done"]
+        batch["progress"]["value"] = done
+        if not batch["cancel_event"].is_set():
+            elapsed = time.perf_counter() - batch["start"]
+            batch["status"].config(text=format_progress(done, batch["total"], elapsed))
+
+        if batch["thread"].is_alive():
+            self.master.after(PROGRESS_POLL_MS, self.poll_generation, batch)
+            return
 
-            progress_window.destroy()
+        batch["window"].destroy()
 
-            messagebox.showinfo("Success", f"Generated {len(names)} certificates in {output_dir}")
+        if batch["error"] is not None:
+            messagebox.showerror("Error", f"Failed to generate certificates: {str(batch['error'])}")
+        elif batch["cancel_event"].is_set():
+            messagebox.showinfo("Cancelled", f"Cancelled after {batch['generated']} certificates in "
+                                             f"{batch['output_dir']}")
+        else:
+            messagebox.showinfo("Success", f"Generated {batch['generated']} certificates in {batch['output_dir']}")
 
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to generate certificates: {str(e)}")
+
+def format_progress(done, total, elapsed):
+    """
+    Return a progress line with the rate and the estimated time left.
+
+    Args:
+        done: Number of certificates generated so far
+        total: Number of certificates in the batch
+        elapsed: Seconds since the batch started
+
+    Returns:
+        Text such as "120/500 - 35.2 certificates/s - ETA 0:11"
+    """
+    if done == 0 or elapsed <= 0:
+        return f"{done}/{total} - starting..."
+
+    rate = done / elapsed
+    remaining = int(round((total - done) / rate))
+    return f"{done}/{total} - {rate:.1f} certificates/s - ETA {remaining // 60}:{remaining % 60:02d}"
@@ -0,0 +1,249 @@
+# instrumentation.py
+#
+# Opt-in timing and counter hooks for generate_certificates. Without an
+# instrumentation object the processor only pays for `is None` checks.
+
+import cProfile
+import heapq
+import json
+import math
+import time
+from array import array
+from contextlib import contextmanager, nullcontext
+
+# Number of slowest names kept in a run summary
+SLOWEST_COUNT = 10
+
+
+class Instrumentation:
+    """
+    Hooks called by the processor during a batch; every hook does nothing.
+
+    Subclass it and override the hooks to forward the events elsewhere (logs,
+    a metrics system). The processor calls:
+
+        run_started() / run_finished()  around generate_certificates
+        timing(stage, seconds)          for the "load", "overlay", "merge", "render", "sign" and "write" stages
+        certificate(name, seconds)      once per certificate written, with its total time
+        count(counter, amount)          for "generated", "skipped", "failed" and "bytes_written"
+
+    In parallel mode the workers record their events and the hooks are called
+    in the main process as the results come back.
+    """
+
+    def run_started(self):
+        pass
+
+    def run_finished(self):
+        pass
+
+    def timing(self, stage, seconds):
+        pass
+
+    def certificate(self, name, seconds):
+        pass
+
+    def count(self, counter, amount=1):
+        pass
+
+    @contextmanager
+    def stage(self, stage):
+        """Context manager reporting the time spent in the block to timing()."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(stage, time.perf_counter() - start)
+
+
+def timed(instrumentation, stage):
+    """Return a context manager timing a stage, or a no-op one without instrumentation."""
+    if instrumentation is None:
+        return nullcontext()
+    return instrumentation.stage(stage)
+
+
+class EventRecorder(Instrumentation):
+    """Records hook calls so they can be replayed in another process (see replay)."""
+
+    def __init__(self):
+        self.events = []
+
+    def timing(self, stage, seconds):
+        self.events.append(("timing", stage, seconds))
+
+    def certificate(self, name, seconds):
+        self.events.append(("certificate", name, seconds))
+
+    def count(self, counter, amount=1):
+        self.events.append(("count", counter, amount))
+
+    def drain(self):
+        """Return the recorded events and start a new list."""
+        events, self.events = self.events, []
+        return events
+
+
+def replay(events, instrumentation):
+    """Call the instrumentation hooks for events recorded by an EventRecorder."""
+    for hook, key, value in events:
+        getattr(instrumentation, hook)(key, value)
+
+
+class RunStats(Instrumentation):
+    """
+    Collects the statistics of a run; call summary() once it finished.
+
+        stats = RunStats()
+        generate_certificates(..., instrumentation=stats)
+        print(stats.summary().to_json())
+    """
+
+    def __init__(self, profile=False, slowest=SLOWEST_COUNT):
+        """
+        Args:
+            profile: Also run cProfile over the batch (see dump_profile). In parallel
+                mode only the main process is profiled.
+            slowest: Number of slowest names kept
+        """
+        self.stages = {}
+        self.counters = {}
+        self.latencies = array("d")
+        self.wall_time = 0.0
+        self._slowest_count = slowest
+        self._slowest = []
+        self._start = None
+        self.profiler = cProfile.Profile() if profile else None
+
+    def run_started(self):
+        self._start = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def run_finished(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.wall_time += time.perf_counter() - self._start
+
+    def timing(self, stage, seconds):
+        total = self.stages.setdefault(stage, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+
+    def certificate(self, name, seconds):
+        # The sequence number keeps equal times from comparing names
+        entry = (seconds, len(self.latencies), name)
+        self.latencies.append(seconds)
+        if len(self._slowest) < self._slowest_count:
+            heapq.heappush(self._slowest, entry)
+        elif self._slowest and seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def summary(self):
+        """Return a RunSummary of what was recorded so far."""
+        latencies = sorted(self.latencies)
+        return RunSummary(
+            certificates=len(latencies),
+            wall_time=self.wall_time,
+            stages={stage: {"total": total, "count": count, "mean": total / count}
+                    for stage, (total, count) in self.stages.items()},
+            latency={
+                "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else 0.0,
+            },
+            counters=dict(self.counters),
+            slowest=[(name, seconds) for seconds, _, name in sorted(self._slowest, reverse=True)],
+        )
+
+    def dump_profile(self, path):
+        """Write the cProfile statistics of the run (readable with pstats or snakeviz)."""
+        if self.profiler is None:
+            raise ValueError("The run was not profiled (use RunStats(profile=True))")
+        self.profiler.dump_stats(path)
+
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of an already sorted sequence (0.0 when empty)."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class RunSummary:
+    """
+    Statistics of a generate_certificates run.
+
+    Attributes:
+        certificates: Number of certificates written (skipped ones excluded)
+        wall_time: Duration of the run in seconds
+        stages: {stage: {"total", "count", "mean"}} times in seconds
+        latency: Per-certificate "mean", "p50", "p95", "p99" and "max" in seconds
+        counters: {"generated", "skipped", "failed", "bytes_written"} (only those seen)
+        slowest: List of (name, seconds), slowest first
+    """
+
+    def __init__(self, certificates, wall_time, stages, latency, counters, slowest):
+        self.certificates = certificates
+        self.wall_time = wall_time
+        self.stages = stages
+        self.latency = latency
+        self.counters = counters
+        self.slowest = slowest
+
+    @property
+    def bytes_written(self):
+        return self.counters.get("bytes_written", 0)
+
+    @property
+    def throughput(self):
+        """Certificates written per second."""
+        return self.certificates / self.wall_time if self.wall_time > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            "certificates": self.certificates,
+            "wall_time": self.wall_time,
+            "throughput": self.throughput,
+            "bytes_written": self.bytes_written,
+            "stages": self.stages,
+            "latency": self.latency,
+            "counters": self.counters,
+            "slowest": [{"name": name, "seconds": seconds} for name, seconds in self.slowest],
+        }
+
+    def to_json(self, path=None):
+        """
+        Return the summary as JSON, also writing it to path when given.
+
+        Args:
+            path: Optional file to write
+        """
+        text = json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        return text
+
+    def format(self):
+        """Return a short human-readable report."""
+        ms = {key: value * 1000 for key, value in self.latency.items()}
+        lines = [
+            f"{self.certificates} certificates in {self.wall_time:.2f}s ({self.throughput:.1f}/s), "
+            f"{self.bytes_written / 1024:.1f} KiB written",
+            f"Latency: p50 {ms['p50']:.1f} ms, p95 {ms['p95']:.1f} ms, p99 {ms['p99']:.1f} ms, max {ms['max']:.1f} ms",
+        ]
+        for stage, values in self.stages.items():
+            lines.append(f"  {stage}: {values['total']:.2f}s total, {values['mean'] * 1000:.2f} ms mean")
+        for counter in ("skipped", "failed"):
+            if self.counters.get(counter):
+                lines.append(f"  {counter}: {self.counters[counter]}")
+        if self.slowest:
+            lines.append("Slowest: " + ", ".join(f"{name} ({seconds * 1000:.1f} ms)" for name, seconds in self.slowest))
+        return "\n".join(lines)
@@ -0,0 +1,232 @@
+# layout.py
+#
+# Text layouts: which CSV columns are drawn on a certificate, where, and with
+# which font. A layout is parsed once per batch; every row then only has its
+# values formatted (see Layout.values).
+
+import json
+
+from modules.fonts import register_fonts
+from modules.metrics import fit_font_sizes
+from modules.utils import resolve_font_name
+
+# Keys of a field's font settings in a layout file, with their defaults
+FONT_DEFAULTS = {"font": "Times-Roman", "size": 24, "bold": False, "italic": False, "color": "#000000",
+                 "max_width": None, "min_size": 8}
+
+
+class Field:
+    """One text field of a layout: a CSV column drawn centered on a position of a template page."""
+
+    def __init__(self, column, position, font_settings, value_format="{value}", page=0):
+        """
+        Args:
+            column: Index of the CSV column, or its header name (see Layout.bind)
+            position: (x, y) position in points (the center of the text)
+            font_settings: Dictionary with font settings (family, size, color, max_width, min_size)
+            value_format: Format of the drawn text, with the cell as {value} (e.g. "Course: {value}")
+            page: Index of the template page the text is drawn on (0 is the first page)
+        """
+        self.column = column
+        self.position = tuple(position)
+        self.font_settings = font_settings
+        self.value_format = value_format
+        self.page = page
+
+    def settings(self):
+        """Return everything that affects how the field is drawn, as JSON-compatible data."""
+        return {"column": self.column, "position": list(self.position), "font": self.font_settings,
+                "format": self.value_format, "page": self.page}
+
+
+class Layout:
+    """
+    The fields drawn on each certificate.
+
+    Rows are sequences of CSV cells (or a plain string for a single-field
+    layout), and Layout.values() turns a row into the tuple of texts drawn,
+    one per field. The name field's text names the output file.
+    """
+
+    def __init__(self, fields, name_field=0):
+        """
+        Args:
+            fields: List of Field
+            name_field: Index in fields of the field whose text names the certificate
+        """
+        if not fields:
+            raise ValueError("A layout needs at least one field")
+        if not 0 <= name_field < len(fields):
+            raise ValueError(f"Invalid name field: {name_field}")
+        if any(field.page < 0 for field in fields):
+            raise ValueError("Page indices start at 0")
+        self.fields = fields
+        self.name_field = name_field
+        # Template pages that receive text, in order; the others are copied as they are
+        self.pages = sorted({field.page for field in fields})
+        self.register_fonts()
+
+    @classmethod
+    def single(cls, font_settings, position):
+        """Return the layout of a single name drawn with the given settings (rows are names)."""
+        return cls([Field(0, position, font_settings)])
+
+    @property
+    def is_single(self):
+        """True for a plain name layout (see single())."""
+        field = self.fields[0]
+        return (len(self.fields) == 1 and field.column == 0 and field.value_format == "{value}"
+                and field.page == 0)
+
+    def register_fonts(self):
+        """
+        Register the font files of the fields with ReportLab (see fonts.register_font).
+
+        Done when the layout is created; worker processes that receive a copy
+        of the layout call it again.
+
+        Raises:
+            ValueError: If a font file cannot be used
+        """
+        register_fonts(field.font_settings for field in self.fields)
+
+    def bind(self, header):
+        """
+        Return the layout with header names resolved to column indices.
+
+        Args:
+            header: List of the CSV header cells
+
+        Raises:
+            ValueError: If a column is not in the header
+        """
+        header = [cell.strip() for cell in header]
+        fields = []
+        for field in self.fields:
+            column = field.column
+            if isinstance(column, str):
+                if column not in header:
+                    raise ValueError(f"Column '{column}' not found in CSV header")
+                column = header.index(column)
+            fields.append(Field(column, field.position, field.font_settings, field.value_format, field.page))
+        return Layout(fields, self.name_field)
+
+    def fields_on(self, page):
+        """Return the indices of the fields drawn on a template page."""
+        return [i for i, field in enumerate(self.fields) if field.page == page]
+
+    def check_pages(self, page_count):
+        """
+        Check that every field targets a page of the template.
+
+        Args:
+            page_count: Number of pages of the template
+
+        Raises:
+            ValueError: If a field targets a page past the end of the template
+        """
+        if self.pages[-1] >= page_count:
+            raise ValueError(f"The layout draws on page {self.pages[-1] + 1}, "
+                             f"but the template has {page_count} page(s)")
+
+    def values(self, row):
+        """
+        Return the texts drawn for a row, one per field.
+
+        Args:
+            row: List of CSV cells (missing cells are empty), or a string for a single-field layout
+        """
+        if isinstance(row, str):
+            row = (row,)
+        return tuple(field.value_format.format(value=row[field.column] if field.column < len(row) else "")
+                     for field in self.fields)
+
+    def has_name(self, row):
+        """Return True if the row's name field cell is not empty (see utils.iter_names_from_csv)."""
+        if isinstance(row, str):
+            row = (row,)
+        column = self.fields[self.name_field].column
+        return column < len(row) and bool(row[column].strip())
+
+    def name(self, values):
+        """Return the name of a certificate from its values (used for file names and progress)."""
+        return values[self.name_field]
+
+    def key(self, values):
+        """Return the texts of a certificate as one string (the name for a single-field layout, see Manifest)."""
+        return "\x1f".join(values)
+
+    def font_sizes(self, batch):
+        """
+        Return the font sizes of a batch of values, auto-fitted per field (see metrics.fit_size).
+
+        Args:
+            batch: List of values tuples
+
+        Returns:
+            List of font size tuples, in the order of batch
+        """
+        columns = [fit_font_sizes([values[i] for values in batch], field.font_settings)
+                   for i, field in enumerate(self.fields)]
+        return list(zip(*columns))
+
+    def settings(self):
+        """Return everything that affects the drawing, as JSON-compatible data (see manifest.batch_key)."""
+        if self.is_single:
+            # Same as before layouts existed, so manifests of plain name batches stay valid
+            field = self.fields[0]
+            return {"font": field.font_settings, "position": list(field.position)}
+        return {"fields": [field.settings() for field in self.fields], "name_field": self.name_field}
+
+
+def load_layout(path):
+    """
+    Read a layout file.
+
+    The file is JSON with a list of fields; each field names its CSV column
+    (index, or header name when the CSV has a header), the position of the
+    text center and optionally its font settings, format and template page
+    (index, 0 by default). The font is a base-14 family or the path of a
+    TrueType font file (.ttf, or .otf with TrueType outlines):
+
+        {"name_field": 0,
+         "fields": [{"column": "name", "x": 420, "y": 300, "size": 32, "bold": true, "max_width": 500},
+                    {"column": "course", "x": 420, "y": 240, "font": "Helvetica", "size": 16,
+                     "format": "for completing {value}"},
+                    {"column": "id", "x": 300, "y": 60, "size": 9, "page": 1}]}
+
+    Args:
+        path: Path to the layout file
+
+    Returns:
+        Layout instance
+    """
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
+
+    fields = [Field(entry["column"], (entry["x"], entry["y"]), parse_font_settings(entry),
+                    entry.get("format", "{value}"), entry.get("page", 0))
+              for entry in spec["fields"]]
+    return Layout(fields, spec.get("name_field", 0))
+
+
+def parse_font_settings(options):
+    """
+    Return the font settings of a field from its layout options.
+
+    Args:
+        options: Dictionary with the keys of FONT_DEFAULTS (missing ones take their default)
+
+    Returns:
+        Font settings dictionary (family, size, bold, italic, color, max_width, min_size)
+    """
+    options = {key: options.get(key, default) for key, default in FONT_DEFAULTS.items()}
+    return {
+        "family": resolve_font_name(options["font"], options["bold"], options["italic"]),
+        "size": options["size"],
+        "bold": options["bold"],
+        "italic": options["italic"],
+        "color": options["color"],
+        "max_width": options["max_width"],
+        "min_size": options["min_size"],
+    }
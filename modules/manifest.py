@@ -0,0 +1,102 @@
+# manifest.py
+
+import hashlib
+import json
+import os
+
+from modules.utils import atomic_open
+
+# Manifest file written next to the certificates
+MANIFEST_FILENAME = ".signit-manifest.json"
+MANIFEST_VERSION = 1
+
+# Number of new entries after which the manifest is saved during a batch
+SAVE_INTERVAL = 100
+
+
+def batch_key(template_digest, settings):
+    """
+    Return the hash of everything that affects a certificate except its texts.
+
+    Args:
+        template_digest: SHA-256 hex digest of the template PDF bytes
+        settings: JSON-compatible layout settings (see Layout.settings)
+
+    Returns:
+        SHA-256 hex digest
+    """
+    settings = json.dumps(settings, sort_keys=True)
+    return hashlib.sha256(f"{template_digest}\0{settings}".encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    """
+    Records which certificates in an output folder are up to date.
+
+    Each entry maps a certificate file name to a hash of the batch settings
+    (template bytes, layout) and the certificate's texts, plus the file size.
+    A certificate is current when its entry matches and the file on disk still
+    has the recorded size, so re-runs only regenerate changed or missing ones.
+    """
+
+    def __init__(self, output_dir, key):
+        """
+        Args:
+            output_dir: Folder with the certificates and the manifest
+            key: Batch key (see batch_key)
+        """
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.key = key
+        self.entries = {}
+        self._unsaved = 0
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.entries = data.get("certificates", {})
+            except (OSError, ValueError):
+                # An unreadable manifest only means everything is regenerated
+                self.entries = {}
+
+    def _name_hash(self, name):
+        return hashlib.sha256(f"{self.key}\0{name}".encode("utf-8")).hexdigest()
+
+    def is_current(self, name, output_path):
+        """
+        Return True if the certificate at output_path is up to date for the name.
+
+        Args:
+            name: Texts on the certificate (the name, see Layout.key)
+            output_path: Path of the certificate
+        """
+        entry = self.entries.get(os.path.basename(output_path))
+        if entry is None or entry.get("hash") != self._name_hash(name):
+            return False
+        try:
+            return os.path.getsize(output_path) == entry.get("size")
+        except OSError:
+            return False
+
+    def record(self, name, output_path):
+        """
+        Record a freshly written certificate, saving the manifest every SAVE_INTERVAL entries.
+
+        Args:
+            name: Texts on the certificate (the name, see Layout.key)
+            output_path: Path of the certificate
+        """
+        self.entries[os.path.basename(output_path)] = {
+            "hash": self._name_hash(name),
+            "size": os.path.getsize(output_path),
+        }
+        self._unsaved += 1
+        if self._unsaved >= SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """Write the manifest atomically."""
+        with atomic_open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "certificates": self.entries}, f, indent=1)
+        self._unsaved = 0
@@ -0,0 +1,130 @@
+# metrics.py
+#
+# Text measurement for the base-14 and TrueType fonts without a ReportLab
+# canvas. Widths come from per-font glyph tables built once per process, so
+# measuring a whole batch of names is a dictionary lookup per character.
+
+from functools import lru_cache
+
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+# Cp1252 bytes that have no character (WinAnsi leaves them undefined too)
+_UNDEFINED_CP1252 = (0x81, 0x8D, 0x8F, 0x90, 0x9D)
+
+
+@lru_cache(maxsize=None)
+def glyph_widths(font_name):
+    """
+    Return the glyph-width table of a font.
+
+    Args:
+        font_name: ReportLab font name
+
+    Returns:
+        Dictionary mapping characters to widths in 1/1000 em, or None when the
+        font is neither TrueType nor WinAnsi-encoded (widths then come from
+        pdfmetrics.stringWidth)
+    """
+    font = pdfmetrics.getFont(font_name)
+    if isinstance(font, TTFont):
+        # Characters missing from the font are measured by stringWidth, with the font's default width
+        return {chr(code): width for code, width in font.face.charWidths.items()}
+    if font.encoding.name != "WinAnsiEncoding":
+        return None
+
+    return {bytes([code]).decode("cp1252"): width
+            for code, width in enumerate(font.widths) if code not in _UNDEFINED_CP1252}
+
+
+def text_width(text, font_name, font_size):
+    """
+    Return the width of the text in points (same result as canvas.stringWidth).
+
+    Args:
+        text: Text to measure
+        font_name: ReportLab font name
+        font_size: Font size in points
+    """
+    widths = glyph_widths(font_name)
+    if widths is not None:
+        try:
+            return sum(map(widths.__getitem__, text)) * font_size / 1000
+        except KeyError:
+            # Characters outside the encoding are drawn with substitution fonts, measured once each
+            return sum(widths[char] if char in widths else fallback_width(font_name, char)
+                       for char in text) * font_size / 1000
+    return pdfmetrics.stringWidth(text, font_name, font_size)
+
+
+@lru_cache(maxsize=None)
+def fallback_width(font_name, char):
+    """Return the width in 1/1000 em of a character missing from a font's glyph table (see text_width)."""
+    return pdfmetrics.stringWidth(char, font_name, 1000)
+
+
+def text_widths(names, font_name, font_size):
+    """
+    Return the widths in points of a batch of names.
+
+    Args:
+        names: Sequence of names
+        font_name: ReportLab font name
+        font_size: Font size in points
+
+    Returns:
+        List of widths, in the order of names
+    """
+    return [text_width(name, font_name, font_size) for name in names]
+
+
+def fit_size(width_at_size, font_settings):
+    """
+    Return the font size that fits a text into the font settings' maximum width.
+
+    Args:
+        width_at_size: Width of the text at font_settings["size"]
+        font_settings: Dictionary with "size" and optionally "max_width" and "min_size"
+
+    Returns:
+        Font size in points: the configured size when the text fits or auto-fit is
+        off, otherwise the largest smaller size that fits, never below min_size
+    """
+    font_size = font_settings["size"]
+    max_width = font_settings.get("max_width")
+    if not max_width or width_at_size <= max_width:
+        return font_size
+
+    min_size = font_settings.get("min_size") or 0
+    return max(font_size * max_width / width_at_size, min_size)
+
+
+def fit_font_size(name, font_settings):
+    """
+    Return the font size for one name (see fit_size).
+
+    Args:
+        name: Name text
+        font_settings: Dictionary with font settings
+    """
+    if not font_settings.get("max_width"):
+        return font_settings["size"]
+    return fit_size(text_width(name, font_settings["family"], font_settings["size"]), font_settings)
+
+
+def fit_font_sizes(names, font_settings):
+    """
+    Return the font sizes for a batch of names (see fit_size).
+
+    Args:
+        names: Sequence of names
+        font_settings: Dictionary with font settings
+
+    Returns:
+        List of font sizes, in the order of names
+    """
+    if not font_settings.get("max_width"):
+        return [font_settings["size"]] * len(names)
+
+    widths = text_widths(names, font_settings["family"], font_settings["size"])
+    return [fit_size(width, font_settings) for width in widths]
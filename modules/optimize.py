@@ -0,0 +1,188 @@
+# optimize.py
+#
+# Output size optimizations. The template is rewritten once per batch (every
+# certificate shares its objects), so the per-certificate cost is only the
+# compression of the merged content stream (see CompiledTemplate.stamp).
+
+import hashlib
+import io
+import zlib
+
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.filters import ASCII85Decode, ASCIIHexDecode
+from PyPDF2.generic import (ArrayObject, DictionaryObject, EncodedStreamObject, IndirectObject, NameObject,
+                            NullObject, StreamObject)
+
+# zlib level used for streams that are (re)compressed once per template
+COMPRESSION_LEVEL = 9
+
+# Text encodings that only make binary streams bigger
+ASCII_FILTERS = {"/ASCII85Decode": ASCII85Decode, "/ASCIIHexDecode": ASCIIHexDecode}
+
+
+def optimize_template(template):
+    """
+    Return the template PDF rewritten to be smaller, without visual change.
+
+    Streams are stored Flate-compressed without ASCII encodings, and objects
+    with identical contents (fonts, images, ICC profiles) are merged into one.
+    Only objects reachable from the pages are kept.
+
+    Args:
+        template: Path to the template PDF, or a file-like object
+
+    Returns:
+        Bytes of the optimized PDF
+    """
+    writer = PdfWriter()
+    for page in PdfReader(template).pages:
+        writer.add_page(page)
+
+    compress_streams(writer)
+    dedupe_objects(writer)
+
+    # Merged duplicates are no longer referenced; copying the pages again leaves them out
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    buffer.seek(0)
+
+    output = PdfWriter()
+    for page in PdfReader(buffer).pages:
+        output.add_page(page)
+
+    buffer = io.BytesIO()
+    output.write(buffer)
+    return buffer.getvalue()
+
+
+def compress_streams(writer):
+    """
+    Store every stream of a writer in its smallest Flate form.
+
+    Uncompressed streams are compressed, ASCII encodings are removed and
+    Flate streams are recompressed at COMPRESSION_LEVEL, whenever that makes
+    them smaller. Other filters (images in DCT, JBIG2...) are left alone.
+
+    Returns:
+        Number of bytes saved
+    """
+    saved = 0
+    for i, obj in enumerate(writer._objects):
+        if not isinstance(obj, StreamObject):
+            continue
+
+        old_size = len(obj._data)
+        filters, params, data = _strip_ascii_filters(obj)
+        try:
+            if not filters:
+                compressed = zlib.compress(data, COMPRESSION_LEVEL)
+                if len(compressed) < len(data):
+                    filters, data = ["/FlateDecode"], compressed
+            elif filters == ["/FlateDecode"] and params is None:
+                # Streams with predictors (DecodeParms) keep their compressed data
+                compressed = zlib.compress(zlib.decompress(data), COMPRESSION_LEVEL)
+                if len(compressed) < len(data):
+                    data = compressed
+        except zlib.error:
+            continue
+
+        if len(data) >= old_size:
+            continue
+
+        stream = EncodedStreamObject()
+        stream.update((key, value) for key, value in obj.items() if key not in ("/Filter", "/DecodeParms", "/Length"))
+        if filters:
+            stream[NameObject("/Filter")] = (NameObject(filters[0]) if len(filters) == 1
+                                             else ArrayObject(NameObject(f) for f in filters))
+        if params is not None:
+            stream[NameObject("/DecodeParms")] = params
+        stream._data = data
+        writer._objects[i] = stream
+        saved += old_size - len(data)
+
+    return saved
+
+
+def _strip_ascii_filters(obj):
+    """
+    Decode the leading ASCII encodings of a stream.
+
+    Returns:
+        Tuple (remaining filter names, remaining DecodeParms or None, data encoded with those filters)
+    """
+    filters = obj.get("/Filter")
+    if filters is None:
+        return [], None, obj.get_data()
+    filters = [str(filters)] if isinstance(filters, NameObject) else [str(f) for f in filters]
+
+    data = obj._data
+    params = obj.get("/DecodeParms")
+    while filters and filters[0] in ASCII_FILTERS:
+        if isinstance(params, ArrayObject):
+            if params and not isinstance(params[0], NullObject):
+                break
+            params = ArrayObject(params[1:])
+        elif params is not None:
+            # A single DecodeParms dictionary belongs to the single filter
+            break
+        data = ASCII_FILTERS[filters.pop(0)].decode(data)
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+
+    if isinstance(params, ArrayObject) and all(isinstance(p, NullObject) for p in params):
+        params = None
+    return filters, params, data
+
+
+def dedupe_objects(writer):
+    """
+    Point every reference to an object at the first object with the same contents.
+
+    Repeated until nothing changes, since merging children can make their
+    parents identical. Duplicates are replaced by null objects, left for
+    optimize_template to drop.
+
+    Returns:
+        Number of objects merged
+    """
+    merged = 0
+    while True:
+        canonical = {}
+        mapping = {}
+        for i, obj in enumerate(writer._objects):
+            if isinstance(obj, NullObject) or (isinstance(obj, DictionaryObject)
+                                               and obj.get("/Type") in ("/Page", "/Pages")):
+                continue
+            buffer = io.BytesIO()
+            obj.write_to_stream(buffer, None)
+            digest = hashlib.sha256(buffer.getvalue()).digest()
+            if digest in canonical:
+                mapping[i + 1] = canonical[digest]
+            else:
+                canonical[digest] = i + 1
+
+        if not mapping:
+            return merged
+
+        for obj in writer._objects:
+            _replace_references(obj, mapping, writer)
+        for idnum in mapping:
+            writer._objects[idnum - 1] = NullObject()
+        merged += len(mapping)
+
+
+def _replace_references(obj, mapping, writer):
+    """Rewrite in place the indirect references of obj listed in mapping."""
+    if isinstance(obj, DictionaryObject):
+        items = obj.items()
+    elif isinstance(obj, ArrayObject):
+        items = enumerate(obj)
+    else:
+        return
+
+    for key, value in list(items):
+        if isinstance(value, IndirectObject):
+            if value.idnum in mapping:
+                obj[key] = IndirectObject(mapping[value.idnum], 0, writer)
+        else:
+            _replace_references(value, mapping, writer)
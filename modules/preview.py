@@ -0,0 +1,191 @@
+# preview.py
+#
+# PyMuPDF, PIL and the processor are imported by the first render, on the
+# preview worker thread, so the GUI window appears without waiting for them.
+
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+
+def pdf_to_image(pdf, dpi=100, alpha=False):
+    """
+    Convert the first page of a PDF to a PIL Image using PyMuPDF (fitz).
+    PyMuPDF is a pure Python library that doesn't need external dependencies.
+
+    Args:
+        pdf: Path to the PDF file, or its bytes
+        dpi: Resolution of the output image
+        alpha: Keep a transparent background (RGBA image)
+
+    Returns:
+        PIL Image object
+    """
+    import fitz  # PyMuPDF
+    from PIL import Image
+
+    try:
+        # Open the PDF file with PyMuPDF
+        if isinstance(pdf, bytes):
+            pdf_document = fitz.open(stream=pdf, filetype="pdf")
+        else:
+            pdf_document = fitz.open(pdf)
+
+        # Get the first page
+        first_page = pdf_document[0]
+
+        # Calculate zoom factor based on DPI
+        zoom_factor = dpi / 72.0  # 72 points per inch
+
+        # Get the pixel matrix with the specified zoom
+        pixmap = first_page.get_pixmap(matrix=fitz.Matrix(zoom_factor, zoom_factor), alpha=alpha)
+
+        # Convert to PIL Image
+        img = Image.frombytes("RGBA" if alpha else "RGB", [pixmap.width, pixmap.height], pixmap.samples)
+
+        # Close the PDF document
+        pdf_document.close()
+
+        return img
+
+    except Exception as e:
+        raise Exception(f"Error converting PDF to image: {str(e)}")
+
+
+class PreviewRenderer:
+    """
+    Renders certificate previews from a cached template raster.
+
+    The template is rasterized once per template file and DPI; each preview
+    then only rasterizes the name overlay (the same one generate_certificates
+    merges) and composites it onto a copy of the cached bitmap.
+    """
+
+    def __init__(self, max_templates=4):
+        """
+        Args:
+            max_templates: Number of (template, DPI) rasters kept in the cache
+        """
+        self.max_templates = max_templates
+        self._rasters = OrderedDict()
+
+    def template_image(self, template_path, dpi=100):
+        """
+        Return the rasterized template, from the cache when possible.
+
+        The cache key includes the file's modification time, so an edited
+        template is rasterized again.
+
+        Args:
+            template_path: Path to the template PDF
+            dpi: Resolution of the image
+
+        Returns:
+            PIL Image object (shared, do not modify)
+        """
+        key = (os.path.abspath(template_path), os.path.getmtime(template_path), dpi)
+        if key in self._rasters:
+            self._rasters.move_to_end(key)
+            return self._rasters[key]
+
+        image = pdf_to_image(template_path, dpi)
+        self._rasters[key] = image
+        if len(self._rasters) > self.max_templates:
+            self._rasters.popitem(last=False)
+        return image
+
+    def render(self, template_path, name, font_settings, position, dpi=100):
+        """
+        Render a preview of the certificate for a name.
+
+        Args:
+            template_path: Path to the template PDF
+            name: Name text to add
+            font_settings: Dictionary with font settings
+            position: (x, y) position in points (the center of the text)
+            dpi: Resolution of the image
+
+        Returns:
+            PIL Image object
+        """
+        from modules.processor import render_name_overlay
+
+        template_image = self.template_image(template_path, dpi)
+        text_layer = pdf_to_image(render_name_overlay(name, font_settings, position), dpi, alpha=True)
+
+        # Both pages share the bottom-left origin; images are top-left based
+        offset_y = template_image.height - text_layer.height
+
+        image = template_image.copy()
+        image.paste(text_layer, (0, offset_y), text_layer)
+        return image
+
+
+class LatestJobWorker:
+    """
+    Runs jobs on a background thread, keeping only the most recent request.
+
+    submit() replaces any job that has not started yet, so a burst of
+    requests renders only the last one. Results are collected in a queue that
+    the GUI drains from the Tk main loop (see CertificateSignerGUI), and each
+    carries the job id it was submitted with so stale results can be dropped.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = None
+        self._busy = False
+        self._results = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="preview-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, job_id, func, *args):
+        """
+        Schedule func(*args), replacing any job still waiting to run.
+
+        Args:
+            job_id: Identifier returned with the result
+            func: Callable to run on the worker thread
+            args: Arguments for func
+        """
+        with self._condition:
+            self._pending = (job_id, func, args)
+            self._condition.notify()
+
+    @property
+    def idle(self):
+        """True when no job is running or waiting."""
+        with self._condition:
+            return self._pending is None and not self._busy
+
+    def results(self):
+        """
+        Return the finished jobs without blocking.
+
+        Returns:
+            List of (job_id, result, error) tuples; error is None on success
+        """
+        finished = []
+        while True:
+            try:
+                finished.append(self._results.get_nowait())
+            except queue.Empty:
+                return finished
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                job_id, func, args = self._pending
+                self._pending = None
+                self._busy = True
+
+            try:
+                self._results.put((job_id, func(*args), None))
+            except Exception as e:
+                self._results.put((job_id, None, e))
+            finally:
+                with self._condition:
+                    self._busy = False
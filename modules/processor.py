@@ -1,56 +1,844 @@
 # processor.py
 
+import hashlib
+import io
 import os
 import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.lib.pagesizes import letter
+from PyPDF2 import PageObject, PdfReader, PdfWriter
 from reportlab.pdfgen import canvas
 
+from modules.archive import ArchiveWriter
+from modules.combined import CombinedWriter
+from modules.instrumentation import EventRecorder, replay, timed
+from modules.layout import Layout
+from modules.manifest import Manifest, batch_key
+from modules.metrics import fit_font_size
+from modules.optimize import optimize_template
+from modules.signing import CHECKSUMS_FILENAME, ChecksumFile
+from modules.stamper import OVERLAY_BOX, OverlayStamper, TextStamper
+from modules.utils import atomic_open
+from modules.validation import validate_certificates
 
-def generate_certificates(pdf_template_path, names_list, font_settings, position, output_dir, output_filename=None):
+# Default file name of the single multi-page output
+COMBINED_FILENAME = "certificates.pdf"
+
+# Default file name of the ZIP archive output
+ARCHIVE_FILENAME = "certificates.zip"
+
+# Number of rows measured at a time when auto-fitting font sizes
+FIT_BATCH_SIZE = 1024
+
+# Chunks submitted ahead per worker process in parallel mode (keeps workers busy, bounds memory)
+PENDING_CHUNKS = 2
+
+
+class CompiledTemplate:
+    """
+    A template PDF parsed once and reused for every certificate in a batch.
+
+    The parsed reader (page tree, fonts, images) is shared by all outputs.
+    Each certificate is stamped onto a shallow copy of a template page, so
+    the cached pages themselves are never modified. When some pages receive
+    no text, they are serialized once instead (see overlay_stamper) and
+    copied into every output as bytes.
+
+    With optimize, the template is first rewritten smaller (see
+    modules.optimize.optimize_template) and the merged content stream of each
+    certificate is compressed.
+    """
+
+    def __init__(self, template_path, optimize=False):
+        self.path = template_path
+        self.optimized = optimize
+        if optimize:
+            self.reader = PdfReader(io.BytesIO(optimize_template(template_path)))
+        else:
+            self.reader = PdfReader(template_path)
+        self.pages = list(self.reader.pages)
+        self.page = self.pages[0]
+        self._digest = None
+        self._overlay_stampers = {}
+
+    @property
+    def digest(self):
+        """SHA-256 hex digest of the template bytes (already in memory, the file is not reopened)."""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.reader.stream.getvalue()).hexdigest()
+        return self._digest
+
+    def stamp(self, overlay_page, index=0):
+        """
+        Return a new page with the overlay merged on top of a template page.
+
+        Args:
+            overlay_page: PageObject to draw on top of the template page
+            index: Index of the template page
+
+        Returns:
+            PageObject sharing the template's resources
+        """
+        template_page = self.pages[index]
+        page = PageObject(self.reader, template_page.indirect_reference)
+        page.update(template_page)
+        page.merge_page(overlay_page)
+        if self.optimized:
+            # Before the page is added to a writer, so the uncompressed stream is not written too
+            page.compress_content_streams()
+        return page
+
+    def overlay_stamper(self, pages):
+        """
+        Return the OverlayStamper merging overlays onto the given pages, created once per set of pages.
+
+        Args:
+            pages: Template pages the overlay pages are merged onto, in order
+        """
+        pages = tuple(pages)
+        if pages not in self._overlay_stampers:
+            self._overlay_stampers[pages] = OverlayStamper(self, pages)
+        return self._overlay_stampers[pages]
+
+
+def load_template(pdf_template, optimize=False):
+    """
+    Return a CompiledTemplate for the given template.
+
+    Args:
+        pdf_template: Path to the PDF template or an already compiled template (returned as is)
+        optimize: Optimize the output size (see CompiledTemplate)
+
+    Returns:
+        CompiledTemplate instance
+    """
+    if isinstance(pdf_template, CompiledTemplate):
+        return pdf_template
+    return CompiledTemplate(pdf_template, optimize)
+
+
+class BatchGenerationError(Exception):
+    """
+    Raised after a parallel batch finishes when some certificates failed.
+
+    Attributes:
+        failures: List of (index, name, error message) tuples, in input order
+        generated_files: Paths of the certificates that were generated
+    """
+
+    def __init__(self, failures, generated_files):
+        self.failures = failures
+        self.generated_files = generated_files
+        details = "; ".join(f"{name}: {error}" for _, name, error in failures[:5])
+        super().__init__(f"{len(failures)} certificate(s) failed: {details}")
+
+
+def generate_certificates(pdf_template_path, names_list, font_settings, position, output_dir, output_filename=None,
+                          in_memory=True, workers=None, chunk_size=16, engine="reportlab", combined=False,
+                          progress_callback=None, cancel_event=None, incremental=False, instrumentation=None,
+                          optimize=False, archive=None, layout=None, signer=None, dry_run=False):
     """
     Generate certificates for each name using the PDF template.
 
     Args:
-        pdf_template_path: Path to the PDF template
-        names_list: List of names (strings)
-        font_settings: Dictionary with font settings (family, size, color)
-        position: Tuple (x, y) in PDF coordinates (origin at bottom-left)
+        pdf_template_path: Path to the PDF template (or a CompiledTemplate)
+        names_list: Iterable of names (strings), consumed lazily (e.g. utils.iter_names_from_csv).
+            With a layout, iterable of CSV rows (lists of cells, e.g. utils.iter_rows_from_csv)
+        font_settings: Dictionary with font settings (family, size, color). With "max_width" (points),
+            names wider than that are drawn smaller to fit, down to "min_size". Ignored with a layout
+        position: Tuple (x, y) in PDF coordinates (origin at bottom-left). Ignored with a layout
         output_dir: Output directory for the generated certificates
         output_filename: Optional specific filename for the output (used for preview)
+        in_memory: Render overlays into memory buffers (set to False to fall back to temporary files)
+        workers: Number of worker processes (None generates serially in this process)
+        chunk_size: Number of names sent to a worker process at a time
+        engine: "reportlab" (overlay + merge) or "direct" (content-stream stamping, see TextStamper)
+        combined: Write a single PDF with one page per name (output_filename, or certificates.pdf)
+            instead of one file per name
+        progress_callback: Optional function called as progress_callback(done, name) after each name
+        cancel_event: Optional threading.Event; once set, the batch stops after the current certificate
+        incremental: Skip certificates that are already up to date according to the manifest in output_dir
+            (see modules.manifest), and record the new ones
+        instrumentation: Optional modules.instrumentation.Instrumentation receiving stage timings and
+            counters (e.g. a RunStats, whose summary() reports latency percentiles and the slowest names)
+        optimize: Write smaller files: the template is compressed and deduplicated once, and each
+            certificate's content stream is compressed (see modules.optimize)
+        archive: "stored" or "deflated" to write the certificates into a single ZIP archive
+            (output_filename, or certificates.zip) instead of one file per name
+        layout: Optional modules.layout.Layout drawing several CSV columns, all in a single overlay;
+            its name field names the files and is reported to progress_callback
+        signer: Optional modules.signing.Signer (see load_signer) adding a digital signature to every
+            certificate (to the single PDF in combined mode). A SHA256SUMS file with the SHA-256 of every
+            output is written next to them (inside the archive in archive mode)
+        dry_run: Only lay out every name, without creating any file, and report the names that
+            overflow or have characters the font cannot draw (see modules.validation)
 
     Returns:
-        List of paths to the generated certificates
+        List of paths to the generated certificates (a single path in combined and archive modes).
+        When cancelled, only the certificates written so far (the archive holds them). Use
+        iter_certificates to get the results as they complete, without keeping a list.
+        With dry_run, a modules.validation.ValidationReport instead.
+
+    Raises:
+        BatchGenerationError: In parallel mode, after the whole batch ran, if any name failed
     """
+    if dry_run:
+        if layout is None:
+            layout = Layout.single(font_settings, position)
+        return validate_certificates(names_list, layout, load_template(pdf_template_path, optimize))
+
+    _check_options(workers, combined, incremental, archive)
+
     generated_files = []
+    failures = []
+    for index, name, result, error in _iter_batch(
+            pdf_template_path, names_list, font_settings, position, output_dir, output_filename, in_memory, workers,
+            chunk_size, engine, combined, progress_callback, cancel_event, incremental, instrumentation, optimize,
+            archive, layout, signer, raise_errors=True):
+        if error is not None:
+            failures.append((index, name, error))
+        elif not (combined or archive):
+            generated_files.append(result)
+
+    if combined or archive:
+        generated_files = [_output_file(output_dir, output_filename, combined)]
+    if failures:
+        raise BatchGenerationError(failures, generated_files)
+
+    return generated_files
 
-    for i, name in enumerate(names_list):
-        # Create a PDF overlay with the name
-        overlay_pdf_path = create_name_overlay(name, font_settings, position)
 
-        # Determine output filename
-        if output_filename and len(names_list) == 1:
-            # Use specified filename (for preview)
-            output_path = os.path.join(output_dir, output_filename)
+def iter_certificates(pdf_template_path, names_list, font_settings, position, output_dir, output_filename=None,
+                      in_memory=True, workers=None, chunk_size=16, engine="reportlab", combined=False,
+                      progress_callback=None, cancel_event=None, incremental=False, instrumentation=None,
+                      optimize=False, archive=None, layout=None, signer=None):
+    """
+    Generate certificates like generate_certificates, yielding each result as it completes.
+
+    Nothing grows with the number of names: the names are read lazily, at most
+    a few chunks per worker process are in flight and no list of paths is
+    kept, so any iterable (e.g. millions of CSV rows) runs in bounded memory.
+    Only incremental runs keep one manifest entry per certificate.
+
+    Failed certificates are yielded with their error instead of being raised,
+    and the batch carries on. Closing the generator early (or cancel_event)
+    stops the batch after the certificates being generated.
+
+    Args:
+        Same as generate_certificates
+
+    Yields:
+        Tuples (index, name, path, error), in input order: path is the certificate's path (the single
+        output file in combined and archive modes, complete once the generator finishes) and error is
+        None, or path is None and error is the error message
+    """
+    _check_options(workers, combined, incremental, archive)
+    return _iter_batch(pdf_template_path, names_list, font_settings, position, output_dir, output_filename,
+                       in_memory, workers, chunk_size, engine, combined, progress_callback, cancel_event,
+                       incremental, instrumentation, optimize, archive, layout, signer, raise_errors=False)
+
+
+def _check_options(workers, combined, incremental, archive):
+    """Raise ValueError for options that cannot be combined."""
+    if combined:
+        if workers:
+            raise ValueError("Combined output is written by a single process")
+        if incremental:
+            raise ValueError("Combined output is always written in full")
+        if archive:
+            raise ValueError("Combined output cannot be archived")
+    if archive and incremental:
+        raise ValueError("Archives are always written in full")
+
+
+def _output_file(output_dir, output_filename, combined):
+    """Return the path of the single output file of combined and archive modes."""
+    return os.path.join(output_dir, output_filename or (COMBINED_FILENAME if combined else ARCHIVE_FILENAME))
+
+
+def _iter_batch(pdf_template_path, names_list, font_settings, position, output_dir, output_filename, in_memory,
+                workers, chunk_size, engine, combined, progress_callback, cancel_event, incremental, instrumentation,
+                optimize, archive, layout, signer, raise_errors):
+    """Run a batch with the chosen output mode, yielding (index, name, path, error) (see iter_certificates)."""
+    if layout is None:
+        layout = Layout.single(font_settings, position)
+
+    if instrumentation is not None:
+        instrumentation.run_started()
+
+    try:
+        output_path = None
+        if combined:
+            output_path = _output_file(output_dir, output_filename, combined)
+            with timed(instrumentation, "load"):
+                template = load_template(pdf_template_path, optimize)
+            results = _generate_combined(template, names_list, layout, output_path, progress_callback,
+                                         cancel_event, instrumentation, raise_errors, signer)
+        elif archive:
+            output_path = _output_file(output_dir, output_filename, combined)
+            results = _generate_archive(pdf_template_path, names_list, layout, output_path, archive, in_memory,
+                                        workers, chunk_size, engine, progress_callback, cancel_event,
+                                        instrumentation, optimize, raise_errors, signer)
+        elif workers:
+            results = _generate_parallel(pdf_template_path, names_list, layout, output_dir, in_memory, workers,
+                                         chunk_size, engine, progress_callback, cancel_event, incremental,
+                                         instrumentation, optimize, signer=signer)
         else:
-            # Generate filename from name
-            safe_name = "".join(c if c.isalnum() or c in " -_" else "_" for c in name)
-            output_path = os.path.join(output_dir, f"certificate_{safe_name}.pdf")
+            results = _generate_serial(pdf_template_path, names_list, layout, output_dir, output_filename,
+                                       in_memory, engine, progress_callback, cancel_event, incremental,
+                                       instrumentation, optimize, raise_errors, signer)
+
+        if signer is not None and not archive:
+            # The archive lists its certificates' checksums itself
+            results = _checksummed(results, os.path.join(output_dir, CHECKSUMS_FILENAME), output_path)
+        yield from results
+    finally:
+        if instrumentation is not None:
+            instrumentation.run_finished()
+
+
+def _checksummed(results, checksums_path, output_path=None):
+    """
+    Yield the results of a batch, writing the SHA-256 of its outputs to a checksum file (see ChecksumFile).
+
+    Args:
+        results: Iterator of (index, name, path, error) tuples
+        checksums_path: Path of the checksum file
+        output_path: Single output file (combined mode), hashed once the batch is complete
+    """
+    with ChecksumFile(checksums_path) as checksums:
+        for result in results:
+            if output_path is None and result[3] is None:
+                checksums.add_file(result[2])
+            yield result
+        if output_path is not None:
+            checksums.add_file(output_path)
 
-        # Merge the overlay with the template
-        merge_pdfs(pdf_template_path, overlay_pdf_path, output_path)
 
+def _generate_serial(pdf_template_path, names_list, layout, output_dir, output_filename, in_memory, engine,
+                     progress_callback=None, cancel_event=None, incremental=False, instrumentation=None,
+                     optimize=False, raise_errors=True, signer=None):
+    """Generate certificates one after the other in this process, yielding (index, name, path, error)."""
+    if output_filename:
+        # The specified filename is only used for a single name (the preview)
+        names_list = list(names_list)
+        if len(names_list) != 1:
+            output_filename = None
+
+    # Parse the template only once for the whole batch
+    with timed(instrumentation, "load"):
+        template = load_template(pdf_template_path, optimize)
+    write_certificate = _certificate_writer(template, layout, in_memory, engine, instrumentation, signer)
+    manifest = _load_manifest(template, layout, output_dir, signer) if incremental else None
+
+    try:
+        for index, (values, font_sizes) in enumerate(_sized(names_list, layout)):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+
+            name = layout.name(values)
+            # Determine output filename
+            if output_filename:
+                # Use specified filename (for preview)
+                output_path = os.path.join(output_dir, output_filename)
+            else:
+                output_path = certificate_path(name, output_dir)
+
+            error = None
+            if manifest is None or not manifest.is_current(layout.key(values), output_path):
+                try:
+                    write_certificate(values, output_path, font_sizes)
+                except Exception as e:
+                    if raise_errors:
+                        raise
+                    output_path, error = None, str(e)
+                    if instrumentation is not None:
+                        instrumentation.count("failed")
+                else:
+                    if manifest is not None:
+                        manifest.record(layout.key(values), output_path)
+            elif instrumentation is not None:
+                instrumentation.count("skipped")
+
+            if progress_callback is not None:
+                progress_callback(index + 1, name)
+
+            yield index, name, output_path, error
+    finally:
+        # Keep what was generated, even if the batch stopped half way
+        if manifest is not None:
+            manifest.save()
+
+
+def generate_certificate(template, name, font_settings, position, output_path, in_memory=True, font_size=None,
+                         instrumentation=None):
+    """
+    Generate a single certificate.
+
+    Args:
+        template: CompiledTemplate (or path to the PDF template)
+        name: Name text to add
+        font_settings: Dictionary with font settings
+        position: (x, y) position in points (the center of the text)
+        output_path: Path where to save the certificate
+        in_memory: Render the overlay into memory instead of a temporary file
+        font_size: Font size for this name (default: auto-fitted from the font settings)
+        instrumentation: Optional Instrumentation timing the overlay, merge and write stages
+    """
+    _write_certificate(template, Layout.single(font_settings, position), (name,), output_path, in_memory,
+                       None if font_size is None else (font_size,), instrumentation)
+
+
+def _write_certificate(template, layout, values, output_path, in_memory=True, font_sizes=None,
+                       instrumentation=None):
+    """Write a certificate with every field of the layout drawn in a single overlay (see generate_certificate)."""
+    # Create a PDF overlay with the texts
+    with timed(instrumentation, "overlay"):
+        if in_memory:
+            overlay = render_overlay(layout, values, font_sizes)
+        else:
+            overlay = create_overlay(layout, values, font_sizes)
+
+    try:
+        # Merge the overlay with the template
+        if instrumentation is None:
+            merge_pdfs(template, overlay, output_path, layout.pages)
+        else:
+            with instrumentation.stage("merge"):
+                data = _merge(template, overlay, layout.pages)
+            with instrumentation.stage("write"), atomic_open(output_path) as f:
+                f.write(data)
+    finally:
         # Remove temporary overlay file
-        if os.path.exists(overlay_pdf_path):
-            os.remove(overlay_pdf_path)
+        if not in_memory and os.path.exists(overlay):
+            os.remove(overlay)
 
-        generated_files.append(output_path)
 
-    return generated_files
+def _certificate_writer(template, layout, in_memory, engine, instrumentation=None, signer=None):
+    """Return a function (values, output_path, font_sizes=None) that writes one certificate with the chosen engine."""
+    layout.check_pages(len(template.pages))
+    if signer is not None:
+        # The certificate is signed in memory, then written
+        render = _render_function(template, layout, in_memory, engine, instrumentation, signer)
+
+        def write_certificate(values, output_path, font_sizes=None):
+            data = render(values, font_sizes)
+            with timed(instrumentation, "write"), atomic_open(output_path) as f:
+                f.write(data)
+    elif engine == "reportlab":
+        def write_certificate(values, output_path, font_sizes=None):
+            _write_certificate(template, layout, values, output_path, in_memory, font_sizes, instrumentation)
+    elif engine == "direct":
+        stamper = TextStamper(template, layout)
+
+        def write_certificate(values, output_path, font_sizes=None):
+            if not stamper.supports(values):
+                # ReportLab substitutes glyphs the font cannot encode
+                _write_certificate(template, layout, values, output_path, in_memory, font_sizes, instrumentation)
+            elif instrumentation is None:
+                stamper.write(values, output_path, font_sizes)
+            else:
+                with instrumentation.stage("render"):
+                    data = stamper.render(values, font_sizes)
+                with instrumentation.stage("write"), atomic_open(output_path) as f:
+                    f.write(data)
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
+
+    if instrumentation is None:
+        return write_certificate
+
+    def write_instrumented(values, output_path, font_sizes=None):
+        start = time.perf_counter()
+        write_certificate(values, output_path, font_sizes)
+        instrumentation.certificate(layout.name(values), time.perf_counter() - start)
+        instrumentation.count("generated")
+        instrumentation.count("bytes_written", os.path.getsize(output_path))
+
+    return write_instrumented
+
+
+def render_certificate(template, name, font_settings, position, in_memory=True, font_size=None,
+                       instrumentation=None):
+    """
+    Generate a single certificate in memory.
+
+    Args:
+        template: CompiledTemplate (or path to the PDF template)
+        name: Name text to add
+        font_settings: Dictionary with font settings
+        position: (x, y) position in points (the center of the text)
+        in_memory: Render the overlay into memory instead of a temporary file
+        font_size: Font size for this name (default: auto-fitted from the font settings)
+        instrumentation: Optional Instrumentation timing the overlay and merge stages
+
+    Returns:
+        Bytes of the certificate PDF
+    """
+    return _render_certificate(template, Layout.single(font_settings, position), (name,), in_memory,
+                               None if font_size is None else (font_size,), instrumentation)
+
 
+def _render_certificate(template, layout, values, in_memory=True, font_sizes=None, instrumentation=None):
+    """Render a certificate with every field of the layout drawn in a single overlay (see render_certificate)."""
+    with timed(instrumentation, "overlay"):
+        if in_memory:
+            overlay = render_overlay(layout, values, font_sizes)
+        else:
+            overlay = create_overlay(layout, values, font_sizes)
+
+    try:
+        with timed(instrumentation, "merge"):
+            return _merge(template, overlay, layout.pages)
+    finally:
+        if not in_memory and os.path.exists(overlay):
+            os.remove(overlay)
+
+
+def certificate_renderer(template, layout, engine="reportlab", in_memory=True, signer=None):
+    """
+    Return a function (values, font_sizes=None) that renders one certificate of a layout to bytes.
+
+    The template is prepared for the engine once (see TextStamper), so a
+    long-running process can keep the function and render certificates one at
+    a time at batch speed (see modules.server).
 
-def create_name_overlay(name, font_settings, position):
+    Args:
+        template: CompiledTemplate (or path to the PDF template)
+        layout: modules.layout.Layout with the fields to draw
+        engine: "reportlab" or "direct"
+        in_memory: Render overlays into memory instead of temporary files
+        signer: Optional modules.signing.Signer signing every certificate
+    """
+    return _certificate_renderer(load_template(template), layout, in_memory, engine, signer=signer)
+
+
+def _certificate_renderer(template, layout, in_memory, engine, instrumentation=None, signer=None):
+    """Return a function (values, font_sizes=None) that renders one certificate to bytes with the chosen engine."""
+    layout.check_pages(len(template.pages))
+    render = _render_function(template, layout, in_memory, engine, instrumentation, signer)
+    if instrumentation is None:
+        return render
+
+    def render_instrumented(values, font_sizes=None):
+        start = time.perf_counter()
+        data = render(values, font_sizes)
+        instrumentation.certificate(layout.name(values), time.perf_counter() - start)
+        instrumentation.count("generated")
+        return data
+
+    return render_instrumented
+
+
+def _render_function(template, layout, in_memory, engine, instrumentation=None, signer=None):
+    """Return a function (values, font_sizes=None) rendering one certificate to bytes, signed if a signer is given."""
+    if engine == "reportlab":
+        def render(values, font_sizes=None):
+            return _render_certificate(template, layout, values, in_memory, font_sizes, instrumentation)
+    elif engine == "direct":
+        stamper = TextStamper(template, layout)
+
+        def render(values, font_sizes=None):
+            if not stamper.supports(values):
+                # ReportLab substitutes glyphs the font cannot encode
+                return _render_certificate(template, layout, values, in_memory, font_sizes, instrumentation)
+            with timed(instrumentation, "render"):
+                return stamper.render(values, font_sizes)
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
+
+    if signer is None:
+        return render
+
+    def render_signed(values, font_sizes=None):
+        data = render(values, font_sizes)
+        with timed(instrumentation, "sign"):
+            return signer.sign(data)
+
+    return render_signed
+
+
+def _generate_archive(pdf_template_path, names_list, layout, output_path, compression, in_memory, workers,
+                      chunk_size, engine, progress_callback=None, cancel_event=None, instrumentation=None,
+                      optimize=False, raise_errors=True, signer=None):
+    """Write the certificates into a ZIP archive as they are rendered, yielding (index, name, path, error)."""
+    # A cancelled or failed batch still leaves a valid archive with the certificates written so far
+    try:
+        with ArchiveWriter(output_path, compression, checksums=signer is not None) as writer:
+            if workers:
+                for index, name, _, error in _generate_parallel(
+                        pdf_template_path, names_list, layout, None, in_memory, workers, chunk_size, engine,
+                        progress_callback, cancel_event, instrumentation=instrumentation, optimize=optimize,
+                        archive=writer, signer=signer):
+                    yield index, name, output_path if error is None else None, error
+                return
+
+            with timed(instrumentation, "load"):
+                template = load_template(pdf_template_path, optimize)
+            render = _certificate_renderer(template, layout, in_memory, engine, instrumentation, signer)
+
+            for index, (values, font_sizes) in enumerate(_sized(names_list, layout)):
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+
+                name = layout.name(values)
+                error = None
+                try:
+                    data = render(values, font_sizes)
+                except Exception as e:
+                    if raise_errors:
+                        raise
+                    error = str(e)
+                    if instrumentation is not None:
+                        instrumentation.count("failed")
+                else:
+                    with timed(instrumentation, "write"):
+                        writer.add(archive_name(name), data)
+
+                if progress_callback is not None:
+                    progress_callback(index + 1, name)
+
+                yield index, name, output_path if error is None else None, error
+    finally:
+        if instrumentation is not None and os.path.exists(output_path):
+            instrumentation.count("bytes_written", os.path.getsize(output_path))
+
+
+def _generate_combined(template, names_list, layout, output_path, progress_callback=None, cancel_event=None,
+                       instrumentation=None, raise_errors=True, signer=None):
+    """Write every certificate as pages of a single PDF sharing the template artwork, yielding (index, name, path, error)."""
+    layout.check_pages(len(template.pages))
+    # A cancelled batch still leaves a valid document with the pages written so far
+    with CombinedWriter(template, layout, output_path, signer) as writer:
+        for index, (values, font_sizes) in enumerate(_sized(names_list, layout)):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+
+            name = layout.name(values)
+            start = time.perf_counter() if instrumentation is not None else None
+            error = None
+            try:
+                if writer.supports(values):
+                    writer.add_values(values, font_sizes)
+                else:
+                    with timed(instrumentation, "overlay"):
+                        overlay = render_overlay(layout, values, font_sizes)
+                    writer.add_overlay(overlay)
+            except Exception as e:
+                if raise_errors:
+                    raise
+                error = str(e)
+
+            if instrumentation is not None:
+                if error is None:
+                    instrumentation.certificate(name, time.perf_counter() - start)
+                    instrumentation.count("generated")
+                else:
+                    instrumentation.count("failed")
+
+            if progress_callback is not None:
+                progress_callback(index + 1, name)
+
+            yield index, name, output_path if error is None else None, error
+
+    if instrumentation is not None:
+        instrumentation.count("bytes_written", os.path.getsize(output_path))
+
+
+def _sized(rows, layout, batch_size=FIT_BATCH_SIZE):
+    """
+    Yield (values, font sizes) pairs, one size per field, measuring the rows a batch at a time.
+
+    Rows are still consumed lazily; only batch_size of them are held at once.
+    """
+    rows = iter(rows)
+    while True:
+        batch = [layout.values(row) for row in islice(rows, batch_size)]
+        if not batch:
+            return
+        yield from zip(batch, layout.font_sizes(batch))
+
+
+def _load_manifest(template, layout, output_dir, signer=None):
+    """Return the manifest of output_dir for this batch's settings."""
+    settings = layout.settings()
+    if signer is not None:
+        # Certificates signed with another key, or not signed, are regenerated
+        settings = dict(settings, signer=signer.fingerprint)
+    return Manifest(output_dir, batch_key(template.digest, settings))
+
+
+def archive_name(name):
+    """Return the file name of a name's certificate inside an archive (as in certificate_path)."""
+    return os.path.basename(certificate_path(name, ""))
+
+
+def certificate_path(name, output_dir):
+    """
+    Return the output path for a name's certificate.
+
+    Args:
+        name: Name text on the certificate
+        output_dir: Output directory for the generated certificates
+
+    Returns:
+        Path of the form <output_dir>/certificate_<safe name>.pdf
+    """
+    # Generate filename from name
+    safe_name = "".join(c if c.isalnum() or c in " -_" else "_" for c in name)
+    return os.path.join(output_dir, f"certificate_{safe_name}.pdf")
+
+
+# Per-process state of the pool workers, set once by _init_worker
+_worker_state = {}
+
+
+def _init_worker(template_path, layout, in_memory, engine, instrumented=False, optimize=False, archive=False,
+                 signer=None):
+    """Load the template (and, through the pickled signer, the signing key) once in each worker process."""
+    # Font files are registered again in workers that did not inherit the main process's fonts
+    layout.register_fonts()
+    # Events are recorded here and replayed by the main process (see _worker_generate)
+    recorder = EventRecorder() if instrumented else None
+    with timed(recorder, "load"):
+        template = load_template(template_path, optimize)
+    _worker_state["recorder"] = recorder
+    if archive:
+        _worker_state["render"] = _certificate_renderer(template, layout, in_memory, engine, recorder, signer)
+    else:
+        _worker_state["write"] = _certificate_writer(template, layout, in_memory, engine, recorder, signer)
+
+
+def _worker_generate(job):
+    """
+    Generate one certificate in a worker, returning (index, values, result, error, written, events).
+
+    The result is the output path, or the certificate bytes when the job has no
+    output path (archive mode, the main process adds them to the archive).
+    """
+    index, values, font_sizes, output_path, skip = job
+    recorder = _worker_state["recorder"]
+    result = output_path
+    if skip:
+        error, written = None, False
+    else:
+        try:
+            if output_path is None:
+                result = _worker_state["render"](values, font_sizes)
+            else:
+                _worker_state["write"](values, output_path, font_sizes)
+            error, written = None, True
+        except Exception as e:
+            result, error, written = None, str(e), False
+    events = recorder.drain() if recorder is not None else None
+    return index, values, result, error, written, events
+
+
+def _worker_generate_chunk(jobs):
+    """Generate a chunk of certificates in a worker (see _worker_generate)."""
+    return [_worker_generate(job) for job in jobs]
+
+
+def _generate_parallel(pdf_template_path, names_list, layout, output_dir, in_memory, workers, chunk_size, engine,
+                       progress_callback=None, cancel_event=None, incremental=False, instrumentation=None,
+                       optimize=False, archive=None, signer=None):
+    """
+    Generate certificates on a process pool, yielding (index, name, path, error) in input order.
+
+    Failures are yielded with the worker's error message. With an
+    ArchiveWriter, workers return the certificates' bytes and they are added
+    to the archive in input order (output_dir is not used; path is the name
+    inside the archive).
+    """
+    manifest = None
+    if incremental:
+        # The manifest lives in this process; workers are only told which names to skip
+        with timed(instrumentation, "load"):
+            pdf_template_path = load_template(pdf_template_path, optimize)
+        manifest = _load_manifest(pdf_template_path, layout, output_dir, signer)
+
+    if isinstance(pdf_template_path, CompiledTemplate):
+        # Each worker compiles (and optimizes) the template again
+        optimize = pdf_template_path.optimized
+        pdf_template_path = pdf_template_path.path
+    elif layout.pages[-1] > 0:
+        # Fail here rather than in every worker's initializer
+        layout.check_pages(len(PdfReader(pdf_template_path).pages))
+
+    def jobs():
+        # Sizes are fitted here, in batches, so workers only draw
+        for i, (values, font_sizes) in enumerate(_sized(names_list, layout)):
+            output_path = certificate_path(layout.name(values), output_dir) if archive is None else None
+            skip = manifest is not None and manifest.is_current(layout.key(values), output_path)
+            yield i, values, font_sizes, output_path, skip
+
+    chunks = _chunks(jobs(), chunk_size)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(pdf_template_path, layout, in_memory, engine, instrumentation is not None,
+                                           optimize, archive is not None, signer)) as executor:
+            # Unlike map(), only a few chunks per worker are submitted ahead, so
+            # memory does not grow with the number of names
+            pending = deque(executor.submit(_worker_generate_chunk, chunk)
+                            for chunk in islice(chunks, workers * PENDING_CHUNKS))
+            try:
+                while pending:
+                    # Results are taken in input order
+                    results = pending.popleft().result()
+                    if cancel_event is None or not cancel_event.is_set():
+                        chunk = next(chunks, None)
+                        if chunk is not None:
+                            pending.append(executor.submit(_worker_generate_chunk, chunk))
+
+                    for index, values, output_path, error, written, events in results:
+                        name = layout.name(values)
+                        if error is None and archive is not None:
+                            # The worker returned the certificate's bytes
+                            data = output_path
+                            with timed(instrumentation, "write"):
+                                output_path = archive.add(archive_name(name), data)
+                        if error is None and written and manifest is not None:
+                            manifest.record(layout.key(values), output_path)
+
+                        if instrumentation is not None:
+                            replay(events, instrumentation)
+                            if error is not None:
+                                instrumentation.count("failed")
+                            elif not written:
+                                instrumentation.count("skipped")
+
+                        if progress_callback is not None:
+                            progress_callback(index + 1, name)
+
+                        yield index, name, output_path, error
+
+                        if cancel_event is not None and cancel_event.is_set():
+                            return
+            finally:
+                # Chunks already running finish; queued ones are dropped
+                for future in pending:
+                    future.cancel()
+    finally:
+        # Keep what was generated, even if the batch stopped half way
+        if manifest is not None:
+            manifest.save()
+
+
+def _chunks(iterable, size):
+    """Yield lists of up to size items of an iterable, consuming it lazily."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def create_name_overlay(name, font_settings, position, font_size=None):
     """
     Create a PDF with transparent background and only the name at the specified position.
 
@@ -58,6 +846,25 @@ def create_name_overlay(name, font_settings, position):
         name: Name text to add
         font_settings: Dictionary with font settings
         position: (x, y) position in points (the center of the text)
+        font_size: Font size for this name (default: auto-fitted from the font settings)
+
+    Returns:
+        Path to the temporary PDF file created
+    """
+    return create_overlay(Layout.single(font_settings, position), (name,),
+                          None if font_size is None else (font_size,))
+
+
+def create_overlay(layout, values, font_sizes=None):
+    """
+    Create a PDF with transparent background and every field of the layout.
+
+    The overlay has a page for each template page that receives text (see Layout.pages).
+
+    Args:
+        layout: modules.layout.Layout with the fields to draw
+        values: Texts of the fields (see Layout.values)
+        font_sizes: Font size of each field (default: auto-fitted from the font settings)
 
     Returns:
         Path to the temporary PDF file created
@@ -67,11 +874,72 @@ def create_name_overlay(name, font_settings, position):
     os.close(fd)
 
     # Create a new PDF with ReportLab
-    c = canvas.Canvas(temp_path, pagesize=letter)
+    c = canvas.Canvas(temp_path, pagesize=OVERLAY_BOX[2:])
+    _draw_fields(c, layout, values, font_sizes)
+
+    # Save the PDF
+    c.save()
+
+    return temp_path
+
+
+def render_name_overlay(name, font_settings, position, font_size=None):
+    """
+    Create the name overlay PDF in memory, without touching the filesystem.
+
+    Args:
+        name: Name text to add
+        font_settings: Dictionary with font settings
+        position: (x, y) position in points (the center of the text)
+        font_size: Font size for this name (default: auto-fitted from the font settings)
+
+    Returns:
+        Bytes of the overlay PDF
+    """
+    return render_overlay(Layout.single(font_settings, position), (name,),
+                          None if font_size is None else (font_size,))
+
+
+def render_overlay(layout, values, font_sizes=None):
+    """
+    Create the overlay PDF of every field of the layout in memory, in a single pass.
+
+    The overlay has a page for each template page that receives text (see Layout.pages).
+
+    Args:
+        layout: modules.layout.Layout with the fields to draw
+        values: Texts of the fields (see Layout.values)
+        font_sizes: Font size of each field (default: auto-fitted from the font settings)
+
+    Returns:
+        Bytes of the overlay PDF
+    """
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=OVERLAY_BOX[2:])
+    _draw_fields(c, layout, values, font_sizes)
+    c.save()
+
+    return buffer.getvalue()
 
+
+def _draw_fields(c, layout, values, font_sizes=None):
+    """Draw the text of every field of the layout on a ReportLab canvas, one canvas page per target page."""
+    if font_sizes is None:
+        font_sizes = (None,) * len(layout.fields)
+    for number, page in enumerate(layout.pages):
+        if number:
+            c.showPage()
+        for i in layout.fields_on(page):
+            field = layout.fields[i]
+            _draw_name(c, values[i], field.font_settings, field.position, font_sizes[i])
+
+
+def _draw_name(c, name, font_settings, position, font_size=None):
+    """Draw the name centered on the position on a ReportLab canvas."""
     # Set font properties
     font_name = font_settings["family"]
-    font_size = font_settings["size"]
+    if font_size is None:
+        font_size = fit_font_size(name, font_settings)
 
     c.setFont(font_name, font_size)
 
@@ -94,38 +962,94 @@ def create_name_overlay(name, font_settings, position):
     # Draw the text
     c.drawString(x_start, y_start, name)
 
-    # Save the PDF
-    c.save()
-
-    return temp_path
-
 
-def merge_pdfs(template_path, overlay_path, output_path):
+def merge_pdfs(template_path, overlay_path, output_path, pages=(0,)):
     """
     Merge the overlay PDF (with the name) onto the template PDF.
 
     Args:
-        template_path: Path to the template PDF
-        overlay_path: Path to the overlay PDF with the name
+        template_path: Path to the template PDF or a CompiledTemplate
+        overlay_path: Path to the overlay PDF with the name, or its bytes / file-like buffer
         output_path: Path where to save the merged PDF
+        pages: Template pages the overlay pages are merged onto, in order (see merge_overlay)
     """
-    # Read the PDFs
-    template_pdf = PdfReader(template_path)
+    data = _merge(template_path, overlay_path, pages)
+
+    # Write the output file (atomically, an interrupted run leaves no truncated PDF)
+    with atomic_open(output_path) as f:
+        f.write(data)
+
+
+def compare_output_size(pdf_template_path, name, font_settings, position, layout=None):
+    """
+    Return the size of one certificate without and with output optimization.
+
+    Args:
+        pdf_template_path: Path to the PDF template
+        name: Name text to add (a CSV row with a layout)
+        font_settings: Dictionary with font settings (ignored with a layout)
+        position: (x, y) position in points (the center of the text, ignored with a layout)
+        layout: Optional modules.layout.Layout (see generate_certificates)
+
+    Returns:
+        Tuple (bytes without optimization, bytes with optimization)
+    """
+    if layout is None:
+        layout = Layout.single(font_settings, position)
+    overlay = render_overlay(layout, layout.values(name))
+    sizes = []
+    for optimize in (False, True):
+        sizes.append(len(_merge(CompiledTemplate(pdf_template_path, optimize), overlay, layout.pages)))
+    return tuple(sizes)
+
+
+def merge_overlay(template_path, overlay_path, pages=(0,)):
+    """
+    Return a PdfWriter with the overlay PDF merged onto the template pages.
+
+    Every template page is written; pages that get no overlay page are taken
+    as they are from the parsed template. Certificates are written with
+    _merge, which copies such pages as pre-serialized bytes instead.
+
+    Args:
+        template_path: Path to the template PDF or a CompiledTemplate
+        overlay_path: Path to the overlay PDF with the name, or its bytes / file-like buffer
+        pages: Template pages the overlay pages are merged onto, in order
+
+    Returns:
+        PdfWriter holding the certificate pages, ready to be written
+    """
+    # Read the PDFs (a compiled template is reused as is)
+    template = load_template(template_path)
+    if isinstance(overlay_path, bytes):
+        overlay_path = io.BytesIO(overlay_path)
     overlay_pdf = PdfReader(overlay_path)
 
     # Create a PDF writer
     output_pdf = PdfWriter()
 
-    # Merge the first pages
-    template_page = template_pdf.pages[0]
-    overlay_page = overlay_pdf.pages[0]
+    overlays = dict(zip(pages, overlay_pdf.pages))
+    for index, template_page in enumerate(template.pages):
+        if index in overlays:
+            # Add the overlay content to a copy of the template page
+            template_page = template.stamp(overlays[index], index)
+        output_pdf.add_page(template_page)
+
+    return output_pdf
 
-    # Add the overlay content to the template page
-    template_page.merge_page(overlay_page)
 
-    # Add the merged page to the output
-    output_pdf.add_page(template_page)
+def _merge(template_path, overlay_path, pages=(0,)):
+    """
+    Return the bytes of the certificate with the overlay merged onto the template pages (see merge_overlay).
+
+    Templates with pages that receive no text go through the template's
+    OverlayStamper, so those pages are not copied and re-serialized by
+    PdfWriter for every certificate.
+    """
+    template = load_template(template_path)
+    if len(pages) < len(template.pages):
+        return template.overlay_stamper(pages).render(overlay_path)
 
-    # Write the output file
-    with open(output_path, "wb") as f:
-        output_pdf.write(f)
+    buffer = io.BytesIO()
+    merge_overlay(template, overlay_path, pages).write(buffer)
+    return buffer.getvalue()
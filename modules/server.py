@@ -0,0 +1,501 @@
+# server.py
+#
+# Long-running job server for certificates requested one at a time, e.g. by a
+# registration system as attendees check out. Interpreter start-up, imports,
+# template parsing and font loading are paid once; each job then reuses the
+# compiled templates, renderers and font files kept in LRU caches. Jobs are
+# queued and run one at a time on a single thread, which owns the caches.
+#
+#   python main.py serve [--port 8765]
+#
+#   POST /render  {"template": "t.pdf", "name": "Jane Doe"}                 -> the certificate PDF
+#   POST /batch   {"template": "t.pdf", "names": [...], "output_dir": "out"} -> JSON summary
+#   GET  /stats                                      -> cache hit rates, queue depth, latency
+#
+# Requests must come from this machine: POST bodies must be sent as
+# application/json (so a web page cannot send one without a CORS preflight),
+# a browser Origin must be local, and the Host header must name the loopback
+# address (against DNS rebinding). Job paths must be inside the server's roots.
+
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlsplit
+
+from modules.fonts import register_font, unregister_font
+from modules.instrumentation import percentile
+from modules.layout import Layout, load_layout, parse_font_settings
+from modules.processor import (ARCHIVE_FILENAME, COMBINED_FILENAME, archive_name, certificate_renderer,
+                               iter_certificates, load_template)
+from modules.utils import ensure_dir, is_font_file
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Default number of compiled templates and of font files kept loaded
+TEMPLATE_CACHE_SIZE = 8
+FONT_CACHE_SIZE = 16
+
+# Renderers (template, layout and engine combinations) kept per cached template
+RENDERERS_PER_TEMPLATE = 4
+
+# Number of recent jobs the latency percentiles are computed over
+LATENCY_WINDOW = 1000
+
+# Largest request body accepted, in bytes
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+# Text position of requests without a layout (the command line's default)
+DEFAULT_POSITION = (300, 400)
+
+# Host names accepted in the Host and Origin headers
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+class LRUCache:
+    """
+    A bounded cache that evicts its least recently used entry, with hit and miss counters.
+
+    Not thread-safe: the job server only uses it from its job thread.
+    """
+
+    def __init__(self, max_size, on_evict=None):
+        """
+        Args:
+            max_size: Number of entries kept
+            on_evict: Optional function (key, value) called for every entry removed
+        """
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, load):
+        """
+        Return the entry for key, creating it with load() on a miss.
+
+        Raises:
+            Whatever load() raises (nothing is cached then)
+        """
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        value = load()
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._evict(*self._entries.popitem(last=False))
+        return value
+
+    def discard(self, predicate):
+        """Remove the entries whose key matches predicate(key)."""
+        for key in [key for key in self._entries if predicate(key)]:
+            self._evict(key, self._entries.pop(key))
+
+    def _evict(self, key, value):
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def stats(self):
+        """Return the size and counters of the cache, as JSON-compatible data."""
+        lookups = self.hits + self.misses
+        return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class CertificateService:
+    """
+    Renders certificate jobs with warm caches (the state behind CertificateServer).
+
+    A template is compiled once per version of its file (path, modification
+    time and size); an edited template replaces its older version. A renderer
+    (see processor.certificate_renderer) is prepared once per template, layout
+    and engine, and dropped with its template. Font files stay registered
+    while they are among the most recently used. A job should not use more
+    font files than the font cache holds.
+
+    Jobs are dictionaries decoded from the request's JSON:
+
+        template     Path of the template PDF (required)
+        name / row   One certificate (/render): a name, or a row of CSV cells (list, or dict by column name)
+        names / rows Several certificates (/batch)
+        layout       Path of a layout file (see layout.load_layout); otherwise the name is drawn at x, y
+                     with the font options of a layout field (font, size, bold, italic, color, max_width,
+                     min_size)
+        engine       "direct" or "reportlab" (default: the server's)
+        optimize     Optimize the output size (see processor.CompiledTemplate)
+        output_dir   Output folder of a batch (required), with combined, archive ("stored"/"deflated")
+                     and incremental as in processor.iter_certificates
+
+    With roots, the template, layout, font and output paths of a job must be
+    inside one of them (symbolic links are resolved first), otherwise the job
+    fails with PermissionError.
+    """
+
+    def __init__(self, engine="direct", templates=TEMPLATE_CACHE_SIZE, fonts=FONT_CACHE_SIZE, signer=None,
+                 roots=None):
+        """
+        Args:
+            engine: Default rendering engine of the jobs
+            templates: Number of compiled templates kept
+            fonts: Number of font files kept registered
+            signer: Optional modules.signing.Signer signing every certificate
+            roots: Optional folders the paths of the jobs must be in (default: any path)
+        """
+        self.engine = engine
+        self.signer = signer
+        self.roots = None if roots is None else [os.path.realpath(root) for root in roots]
+        self.templates = LRUCache(templates, self._template_evicted)
+        self.renderers = LRUCache(templates * RENDERERS_PER_TEMPLATE)
+        self.fonts = LRUCache(fonts, lambda path, _: unregister_font(path))
+
+    def template(self, path, optimize=False):
+        """
+        Return the compiled template of a file, from the cache when it has not changed.
+
+        Returns:
+            Tuple (cache key, CompiledTemplate)
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size, bool(optimize))
+
+        def load():
+            # Older versions of the file are not used any more
+            self.templates.discard(lambda old: old[0] == path and old[1:3] != key[1:3])
+            return load_template(path, optimize)
+
+        return key, self.templates.get(key, load)
+
+    def _template_evicted(self, key, _):
+        self.renderers.discard(lambda renderer_key: renderer_key[0] == key)
+
+    def render(self, job):
+        """Render the single certificate of a job and return its (file name, PDF bytes)."""
+        template_key, template = self.template(self._path(_require(job, "template")), job.get("optimize", False))
+        header, rows = _rows(job, "name", "row")
+        if len(rows) != 1:
+            raise ValueError("A render job has a single 'name' or 'row' (use /batch for several)")
+        layout = self._layout(job, header)
+        engine = job.get("engine", self.engine)
+
+        key = (template_key, json.dumps(layout.settings(), sort_keys=True), engine)
+        render = self.renderers.get(key, lambda: certificate_renderer(template, layout, engine,
+                                                                      signer=self.signer))
+        values = layout.values(rows[0])
+        return archive_name(layout.name(values)), render(values)
+
+    def batch(self, job):
+        """
+        Write the certificates of a job to its output folder.
+
+        Returns:
+            Dictionary with the number generated, the failed rows and the output path
+        """
+        _, template = self.template(self._path(_require(job, "template")), job.get("optimize", False))
+        header, rows = _rows(job, "names", "rows")
+        layout = self._layout(job, header)
+        output_dir = self._path(_require(job, "output_dir"))
+        ensure_dir(output_dir)
+
+        generated = 0
+        failures = []
+        results = iter_certificates(template, (row for row in rows if layout.has_name(row)), None, None, output_dir,
+                                    engine=job.get("engine", self.engine), combined=job.get("combined", False),
+                                    incremental=job.get("incremental", False), archive=job.get("archive"),
+                                    layout=layout, signer=self.signer)
+        for index, name, _, error in results:
+            if error is None:
+                generated += 1
+            else:
+                failures.append({"index": index, "name": name, "error": error})
+
+        output = output_dir
+        if job.get("combined"):
+            output = os.path.join(output_dir, COMBINED_FILENAME)
+        elif job.get("archive"):
+            output = os.path.join(output_dir, ARCHIVE_FILENAME)
+        return {"generated": generated, "failed": failures, "output": output}
+
+    def _layout(self, job, header):
+        """Return the layout of a job, with its font files registered through the font cache."""
+        if "layout" in job:
+            layout = load_layout(self._path(job["layout"])).bind(header)
+        else:
+            layout = Layout.single(parse_font_settings(job), (job.get("x", DEFAULT_POSITION[0]),
+                                                              job.get("y", DEFAULT_POSITION[1])))
+        for field in layout.fields:
+            family = field.font_settings["family"]
+            if is_font_file(family):
+                self._path(family)
+                # Marks the font as used, evicting the least recently used ones
+                self.fonts.get(family, lambda: register_font(family))
+        return layout
+
+    def _path(self, path):
+        """
+        Return a path of a job after checking that it is inside the roots.
+
+        Raises:
+            PermissionError: If the path is outside every root
+        """
+        if not isinstance(path, str):
+            raise ValueError(f"Invalid path: {path!r}")
+        if self.roots is not None:
+            resolved = os.path.realpath(path)
+            if not any(os.path.commonpath((resolved, root)) == root for root in self.roots):
+                raise PermissionError(f"{path} is outside the server's roots")
+        return path
+
+    def stats(self):
+        """Return the cache statistics, as JSON-compatible data."""
+        return {"engine": self.engine, "signing": self.signer is not None,
+                "caches": {"templates": self.templates.stats(), "renderers": self.renderers.stats(),
+                           "fonts": self.fonts.stats()}}
+
+
+class JobQueue:
+    """
+    Runs jobs one at a time on a background thread, in submission order.
+
+    Every job's latency (queue wait included) is kept for the last
+    LATENCY_WINDOW jobs.
+    """
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.running = False
+        self.completed = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name="job-worker", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """Number of jobs waiting to run."""
+        return self._jobs.qsize()
+
+    def submit(self, func, *args):
+        """
+        Schedule func(*args).
+
+        Returns:
+            concurrent.futures.Future with the result of the job
+        """
+        future = Future()
+        self._jobs.put((time.perf_counter(), future, func, args))
+        return future
+
+    def _run(self):
+        while True:
+            submitted, future, func, args = self._jobs.get()
+            self.running = True
+            try:
+                result = func(*args)
+            except Exception as e:
+                failed = True
+                future.set_exception(e)
+            else:
+                failed = False
+                future.set_result(result)
+            finally:
+                self.running = False
+
+            with self._lock:
+                self._latencies.append(time.perf_counter() - submitted)
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+
+    def stats(self):
+        """Return the queue depth, job counters and latency percentiles, as JSON-compatible data."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            completed, failed = self.completed, self.failed
+        return {"queue_depth": self.depth, "running": self.running,
+                "jobs": {"completed": completed, "failed": failed},
+                "latency_ms": {"p50": percentile(latencies, 50) * 1000, "p95": percentile(latencies, 95) * 1000,
+                               "p99": percentile(latencies, 99) * 1000, "window": len(latencies)}}
+
+
+class CertificateServer(ThreadingHTTPServer):
+    """
+    Local HTTP server queueing jobs for a CertificateService (see the routes at the top of the module).
+
+    Connections are handled on their own threads, kept alive between
+    requests, and wait for their job while the job thread works through the
+    queue. Bind it to localhost: paths in the jobs are read and written with
+    the server's permissions. Requests that a web page could send (other
+    content types, foreign Origin or Host headers) are rejected, see the top
+    of the module.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, service, quiet=False):
+        """
+        Args:
+            address: (host, port) to listen on (port 0 picks a free port)
+            service: CertificateService running the jobs
+            quiet: Do not log the requests
+        """
+        super().__init__(address, _RequestHandler)
+        self.service = service
+        self.jobs = JobQueue()
+        self.quiet = quiet
+        port = self.server_address[1]
+        hosts = set(LOCAL_HOSTS)
+        if address[0] not in ("", "0.0.0.0", "::"):
+            # A specific address the server was bound to, e.g. a LAN address
+            hosts.add(address[0])
+        self.allowed_hosts = {f"[{host}]:{port}" if ":" in host else f"{host}:{port}" for host in hosts}
+
+    def stats(self):
+        """Return the statistics reported by /stats."""
+        stats = self.jobs.stats()
+        stats.update(self.service.stats())
+        return stats
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Routes the HTTP requests of a CertificateServer."""
+
+    protocol_version = "HTTP/1.1"
+    # Responses are written in several parts; without this, kept-alive connections wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if not self._check_origin():
+            return
+        if self.path == "/stats":
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Reading a negative length would wait for the client to close the connection
+            self._send_json(400, {"error": "Invalid Content-Length"})
+            self.close_connection = True
+            return
+        if length > MAX_REQUEST_SIZE:
+            self._send_json(413, {"error": f"Request larger than {MAX_REQUEST_SIZE} bytes"})
+            self.close_connection = True
+            return
+        # Read even when the request is refused, so the next request on the connection starts cleanly
+        body = self.rfile.read(length)
+
+        if not self._check_origin():
+            return
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            # Web pages can only send other types without a CORS preflight
+            self._send_json(415, {"error": "The request must be sent as application/json"})
+            return
+
+        routes = {"/render": self.server.service.render, "/batch": self.server.service.batch}
+        if self.path not in routes:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            job = json.loads(body)
+            if not isinstance(job, dict):
+                raise ValueError("The request must be a JSON object")
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        try:
+            result = self.server.jobs.submit(routes[self.path], job).result()
+        except PermissionError as e:
+            self._send_json(403, {"error": str(e)})
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            # Bad paths, options or layout files
+            self._send_json(400, {"error": f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+        else:
+            if self.path == "/render":
+                filename, data = result
+                self._send(200, "application/pdf", data, {
+                    "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"})
+            else:
+                self._send_json(200, result)
+
+    def _check_origin(self):
+        """Return True if the request comes from this machine, otherwise answer it with 403."""
+        host = self.headers.get("Host", "").lower()
+        if host not in self.server.allowed_hosts:
+            # A page on another domain resolving to this address (DNS rebinding)
+            self._send_json(403, {"error": f"Host not allowed: {host}"})
+            return False
+        origin = self.headers.get("Origin")
+        if origin is not None and urlsplit(origin).hostname not in LOCAL_HOSTS:
+            self._send_json(403, {"error": f"Origin not allowed: {origin}"})
+            return False
+        return True
+
+    def _send_json(self, status, data):
+        self._send(status, "application/json", json.dumps(data).encode("utf-8"))
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def _require(job, key):
+    """Return a required value of a job."""
+    if key not in job:
+        raise ValueError(f"Missing '{key}'")
+    return job[key]
+
+
+def _rows(job, name_key, row_key):
+    """
+    Return the CSV header and the rows of a job.
+
+    Names are rows of a single cell. Rows given as dictionaries are turned
+    into lists, with the keys of the first row as the header.
+
+    Returns:
+        Tuple (header list, list of rows)
+    """
+    if name_key in job:
+        names = job[name_key]
+        return [], [[names]] if isinstance(names, str) else [[name] for name in names]
+    rows = _require(job, row_key)
+    if isinstance(rows, (list, dict)) and row_key == "row":
+        rows = [rows]
+    if rows and isinstance(rows[0], dict):
+        header = list(rows[0])
+        return header, [[str(row.get(column, "")) for column in header] for row in rows]
+    return [], rows
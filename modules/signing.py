@@ -0,0 +1,412 @@
+# signing.py
+#
+# PDF digital signatures for the generated certificates, with a local key
+# (PKCS#12, or PEM key and certificates). The key, the certificate chain and
+# every constant part of the CMS signature are loaded once per process (see
+# load_signer); signing a certificate then only appends an incremental update,
+# hashes the file and signs the attributes. Needs the optional "cryptography"
+# package, imported when a signer is loaded.
+
+import hashlib
+import io
+import os
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject
+
+from modules.utils import atomic_open
+
+# File with the SHA-256 of every output, in sha256sum format (sha256sum -c SHA256SUMS)
+CHECKSUMS_FILENAME = "SHA256SUMS"
+
+# Bytes read at a time when hashing files
+HASH_BLOCK_SIZE = 1 << 20
+
+# Extra room in the signature placeholder (ECDSA signatures vary by a few bytes)
+SIGNATURE_SLACK = 32
+
+# Width of each number in the /ByteRange placeholder, and of the whole "0 start end length" entry
+BYTE_RANGE_WIDTH = 10
+BYTE_RANGE_SIZE = 2 + 3 * (BYTE_RANGE_WIDTH + 1)
+
+# Object identifiers of the CMS structures
+OID_DATA = "1.2.840.113549.1.7.1"
+OID_SIGNED_DATA = "1.2.840.113549.1.7.2"
+OID_CONTENT_TYPE = "1.2.840.113549.1.9.3"
+OID_MESSAGE_DIGEST = "1.2.840.113549.1.9.4"
+OID_SIGNING_TIME = "1.2.840.113549.1.9.5"
+OID_SHA256 = "2.16.840.1.101.3.4.2.1"
+OID_RSA = "1.2.840.113549.1.1.1"
+OID_ECDSA_SHA256 = "1.2.840.10045.4.3.2"
+
+
+@lru_cache(maxsize=None)
+def load_signer(key_path, password=None, certificate_path=None):
+    """
+    Return the Signer of a key file, loading it once per process.
+
+    Args:
+        key_path: PKCS#12 file (.p12/.pfx) with the key and certificates, or PEM file with the private key
+            (and optionally the certificates)
+        password: Password of the key file, if it is encrypted
+        certificate_path: PEM/DER file with the signing certificate, then its chain (default: taken from key_path)
+
+    Raises:
+        ImportError: If the cryptography package is not installed
+        ValueError: If the key or certificates cannot be read, or do not match
+    """
+    return Signer(key_path, password, certificate_path)
+
+
+class Signer:
+    """
+    Signs PDFs with a private key and its certificate (adbe.pkcs7.detached).
+
+    Each signature is an invisible signature field added to the first page by
+    an incremental update, so the signed bytes are the certificate as it was
+    rendered. The signer pickles as its file names: a worker process that
+    receives it loads the key once, through load_signer.
+    """
+
+    def __init__(self, key_path, password=None, certificate_path=None):
+        """
+        Args:
+            Same as load_signer (use load_signer, which caches the signer)
+        """
+        try:
+            from cryptography import x509
+            from cryptography.hazmat.primitives import hashes, serialization
+            from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+            from cryptography.hazmat.primitives.serialization import pkcs12
+        except ImportError as e:
+            raise ImportError("Signing needs the 'cryptography' package (pip install cryptography)") from e
+
+        self.key_path = key_path
+        self.password = password
+        self.certificate_path = certificate_path
+
+        with open(key_path, "rb") as f:
+            data = f.read()
+        secret = password.encode("utf-8") if password is not None else None
+        certificates = []
+        try:
+            if key_path.lower().endswith((".p12", ".pfx")):
+                key, certificate, chain = pkcs12.load_key_and_certificates(data, secret)
+                certificates = [certificate] + chain if certificate is not None else chain
+            else:
+                key = serialization.load_pem_private_key(data, secret)
+                if b"-----BEGIN CERTIFICATE-----" in data:
+                    certificates = x509.load_pem_x509_certificates(data)
+            if certificate_path is not None:
+                with open(certificate_path, "rb") as f:
+                    data = f.read()
+                certificates = (x509.load_pem_x509_certificates(data) if b"-----BEGIN" in data
+                                else [x509.load_der_x509_certificate(data)])
+        except (TypeError, ValueError) as e:
+            # cryptography raises TypeError for a missing or unexpected password
+            raise ValueError(f"Cannot read the signing key: {e}") from e
+
+        if key is None or not certificates:
+            raise ValueError("The signing key needs a private key and its certificate")
+        public = serialization.PublicFormat.SubjectPublicKeyInfo
+        if (key.public_key().public_bytes(serialization.Encoding.DER, public)
+                != certificates[0].public_key().public_bytes(serialization.Encoding.DER, public)):
+            raise ValueError("The certificate does not belong to the signing key")
+
+        if isinstance(key, rsa.RSAPrivateKey):
+            self._sign_args = (padding.PKCS1v15(), hashes.SHA256())
+            signature_algorithm = _sequence(_oid(OID_RSA), b"\x05\x00")
+            signature_size = key.key_size // 8
+        elif isinstance(key, ec.EllipticCurvePrivateKey):
+            self._sign_args = (ec.ECDSA(hashes.SHA256()),)
+            signature_algorithm = _sequence(_oid(OID_ECDSA_SHA256))
+            # DER-encoded (r, s): two integers of up to the key size plus a sign byte each
+            signature_size = 2 * (key.key_size // 8 + 3) + 2
+        else:
+            raise ValueError("Only RSA and EC signing keys are supported")
+        self._key = key
+
+        # Constant parts of the CMS signature
+        certificate = certificates[0]
+        self.fingerprint = certificate.fingerprint(hashes.SHA256()).hex()
+        self.subject = certificate.subject.rfc4514_string()
+        self._digest_algorithm = _sequence(_oid(OID_SHA256))
+        self._signature_algorithm = signature_algorithm
+        self._signer_id = _sequence(certificate.issuer.public_bytes(), _integer(certificate.serial_number))
+        self._certificates = _der(0xA0, b"".join(c.public_bytes(serialization.Encoding.DER) for c in certificates))
+        self._content_type = _sequence(_oid(OID_CONTENT_TYPE), _set(_oid(OID_DATA)))
+
+        # Room for the hex-encoded signature in /Contents
+        size = len(self._cms(bytes(32), b"\0" * signature_size, datetime.now(timezone.utc)))
+        self._contents_size = 2 * (size + SIGNATURE_SLACK)
+
+    def __reduce__(self):
+        return load_signer, (self.key_path, self.password, self.certificate_path)
+
+    def sign(self, data):
+        """
+        Return a PDF with a signature added.
+
+        Args:
+            data: Bytes of the PDF
+
+        Returns:
+            Bytes of the signed PDF
+        """
+        buffer = io.BytesIO(data)
+        buffer.seek(0, os.SEEK_END)
+        self._sign(buffer)
+        return buffer.getvalue()
+
+    def sign_file(self, path):
+        """
+        Add a signature to a PDF file in place (the file is hashed in blocks, not read into memory).
+
+        Args:
+            path: Path of the PDF
+        """
+        with open(path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            self._sign(f)
+
+    def _sign(self, f):
+        """Append the signature update to a PDF file object positioned at its end."""
+        end = f.tell()
+        update, contents_offset = self._update(PdfReader(f), _startxref(f, end), end)
+
+        # The signed bytes are everything but the hex string of /Contents
+        contents_start = end + contents_offset
+        contents_end = contents_start + self._contents_size + 2
+        total = end + len(update)
+        byte_range = b"0 %d %d %d" % (contents_start, contents_end, total - contents_end)
+        marker = update.index(b"/ByteRange [") + len(b"/ByteRange [")
+        update = update[:marker] + byte_range.ljust(BYTE_RANGE_SIZE) + update[marker + BYTE_RANGE_SIZE:]
+        f.seek(end)
+        f.write(update)
+
+        digest = hashlib.sha256()
+        for start, length in ((0, contents_start), (contents_end, total - contents_end)):
+            f.seek(start)
+            while length:
+                block = f.read(min(length, HASH_BLOCK_SIZE))
+                digest.update(block)
+                length -= len(block)
+
+        now = datetime.now(timezone.utc)
+        cms = self._cms(digest.digest(), None, now).hex().encode()
+        if len(cms) > self._contents_size:
+            raise ValueError("The signature is larger than its placeholder")
+        f.seek(contents_start + 1)
+        f.write(cms)
+
+    def _update(self, reader, startxref, end):
+        """
+        Return the incremental update adding the signature field, with placeholders.
+
+        Returns:
+            Tuple (update bytes, offset of the /Contents hex string in the update)
+        """
+        trailer = reader.trailer
+        size = trailer["/Size"]
+        signature_id, widget_id = size, size + 1
+        widget = IndirectObject(widget_id, 0, None)
+
+        page_ref = reader.pages[0].indirect_reference
+        page = DictionaryObject(reader.pages[0].items())
+        page[NameObject("/Annots")] = ArrayObject(list(page.get("/Annots", ArrayObject())) + [widget])
+
+        root_ref = trailer.raw_get("/Root")
+        root = DictionaryObject(trailer["/Root"].items())
+        form = DictionaryObject(root["/AcroForm"].items()) if "/AcroForm" in root else DictionaryObject()
+        fields = list(form.get("/Fields", ArrayObject()))
+        form[NameObject("/Fields")] = ArrayObject(fields + [widget])
+        form[NameObject("/SigFlags")] = NumberObject(3)
+        root[NameObject("/AcroForm")] = form
+
+        signed_at = datetime.now(timezone.utc).strftime("D:%Y%m%d%H%M%SZ").encode()
+        objects = {
+            page_ref.idnum: _serialize(page),
+            root_ref.idnum: _serialize(root),
+            signature_id: (b"<<\n/Type /Sig\n/Filter /Adobe.PPKLite\n/SubFilter /adbe.pkcs7.detached\n/M (%s)\n"
+                           b"/ByteRange [%s]\n/Contents <%s>\n>>"
+                           % (signed_at, b" " * BYTE_RANGE_SIZE, b"0" * self._contents_size)),
+            widget_id: (b"<<\n/Type /Annot\n/Subtype /Widget\n/FT /Sig\n/T (Signature%d)\n/F 132\n"
+                        b"/Rect [ 0 0 0 0 ]\n/V %d 0 R\n/P %d 0 R\n>>"
+                        % (len(fields) + 1, signature_id, page_ref.idnum)),
+        }
+
+        update = io.BytesIO()
+        update.write(b"\n")
+        offsets = {}
+        contents_offset = None
+        for idnum, body in objects.items():
+            offsets[idnum] = end + update.tell()
+            if idnum == signature_id:
+                contents_offset = update.tell() + len(b"%d 0 obj\n" % idnum) + body.index(b"/Contents <") + 10
+            update.write(b"%d 0 obj\n" % idnum + body + b"\nendobj\n")
+
+        xref_start = end + update.tell()
+        update.write(b"xref\n")
+        for idnum in sorted(offsets):
+            update.write(b"%d 1\n%010d 00000 n \n" % (idnum, offsets[idnum]))
+        new_trailer = DictionaryObject((key, value) for key, value in trailer.items()
+                                       if key in ("/Root", "/Info", "/ID"))
+        new_trailer[NameObject("/Size")] = NumberObject(size + 2)
+        new_trailer[NameObject("/Prev")] = NumberObject(startxref)
+        update.write(b"trailer\n" + _serialize(new_trailer) + b"\nstartxref\n%d\n%%%%EOF\n" % xref_start)
+        return update.getvalue(), contents_offset
+
+    def _cms(self, digest, signature, signing_time):
+        """
+        Return the DER-encoded CMS SignedData of a document digest.
+
+        Args:
+            digest: SHA-256 of the signed bytes
+            signature: Signature of the attributes to use (None signs them with the key)
+            signing_time: UTC datetime recorded in the signature
+        """
+        attributes = _set(
+            self._content_type,
+            _sequence(_oid(OID_SIGNING_TIME), _set(_der(0x17, signing_time.strftime("%y%m%d%H%M%SZ").encode()))),
+            _sequence(_oid(OID_MESSAGE_DIGEST), _set(_der(0x04, digest))),
+        )
+        if signature is None:
+            # The signature covers the attributes with their SET OF tag
+            signature = self._key.sign(attributes, *self._sign_args)
+
+        signer_info = _sequence(
+            _integer(1), self._signer_id, self._digest_algorithm,
+            b"\xa0" + attributes[1:],  # [0] IMPLICIT
+            self._signature_algorithm, _der(0x04, signature),
+        )
+        signed_data = _sequence(
+            _integer(1), _set(self._digest_algorithm), _sequence(_oid(OID_DATA)),
+            self._certificates, _set(signer_info),
+        )
+        return _sequence(_oid(OID_SIGNED_DATA), _der(0xA0, signed_data))
+
+
+class ChecksumFile:
+    """
+    Writes the SHA-256 of output files in sha256sum format ("<hex>  <file name>").
+
+    Files are hashed as they are added; a file added again (a duplicate name
+    overwrites its certificate) keeps its last digest. close() writes the
+    file atomically. Use it as a context manager, or call close() to finish
+    the file.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: Path of the checksum file (file names are listed relative to its folder)
+        """
+        self.path = path
+        self.digests = {}  # file name -> SHA-256 hex digest
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_file(self, path):
+        """Hash a file and record its digest."""
+        self.digests[os.path.basename(path)] = file_digest(path)
+
+    def close(self):
+        """Write the checksum file."""
+        if self._closed:
+            return
+        self._closed = True
+        with atomic_open(self.path, "w", encoding="utf-8", newline="\n") as f:
+            f.writelines(checksum_line(digest, filename) for filename, digest in self.digests.items())
+
+
+def checksum_line(digest, filename):
+    """Return the sha256sum line of a file."""
+    return f"{digest}  {filename}\n"
+
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def verify_checksums(path):
+    """
+    Check the files listed in a checksum file (see ChecksumFile).
+
+    Args:
+        path: Path of the checksum file
+
+    Returns:
+        List of (file name, problem) tuples for the files that are missing or changed
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    problems = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            digest, _, filename = line.rstrip("\n").partition("  ")
+            try:
+                if file_digest(os.path.join(directory, filename)) != digest:
+                    problems.append((filename, "changed"))
+            except FileNotFoundError:
+                problems.append((filename, "missing"))
+    return problems
+
+
+def _startxref(f, end):
+    """Return the offset of the last cross-reference section of a PDF file object."""
+    f.seek(max(end - 1024, 0))
+    tail = f.read(end - f.tell())
+    return int(tail[tail.rindex(b"startxref") + 9:].split()[0])
+
+
+def _serialize(obj):
+    """Return the bytes of a PyPDF2 object."""
+    buffer = io.BytesIO()
+    obj.write_to_stream(buffer, None)
+    return buffer.getvalue()
+
+
+def _der(tag, content):
+    """Return a DER element."""
+    length = len(content)
+    if length < 0x80:
+        return bytes((tag, length)) + content
+    size = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes((tag, 0x80 | len(size))) + size + content
+
+
+def _sequence(*parts):
+    return _der(0x30, b"".join(parts))
+
+
+def _set(*parts):
+    # DER sorts the elements of a SET OF by their encoding
+    return _der(0x31, b"".join(sorted(parts)))
+
+
+def _integer(value):
+    return _der(0x02, value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True))
+
+
+def _oid(dotted):
+    arcs = [int(arc) for arc in dotted.split(".")]
+    body = bytearray([40 * arcs[0] + arcs[1]])
+    for arc in arcs[2:]:
+        encoded = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            encoded.append(0x80 | (arc & 0x7F))
+            arc >>= 7
+        body.extend(reversed(encoded))
+    return _der(0x06, bytes(body))
@@ -0,0 +1,515 @@
+# stamper.py
+
+import copy
+import io
+from bisect import bisect_left
+
+from PyPDF2 import PageObject, PdfReader, PdfWriter
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, IndirectObject,
+                            NameObject)
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.rl_accel import escapePDF, fp_str
+from reportlab.pdfbase import pdfmetrics
+
+from modules.fonts import EmbeddedFont
+from modules.metrics import fit_font_size, text_width
+from modules.utils import atomic_open, is_font_file
+
+# Marker written into the placeholder text stream of the pre-serialized page
+PLACEHOLDER = b"%SIGNIT-STAMP"
+
+# ReportLab overlays are letter-sized, and merge_page clips them to that box
+# (left, bottom, right, top); every engine clips the text it draws to it
+OVERLAY_BOX = (0, 0) + letter
+OVERLAY_CLIP = b"%s re W n" % fp_str(*OVERLAY_BOX).encode()
+
+
+def read_xref(data):
+    """
+    Parse the classic xref table of a PDF written by PdfWriter.
+
+    Args:
+        data: Bytes of the PDF
+
+    Returns:
+        Tuple (xref offset, list of object offsets for objects 1..n, trailer bytes)
+    """
+    xref_start = int(data[data.rindex(b"startxref\n") + 10:].split()[0])
+    _, _, rest = data[xref_start:].partition(b"\n")
+    count_line, _, rest = rest.partition(b"\n")
+    count = int(count_line.split()[1])
+    entries = rest[:20 * count]
+    trailer = rest[20 * count:rest.index(b"startxref\n")]
+    offsets = [int(entries[20 * i:20 * i + 10]) for i in range(1, count)]
+    return xref_start, offsets, trailer
+
+
+class TextSnippet:
+    """
+    Precomputed text-drawing operators for one font, colour and position.
+
+    WinAnsi-encoded (base-14 text) fonts are handled, and TrueType fonts
+    when the document embeds them (see fonts.EmbeddedFont). Names the font
+    cannot encode are reported by supports() so the caller can fall back to
+    the ReportLab overlay path, which substitutes missing glyphs.
+    """
+
+    def __init__(self, font_settings, position, resource_name, embedded=None):
+        """
+        Args:
+            font_settings: Dictionary with font settings (family, size, color)
+            position: (x, y) position in points (the center of the text)
+            resource_name: Resource name the font is registered under (e.g. "/SignitF1")
+            embedded: fonts.EmbeddedFont of a TrueType font, shared by the snippets of a document
+        """
+        self.font_settings = font_settings
+        self.resource_name = resource_name
+        self.font_name = font_settings["family"]
+        self.font_size = font_settings["size"]
+        self.position = position
+        self.embedded = embedded
+
+        font = pdfmetrics.getFont(self.font_name)
+        self.encodable = embedded is not None or font.encoding.name == "WinAnsiEncoding"
+
+        # Graphics state shared by every name: clip, font and colour (the size can vary per name)
+        self._color_op = b""
+        if font_settings.get("color"):
+            color = font_settings["color"].lstrip('#')
+            rgb = [int(color[i:i + 2], 16) / 255 for i in (0, 2, 4)]
+            self._color_op = fp_str(*rgb).encode() + b" rg "
+
+        self._prefix = b"q " + OVERLAY_CLIP + b" BT "
+
+    def font_dictionary(self):
+        """Return the font resource dictionary to register once (embedded fonts are written by their document)."""
+        font = DictionaryObject()
+        font[NameObject("/Type")] = NameObject("/Font")
+        font[NameObject("/Subtype")] = NameObject("/Type1")
+        font[NameObject("/BaseFont")] = NameObject("/" + self.font_name)
+        if self.encodable:
+            font[NameObject("/Encoding")] = NameObject("/WinAnsiEncoding")
+        return font
+
+    def supports(self, name):
+        """Return True if the name can be drawn with the font's own encoding."""
+        if not self.encodable:
+            return False
+        if self.embedded is not None:
+            # Characters missing from a TrueType font are drawn as its .notdef glyph, like ReportLab does
+            return True
+        try:
+            name.encode("cp1252")
+        except UnicodeEncodeError:
+            return False
+        return True
+
+    def ops(self, name, font_size=None):
+        """
+        Return the content-stream operators that draw the name.
+
+        Args:
+            name: Name text to add (must satisfy supports())
+            font_size: Font size for this name (default: auto-fitted from the font settings)
+
+        Returns:
+            Bytes of a self-contained q ... Q block, centered like create_name_overlay
+        """
+        if font_size is None:
+            font_size = fit_font_size(name, self.font_settings)
+
+        width = text_width(name, self.font_name, font_size)
+        x, y = self.position
+        x_start = x - width / 2
+        y_start = y - font_size / 2
+
+        size = fp_str(font_size).encode()
+        if self.embedded is None:
+            font_op = self.resource_name.encode() + b" " + size + b" Tf "
+            show = b"(" + _escape(name.encode("cp1252")) + b") Tj"
+        else:
+            # One run per font subset the characters fall in
+            font_op = b""
+            show = b" ".join(resource_name + b" " + size + b" Tf (" + _escape(codes) + b") Tj"
+                             for resource_name, codes in self.embedded.encode(name))
+        return (self._prefix + font_op + self._color_op + b"1 0 0 1 "
+                + fp_str(x_start, y_start).encode() + b" Tm " + show + b" ET\nQ\n")
+
+
+class TextStamper:
+    """
+    Direct content-stream stamping engine.
+
+    The template pages, plus the layout's fonts registered once, are
+    serialized a single time with a placeholder text stream on each page that
+    receives text. Each certificate then only replaces those small streams
+    (font, colour, position and the escaped text of every field) and rebuilds
+    the cross-reference table, so neither ReportLab's canvas nor PyPDF2's
+    merge_page runs per certificate, and pages without text are copied as
+    bytes.
+
+    See TextSnippet for the fonts and texts it can handle. TrueType fonts are
+    not embedded here: their certificates take the ReportLab path, which
+    embeds a subset with only the certificate's glyphs.
+    """
+
+    def __init__(self, template, layout):
+        """
+        Args:
+            template: CompiledTemplate to stamp onto
+            layout: modules.layout.Layout with the fields to draw
+        """
+        self._page_fields = {page: layout.fields_on(page) for page in layout.pages}
+        self.texts = font_snippets(layout, self._free_names(template, layout.pages, "/Font", "/SignitF"))
+        self._serialize(template)
+
+    @staticmethod
+    def _free_names(template, pages, category, prefix):
+        """Yield resource names of a category (e.g. "/Font") none of the given template pages use yet."""
+        used = set()
+        for index in pages:
+            resources = template.pages[index].get("/Resources")
+            names = resources.get_object().get(category) if resources is not None else None
+            used.update(names.get_object() if names is not None else ())
+
+        index = 1
+        while True:
+            if f"{prefix}{index}" not in used:
+                yield f"{prefix}{index}"
+            index += 1
+
+    @staticmethod
+    def _add_resources(template_page, category, entries):
+        """Return a copy of a template page's resources with entries added to a category."""
+        resources = template_page.get("/Resources")
+        resources = DictionaryObject(resources.get_object() if resources is not None else {})
+        names = resources.get(category)
+        names = DictionaryObject(names.get_object() if names is not None else {})
+
+        for resource_name, value in entries.items():
+            names[NameObject(resource_name)] = value
+        resources[NameObject(category)] = names
+        return resources
+
+    def _resources(self, template_page, index):
+        """Return a copy of a template page's resources with the fonts added."""
+        return self._add_resources(template_page, "/Font", font_dictionaries(self.texts))
+
+    def _tail(self, index):
+        """Return the stream drawn after a template page's content: its placeholder, replaced per certificate."""
+        placeholder = DecodedStreamObject()
+        placeholder.set_data(PLACEHOLDER + b" %d\n" % index)
+        return placeholder
+
+    def _stamped_page(self, template, index):
+        """Return a copy of a template page ending with the stream drawing its fields."""
+        template_page = template.pages[index]
+        page = PageObject(template.reader, template_page.indirect_reference)
+        page.update(template_page)
+
+        original = template_page.get("/Contents")
+        original = original.get_object() if original is not None else ArrayObject()
+        if not isinstance(original, ArrayObject):
+            original = ArrayObject([template_page.raw_get("/Contents")])
+
+        # Isolate the template's graphics state like merge_page does
+        push = DecodedStreamObject()
+        push.set_data(b"q\n")
+        tail = self._tail(index)
+        # New streams must become indirect objects when the page is cloned into the writer
+        push.indirect_reference = None
+        tail.indirect_reference = None
+
+        page[NameObject("/Contents")] = ArrayObject([push] + list(original) + [tail])
+        page[NameObject("/Resources")] = self._resources(template_page, index)
+        return page
+
+    def _serialize(self, template):
+        """Write the template pages once and split the bytes around the placeholder streams."""
+        writer = PdfWriter()
+        for index, template_page in enumerate(template.pages):
+            writer.add_page(self._stamped_page(template, index) if index in self._page_fields else template_page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        data = buffer.getvalue()
+
+        # Locate the placeholder objects, in file order
+        slots = []
+        for page in self._page_fields:
+            marker = data.index(PLACEHOLDER + b" %d\n" % page)
+            obj_start = data.rfind(b" 0 obj\n", 0, marker)
+            obj_start = data.rfind(b"\n", 0, obj_start) + 1
+            obj_end = data.index(b"endobj\n", marker) + len(b"endobj\n")
+            slots.append((obj_start, obj_end, page))
+        slots.sort()
+
+        xref_start, self._offsets, self._trailer = read_xref(data)
+
+        # Bytes between the placeholder objects, which are rebuilt per certificate
+        self._chunks = []
+        self._slots = []
+        position = 0
+        for obj_start, obj_end, page in slots:
+            self._chunks.append(data[position:obj_start])
+            self._slots.append((int(data[obj_start:data.index(b" ", obj_start)]), page, obj_start,
+                                obj_end - obj_start))
+            position = obj_end
+        self._chunks.append(data[position:xref_start])
+        self._slot_offsets = [obj_offset for _, _, obj_offset, _ in self._slots]
+        self._count = len(self._offsets) + 1
+
+    def supports(self, values):
+        """Return True if every field's text can be drawn with its font's own encoding."""
+        return all(text.supports(value) for text, value in zip(self.texts, values))
+
+    def render(self, values, font_sizes=None):
+        """
+        Render a certificate.
+
+        Args:
+            values: Texts of the layout's fields (must satisfy supports())
+            font_sizes: Font size of each field (default: auto-fitted from the font settings)
+
+        Returns:
+            Bytes of the certificate PDF
+        """
+        # Close the template's graphics state, then draw the page's fields
+        return self._assemble({page: _stream(b"\nQ\n" + fields_ops(self.texts, values, font_sizes, indices))
+                               for page, indices in self._page_fields.items()})
+
+    def _assemble(self, slots, extra=()):
+        """
+        Return the PDF bytes with the placeholder objects replaced.
+
+        Args:
+            slots: {template page index: body of the object replacing the page's placeholder object}
+            extra: Bodies of new objects, numbered from the first free object number on
+
+        Returns:
+            Bytes of the PDF
+        """
+        parts = [self._chunks[0]]
+        shifts = [0]
+        for (obj_num, page, _, obj_len), chunk in zip(self._slots, self._chunks[1:]):
+            obj = b"%d 0 obj\n" % obj_num + slots[page] + b"\nendobj\n"
+            parts += (obj, chunk)
+            shifts.append(shifts[-1] + len(obj) - obj_len)
+
+        extra_offsets = []
+        position = sum(map(len, parts))
+        for obj_num, body in enumerate(extra, self._count):
+            obj = b"%d 0 obj\n" % obj_num + body + b"\nendobj\n"
+            extra_offsets.append(position)
+            parts.append(obj)
+            position += len(obj)
+        xref_location = position
+
+        # Objects after a placeholder move by the size change of the placeholders before them
+        count = self._count + len(extra)
+        xref = [b"xref\n0 %d\n0000000000 65535 f \n" % count]
+        for offset in self._offsets:
+            xref.append(b"%010d 00000 n \n" % (offset + shifts[bisect_left(self._slot_offsets, offset)]))
+        xref += [b"%010d 00000 n \n" % offset for offset in extra_offsets]
+
+        trailer = self._trailer
+        if extra:
+            trailer = trailer.replace(b"/Size %d\n" % self._count, b"/Size %d\n" % count, 1)
+        return b"".join(parts + xref + [trailer, b"startxref\n%d\n%%%%EOF\n" % xref_location])
+
+    def write(self, values, output_path, font_sizes=None):
+        """
+        Write a certificate.
+
+        Args:
+            values: Texts of the layout's fields (must satisfy supports())
+            output_path: Path where to save the certificate
+            font_sizes: Font size of each field (default: auto-fitted from the font settings)
+        """
+        with atomic_open(output_path) as f:
+            f.write(self.render(values, font_sizes))
+
+
+class OverlayStamper(TextStamper):
+    """
+    Stamps ReportLab overlays (see processor.render_overlay) onto templates with pages that receive no text.
+
+    As in TextStamper, the template pages are serialized a single time, so
+    pages without text are copied as bytes instead of going through
+    PdfWriter for every certificate. Each page that receives text ends by
+    drawing a form XObject; per certificate only that form is replaced with
+    the overlay page (its content, clipped to OVERLAY_BOX by the form's
+    bounding box as merge_page clips the overlay, and its resources), and the
+    objects the overlay's fonts refer to are appended.
+    """
+
+    def __init__(self, template, pages):
+        """
+        Args:
+            template: CompiledTemplate to stamp onto
+            pages: Template pages the overlay pages are merged onto, in order (see processor.merge_overlay)
+        """
+        self._page_fields = dict.fromkeys(pages)
+        self._compress = template.optimized
+        self._form_name = next(self._free_names(template, pages, "/XObject", "/SignitOverlay"))
+        self._serialize(template)
+
+    def _resources(self, template_page, index):
+        """Return a copy of a template page's resources with the overlay form added."""
+        placeholder = DecodedStreamObject()
+        placeholder.set_data(PLACEHOLDER + b" %d\n" % index)
+        placeholder.indirect_reference = None
+        return self._add_resources(template_page, "/XObject", {self._form_name: placeholder})
+
+    def _tail(self, index):
+        """Return the stream drawing the overlay form after a template page's content."""
+        tail = DecodedStreamObject()
+        tail.set_data(b"\nQ\nq " + self._form_name.encode() + b" Do Q\n")
+        return tail
+
+    def render(self, overlay):
+        """
+        Render a certificate.
+
+        Args:
+            overlay: Overlay PDF (path, bytes or file-like buffer) with a page per template page that receives text
+
+        Returns:
+            Bytes of the certificate PDF
+        """
+        if isinstance(overlay, bytes):
+            overlay = io.BytesIO(overlay)
+        overlay_pages = PdfReader(overlay).pages
+
+        extra = []
+        copied = {}  # overlay object number -> object number in the certificate
+
+        def reference(ref):
+            if ref.idnum not in copied:
+                # Numbered before its body is built, so objects referring to each other work
+                copied[ref.idnum] = self._count + len(extra)
+                extra.append(None)
+                body = io.BytesIO()
+                remap_references(ref.get_object(), reference).write_to_stream(body, None)
+                extra[copied[ref.idnum] - self._count] = body.getvalue()
+            return IndirectObject(copied[ref.idnum], 0, None)
+
+        forms = {}
+        for page, overlay_page in zip(self._page_fields, overlay_pages):
+            form = DecodedStreamObject()
+            form.set_data(page_content(overlay_page))
+            if self._compress:
+                form = form.flate_encode()
+            form[NameObject("/Type")] = NameObject("/XObject")
+            form[NameObject("/Subtype")] = NameObject("/Form")
+            form[NameObject("/BBox")] = ArrayObject(FloatObject(value) for value in OVERLAY_BOX)
+            form[NameObject("/Resources")] = remap_references(overlay_page.raw_get("/Resources"), reference)
+            body = io.BytesIO()
+            form.write_to_stream(body, None)
+            forms[page] = body.getvalue()
+        return self._assemble(forms, extra)
+
+    def write(self, overlay, output_path):
+        """
+        Write a certificate.
+
+        Args:
+            overlay: Overlay PDF (path, bytes or file-like buffer), see render()
+            output_path: Path where to save the certificate
+        """
+        with atomic_open(output_path) as f:
+            f.write(self.render(overlay))
+
+
+def font_snippets(layout, resource_names, embed=False):
+    """
+    Return a TextSnippet per layout field, with one font resource per distinct font.
+
+    Args:
+        layout: modules.layout.Layout
+        resource_names: Iterator of free font resource names
+        embed: Embed the TrueType fonts, one fonts.EmbeddedFont per font shared by
+            its snippets (the document must write them, see embedded_fonts)
+    """
+    fonts = {}
+    embedded = {}
+    texts = []
+    for field in layout.fields:
+        family = field.font_settings["family"]
+        if family not in fonts:
+            fonts[family] = next(resource_names)
+            if embed and is_font_file(family):
+                embedded[family] = EmbeddedFont(family, fonts[family])
+        texts.append(TextSnippet(field.font_settings, field.position, fonts[family], embedded.get(family)))
+    return texts
+
+
+def font_dictionaries(texts):
+    """Return {resource name: font dictionary} for the fonts used by the snippets, except embedded ones."""
+    return {text.resource_name: text.font_dictionary() for text in texts if text.embedded is None}
+
+
+def embedded_fonts(texts):
+    """Return the distinct fonts.EmbeddedFont of the snippets."""
+    return list({id(text.embedded): text.embedded for text in texts if text.embedded is not None}.values())
+
+
+def page_content(page):
+    """Return the decoded content stream of a page (several streams are joined)."""
+    contents = page.get("/Contents")
+    if contents is None:
+        return b""
+    contents = contents.get_object()
+    if isinstance(contents, list):
+        return b"\n".join(stream.get_object().get_data() for stream in contents)
+    return contents.get_data()
+
+
+def remap_references(obj, reference):
+    """
+    Return a PyPDF2 object with its indirect references replaced.
+
+    Args:
+        obj: PyPDF2 object, or an indirect reference
+        reference: Function (IndirectObject) returning the IndirectObject to use instead
+
+    Returns:
+        A copy of obj's containers (streams keep their data); other objects are shared
+    """
+    if isinstance(obj, IndirectObject):
+        return reference(obj)
+    if isinstance(obj, DictionaryObject):
+        # Shallow copy, so streams keep their data
+        remapped = copy.copy(obj)
+        remapped.clear()
+        remapped.update((key, remap_references(value, reference)) for key, value in obj.items())
+        return remapped
+    if isinstance(obj, ArrayObject):
+        return ArrayObject(remap_references(value, reference) for value in obj)
+    return obj
+
+
+def _stream(data):
+    """Return the body of an uncompressed stream object."""
+    return b"<<\n/Length %d\n>>\nstream\n" % len(data) + data + b"\nendstream"
+
+
+def _escape(data):
+    """Return bytes escaped for a PDF string literal."""
+    return escapePDF(data.decode("latin-1")).encode("latin-1")
+
+
+def fields_ops(texts, values, font_sizes=None, indices=None):
+    """
+    Return the operators drawing the fields' texts with their snippets.
+
+    Args:
+        texts: TextSnippet of each field (see font_snippets)
+        values: Texts of the fields
+        font_sizes: Font size of each field (default: auto-fitted from the font settings)
+        indices: Indices of the fields to draw (default: all of them)
+    """
+    if font_sizes is None:
+        font_sizes = (None,) * len(texts)
+    if indices is None:
+        indices = range(len(texts))
+    return b"".join(texts[i].ops(values[i], font_sizes[i]) for i in indices)
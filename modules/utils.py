@@ -1,42 +1,285 @@
 # utils.py
 
+import codecs
 import csv
 import os
+import uuid
+from contextlib import contextmanager
+from itertools import islice
 
 
-def read_names_from_csv(csv_path):
+# Number of bytes read to detect the encoding of a CSV file
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+# Encoding used when detection has nothing better (it decodes any byte)
+FALLBACK_ENCODING = 'latin-1'
+
+# Minimum confidence for chardet's guess to be used
+MIN_ENCODING_CONFIDENCE = 0.5
+
+# Extensions of the font files accepted as a font family (see modules.fonts)
+FONT_FILE_EXTENSIONS = (".ttf", ".otf")
+
+
+def read_names_from_csv(csv_path, column=0, has_header=False):
     """
     Read names from a CSV file (single column with names).
 
     Args:
         csv_path: Path to the CSV file
+        column: Index of the column with the names (or its header name when has_header is set)
+        has_header: Whether the first row is a header row
 
     Returns:
         List of names (strings)
     """
-    names = []
-
-    # Determine the encoding to use
-    encodings = ['utf-8-sig', 'utf-8', 'latin-1']
-
-    for encoding in encodings:
-        try:
-            with open(csv_path, 'r', newline='', encoding=encoding) as csvfile:
-                reader = csv.reader(csvfile)
-                for row in reader:
-                    if row and len(row) > 0 and row[0].strip():
-                        names.append(row[0].strip())
-
-            # If we reached here without error, break the loop
-            break
-        except UnicodeDecodeError:
-            # Try the next encoding
-            continue
-        except Exception as e:
-            # Re-raise other exceptions
-            raise e
-
-    return names
+    return list(iter_names_from_csv(csv_path, column, has_header))
+
+
+def count_names_from_csv(csv_path, column=0, has_header=False):
+    """
+    Count the names in a CSV file without keeping them in memory (e.g. for a progress bar).
+
+    Args:
+        csv_path: Path to the CSV file
+        column: Index of the column with the names (or its header name when has_header is set)
+        has_header: Whether the first row is a header row
+
+    Returns:
+        Number of names iter_names_from_csv yields
+    """
+    return sum(1 for _ in iter_names_from_csv(csv_path, column, has_header))
+
+
+def iter_names_from_csv(csv_path, column=0, has_header=False):
+    """
+    Lazily yield names from a CSV file, reading it a single time (see iter_csv for the exception).
+
+    The encoding is detected once from a bounded sample (see detect_encoding),
+    so memory use does not depend on the size of the file. Bytes past the
+    sample that do not decode are handled as described in iter_csv.
+
+    Args:
+        csv_path: Path to the CSV file
+        column: Index of the column with the names (or its header name when has_header is set)
+        has_header: Whether the first row is a header row
+
+    Yields:
+        Names (strings), skipping empty cells
+    """
+    reader = iter_csv(csv_path)
+
+    if has_header:
+        header = next(reader, [])
+        if isinstance(column, str):
+            stripped = [cell.strip() for cell in header]
+            if column not in stripped:
+                raise ValueError(f"Column '{column}' not found in CSV header")
+            column = stripped.index(column)
+    elif isinstance(column, str):
+        raise ValueError("A column name requires has_header=True")
+
+    for row in reader:
+        if len(row) > column and row[column].strip():
+            yield row[column].strip()
+
+
+def iter_rows_from_csv(csv_path, has_header=False):
+    """
+    Lazily yield the rows of a CSV file, reading it a single time.
+
+    Args:
+        csv_path: Path to the CSV file
+        has_header: Whether the first row is a header row (it is skipped, see read_csv_header)
+
+    Yields:
+        Rows (lists of stripped cells), skipping empty rows
+    """
+    reader = iter_csv(csv_path)
+    if has_header:
+        next(reader, None)
+
+    for row in reader:
+        row = [cell.strip() for cell in row]
+        if any(row):
+            yield row
+
+
+def read_csv_header(csv_path):
+    """
+    Return the header row of a CSV file.
+
+    Args:
+        csv_path: Path to the CSV file
+
+    Returns:
+        List of stripped header cells (empty for an empty file)
+    """
+    reader = iter_csv(csv_path)
+    try:
+        return [cell.strip() for cell in next(reader, [])]
+    finally:
+        reader.close()
+
+
+def iter_csv(csv_path):
+    """
+    Lazily yield the raw rows of a CSV file, decoded strictly with its detected encoding.
+
+    The encoding is guessed from a sample (see detect_encoding), so a byte
+    further on may not decode. If every row read before it was ASCII, which
+    decodes the same in any encoding, the file is read again once with
+    FALLBACK_ENCODING, skipping the rows already yielded. Otherwise the
+    rows already yielded would be in a different encoding than the rest,
+    so a ValueError naming the line is raised instead.
+
+    Args:
+        csv_path: Path to the CSV file
+
+    Yields:
+        Rows (lists of cells, as csv.reader returns them)
+
+    Raises:
+        ValueError: If the file does not decode with a single encoding
+    """
+    encoding = detect_encoding(csv_path)
+    count = 0
+    ascii_only = True
+
+    try:
+        with open(csv_path, 'r', newline='', encoding=encoding) as csvfile:
+            for row in csv.reader(csvfile):
+                ascii_only = ascii_only and all(cell.isascii() for cell in row)
+                count += 1
+                yield row
+        return
+    except UnicodeDecodeError as e:
+        if not ascii_only or encoding == FALLBACK_ENCODING:
+            line = _undecodable_line(csv_path, encoding)
+            raise ValueError(f"{csv_path}: line {line} is not valid {encoding} ({e.reason}), "
+                             f"but earlier lines were read as {encoding}; save the file as UTF-8") from e
+
+    with open(csv_path, 'r', newline='', encoding=FALLBACK_ENCODING) as csvfile:
+        yield from islice(csv.reader(csvfile), count, None)
+
+
+def _undecodable_line(path, encoding):
+    """Return the number of the first line of a file that does not decode with an encoding."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    number = 0
+    with open(path, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            try:
+                decoder.decode(line)
+            except UnicodeDecodeError:
+                return number
+    return number
+
+
+def detect_encoding(path, sample_size=ENCODING_SAMPLE_SIZE):
+    """
+    Detect the text encoding of a file from its first bytes.
+
+    A byte order mark wins, then UTF-8 if the sample is valid UTF-8, then
+    chardet's guess if it is confident enough; FALLBACK_ENCODING is the
+    last resort. A file valid in the sample may still fail to decode
+    further on (see iter_csv).
+
+    Args:
+        path: Path to the file
+        sample_size: Maximum number of bytes to inspect
+
+    Returns:
+        Encoding name usable with open()
+    """
+    with open(path, 'rb') as f:
+        sample = f.read(sample_size)
+
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+
+    try:
+        # An incomplete character at the end of the sample is not an error
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    # Only needed for files that are not UTF-8, so it is not imported at start-up
+    import chardet
+
+    guess = chardet.detect(sample)
+    if guess["encoding"] and guess["confidence"] >= MIN_ENCODING_CONFIDENCE:
+        return guess["encoding"]
+
+    return FALLBACK_ENCODING
+
+
+def is_font_file(font_name):
+    """Return True if a font family is the path of a TrueType/OpenType font file."""
+    return font_name.lower().endswith(FONT_FILE_EXTENSIONS)
+
+
+def resolve_font_name(font_name, bold=False, italic=False):
+    """
+    Return the base-14 font name for a family with bold/italic styles applied.
+
+    Args:
+        font_name: Font family ("Times-Roman", "Helvetica", "Courier", ...) or font file path
+        bold: Use the bold variant
+        italic: Use the italic/oblique variant
+
+    Returns:
+        Font name (unchanged for families without variants and for font files, which
+        are a single style each)
+    """
+    # Add Bold/Italic suffixes for standard fonts
+    if font_name in ["Times-Roman", "Helvetica", "Courier"]:
+        if bold and italic:
+            if font_name == "Times-Roman":
+                font_name = "Times-BoldItalic"
+            else:
+                font_name = f"{font_name}-BoldOblique"
+        elif bold:
+            if font_name == "Times-Roman":
+                font_name = "Times-Bold"
+            else:
+                font_name = f"{font_name}-Bold"
+        elif italic:
+            if font_name == "Times-Roman":
+                font_name = "Times-Italic"
+            else:
+                font_name = f"{font_name}-Oblique"
+
+    return font_name
+
+
+@contextmanager
+def atomic_open(path, mode="wb", **kwargs):
+    """
+    Open a temporary file next to path and move it over path once closed.
+
+    If the block raises, the temporary file is removed and path is left
+    untouched, so readers never see a truncated file.
+
+    Args:
+        path: Final path of the file
+        mode: File mode ("wb" or "w")
+        kwargs: Extra arguments for open() (e.g. encoding)
+
+    Yields:
+        The open temporary file
+    """
+    directory, filename = os.path.split(os.path.abspath(path))
+    temp_path = os.path.join(directory, f".tmp-{uuid.uuid4().hex}-{filename}")
+    try:
+        with open(temp_path, mode.replace("w", "x"), **kwargs) as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 def ensure_dir(directory):
@@ -0,0 +1,188 @@
+# validation.py
+#
+# Dry-run checks of a batch: every row is laid out exactly as the certificate
+# would draw it (auto-fitted size, text centered on the field's position, see
+# processor._draw_name), using the glyph-width tables of modules.metrics, but
+# no PDF is created. Rows whose text overflows its maximum width, leaves the
+# area where it is visible, or uses characters the font has no glyph for,
+# are reported.
+
+import json
+import os
+import time
+from itertools import islice
+
+from modules.metrics import fit_size, glyph_widths, text_widths
+from modules.stamper import OVERLAY_BOX
+
+# Rows laid out at a time (only these are held in memory)
+VALIDATION_BATCH_SIZE = 4096
+
+# Issues listed by ValidationReport.format()
+REPORTED_ISSUES = 20
+
+
+class ValidationReport:
+    """
+    Result of validate_certificates.
+
+    Attributes:
+        rows: Number of rows checked
+        issues: List of (index, name, problem) tuples, in row order (a row can have several)
+        elapsed: Duration of the check in seconds
+    """
+
+    def __init__(self, rows, issues, elapsed):
+        self.rows = rows
+        self.issues = issues
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        """True when no row has an issue."""
+        return not self.issues
+
+    @property
+    def offending_rows(self):
+        """Number of rows with at least one issue."""
+        return len({index for index, _, _ in self.issues})
+
+    def to_dict(self):
+        return {
+            "rows": self.rows,
+            "offending_rows": self.offending_rows,
+            "elapsed": self.elapsed,
+            "issues": [{"index": index, "name": name, "problem": problem} for index, name, problem in self.issues],
+        }
+
+    def to_json(self, path=None):
+        """
+        Return the report as JSON, also writing it to path when given.
+
+        Args:
+            path: Optional file to write
+        """
+        text = json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        return text
+
+    def format(self, limit=REPORTED_ISSUES):
+        """Return a short human-readable report listing the first issues."""
+        lines = [f"Checked {self.rows} rows in {self.elapsed * 1000:.1f} ms: "
+                 + (f"{self.offending_rows} with issues" if self.issues else "no issues")]
+        for index, name, problem in self.issues[:limit]:
+            lines.append(f"  row {index} ({name}): {problem}")
+        if len(self.issues) > limit:
+            lines.append(f"  ... and {len(self.issues) - limit} more")
+        return "\n".join(lines)
+
+
+def validate_certificates(names_list, layout, template):
+    """
+    Lay out every row of a batch without rendering it, and report the rows that would come out wrong.
+
+    A field's text is reported when it is still wider than max_width at
+    the minimum font size, when it leaves the area where it is visible (the
+    page's crop box intersected with stamper.OVERLAY_BOX, which every
+    engine clips text to), or when it has characters the font cannot draw
+    (ReportLab substitutes them for base-14 fonts, TrueType fonts draw
+    their empty glyph). Fonts without a width table (Symbol, ZapfDingbats)
+    are not checked for glyphs.
+
+    Args:
+        names_list: Iterable of rows (names, or CSV rows for a layout), read lazily
+        layout: modules.layout.Layout with the fields to check
+        template: CompiledTemplate whose page boxes bound the text (with the overlay box)
+
+    Returns:
+        ValidationReport
+    """
+    start = time.perf_counter()
+    layout.check_pages(len(template.pages))
+    boxes = {}
+    for page in layout.pages:
+        page_box = _page_box(template.pages[page])
+        boxes[page] = page_box, _intersect(page_box, OVERLAY_BOX)
+    labels = [_field_label(field, len(layout.fields)) for field in layout.fields]
+
+    issues = []
+    count = 0
+    rows = iter(names_list)
+    while True:
+        batch = [layout.values(row) for row in islice(rows, VALIDATION_BATCH_SIZE)]
+        if not batch:
+            break
+        batch_issues = []
+        for i, field in enumerate(layout.fields):
+            texts = [values[i] for values in batch]
+            for offset, problem in _check_field(texts, field, boxes[field.page]):
+                batch_issues.append((offset, i, labels[i] + problem))
+        # Rows in order, then fields in layout order
+        batch_issues.sort(key=lambda issue: issue[:2])
+        issues += [(count + offset, layout.name(batch[offset]), problem) for offset, _, problem in batch_issues]
+        count += len(batch)
+
+    return ValidationReport(count, issues, time.perf_counter() - start)
+
+
+def _check_field(texts, field, boxes):
+    """
+    Yield (offset in texts, problem) for the texts of one field that would not be drawn correctly.
+
+    boxes is the (page box, visible box) pair of the field's page.
+    """
+    font_settings = field.font_settings
+    font_name = font_settings["family"]
+    size = font_settings["size"]
+    max_width = font_settings.get("max_width")
+    glyphs = glyph_widths(font_name)
+    font_label = os.path.basename(font_name)
+    x, y = field.position
+    page_box, visible_box = boxes
+
+    for offset, (text, width) in enumerate(zip(texts, text_widths(texts, font_name, size))):
+        if glyphs is not None:
+            missing = set(text).difference(glyphs)
+            if missing:
+                yield offset, f"no glyph for {''.join(sorted(missing))!r} in {font_label}"
+
+        font_size = fit_size(width, font_settings)
+        width = width * font_size / size
+        if max_width and width > max_width:
+            yield offset, f"{width:.0f} pt wide at {font_size:g} pt, more than max_width {max_width:g}"
+
+        # Same placement as processor._draw_name
+        text_box = (x - width / 2, y - font_size / 2, x + width / 2, y + font_size / 2)
+        past = _outside(text_box, page_box)
+        if past > 0:
+            yield offset, f"runs {past:.0f} pt off page {field.page + 1}"
+            continue
+        past = _outside(text_box, visible_box)
+        if past > 0:
+            yield offset, (f"runs {past:.0f} pt out of the {OVERLAY_BOX[2]:g}x{OVERLAY_BOX[3]:g} pt area "
+                           f"text is drawn in on page {field.page + 1}")
+
+
+def _page_box(page):
+    """Return the visible (crop) box of a template page as (left, bottom, right, top) in points."""
+    box = page.cropbox
+    return float(box.left), float(box.bottom), float(box.right), float(box.top)
+
+
+def _intersect(box, other):
+    """Return the intersection of two (left, bottom, right, top) boxes (empty boxes have right < left)."""
+    return max(box[0], other[0]), max(box[1], other[1]), min(box[2], other[2]), min(box[3], other[3])
+
+
+def _outside(text_box, box):
+    """Return how far in points a text box extends past a box (0 or less when it is inside)."""
+    return max(box[0] - text_box[0], text_box[2] - box[2], box[1] - text_box[1], text_box[3] - box[3])
+
+
+def _field_label(field, field_count):
+    """Return the prefix naming a field in the problems of a multi-field layout."""
+    if field_count == 1:
+        return ""
+    return f"column {field.column}: " if isinstance(field.column, int) else f"{field.column}: "